@@ -12,6 +12,7 @@ from pyaspora.roster.views import blueprint as roster_blueprint
 from pyaspora.tag.views import blueprint as tags_blueprint
 from pyaspora.user.views import blueprint as users_blueprint
 from pyaspora.utils import templates
+from pyaspora.utils.memo import forget_request_memos
 
 app = Flask(__name__)
 db.init_app(app)
@@ -19,6 +20,9 @@ db.init_app(app)
 # Global configuration
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# Per-request memos of model lookups
+app.teardown_request(forget_request_memos)
+
 # Register modules
 app.register_blueprint(content_blueprint, url_prefix='/content')
 app.register_blueprint(contacts_blueprint, url_prefix='/contacts')
@@ -44,7 +48,34 @@ except:
 
 
 def init_db():
+    from pyaspora.database import add_missing_columns, \
+        add_missing_indexes, drop_old_indexes
+    from pyaspora.diaspora.models import DiasporaContact, DiasporaPost
+    from pyaspora.feed.models import TimelineEntry
+    from pyaspora.post.models import AudienceList, Post
     db.create_all()
+    add_missing_columns()
+
+    # Lists with the same members have to be merged before their digests
+    # can be given a unique index
+    AudienceList.merge_duplicates()
+    db.session.commit()
+    add_missing_indexes()
+    # Covered by ix_shares_post_public_hidden, and never used, respectively
+    drop_old_indexes('shares', ['ix_shares_post_id'])
+    drop_old_indexes('posts', ['ix_posts_thread_modified'])
+
+    # Older databases may have local users and posts without Diaspora GUIDs,
+    # and posts without reply counts, thread roots or public flags
+    DiasporaContact.allocate_missing()
+    DiasporaPost.allocate_missing()
+    Post.recount_replies()
+    Post.fill_thread_columns()
+    db.session.commit()
+
+    if TimelineEntry.enabled():
+        TimelineEntry.rebuild_all()
+        db.session.commit()
 
 
 @app.route('/setup')
@@ -2,11 +2,13 @@ from __future__ import absolute_import
 
 from json import dumps
 from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.orm import joinedload, relationship
-from sqlalchemy.sql import and_
+from sqlalchemy.orm import joinedload, relationship, subqueryload
+from sqlalchemy.sql import and_, select
 
 from pyaspora import db
-from pyaspora.content.models import MimePart
+from pyaspora.content.models import MimePart, MimePartRecord
+from pyaspora.database import Record
+from pyaspora.utils.memo import memoised_for_request
 
 
 class Contact(db.Model):
@@ -46,11 +48,12 @@ class Contact(db.Model):
         return db.session.query(cls).options(
             joinedload(cls.avatar),
             joinedload(cls.bio),
-            joinedload(cls.interests),
+            subqueryload(cls.interests),  # SQLite won't index a nested join
             joinedload(cls.user)
         )
 
     @classmethod
+    @memoised_for_request
     def get(cls, contact_id, prefetch=True):
         """
         Get a contact by primary key ID. None is returned if the Contact
@@ -70,6 +73,73 @@ class Contact(db.Model):
         """
         return cls._get_base(). filter(cls.id.in_(contact_ids))
 
+    @classmethod
+    def get_many_records(cls, contact_ids):
+        """
+        ContactRecords for the Contacts with IDs <contact_ids>, read without
+        loading any model objects. The records are returned in an unsorted
+        order.
+        """
+        from pyaspora.diaspora.models import DiasporaContact
+        from pyaspora.tag.models import Interest, Tag, TagRecord
+        from pyaspora.user.models import User
+
+        if not contact_ids:
+            return []
+        rows = db.session.execute(
+            select([
+                cls.id, cls.realname, cls.avatar_id, User.email,
+                DiasporaContact.username, MimePart.id, MimePart.type,
+                MimePart.body, MimePart.text_preview
+            ]).
+            select_from(
+                cls.__table__.
+                outerjoin(User.__table__, User.contact_id == cls.id).
+                outerjoin(DiasporaContact.__table__,
+                          DiasporaContact.contact_id == cls.id).
+                outerjoin(MimePart.__table__, MimePart.id == cls.bio_id)
+            ).
+            where(cls.id.in_(contact_ids))
+        ).fetchall()
+
+        interests = {}
+        tags = db.session.execute(
+            select([Interest.contact_id, Tag.id, Tag.name]).
+            select_from(Interest.__table__.join(Tag.__table__)).
+            where(Interest.contact_id.in_(contact_ids))
+        )
+        for tag in tags:
+            interests.setdefault(tag[0], []).append(TagRecord(*tag[1:]))
+
+        return [
+            ContactRecord(
+                row[0],
+                row[1],
+                row[2],
+                MimePartRecord(*row[5:]) if row[5] is not None else None,
+                UserRecord(row[3]) if row[3] is not None else None,
+                DiasporaRecord(row[4]) if row[4] is not None else None,
+                interests.get(row[0], [])
+            )
+            for row in rows
+        ]
+
+    def cache_tag(self, kind):
+        """
+        The response-cache tag for cached documents of type <kind> (eg.
+        "profile") that describe this Contact.
+        """
+        return 'contact:{0}:{1}'.format(self.id, kind)
+
+    def profile_changed(self):
+        """
+        Drop cached federation documents (webfinger, hCard, public feeds)
+        describing this Contact once the session is committed. Call this when
+        the name, avatar or key changes.
+        """
+        from pyaspora.utils.cache import invalidate_on_commit
+        invalidate_on_commit(self.cache_tag('profile'), self.cache_tag('feed'))
+
     def subscribe(self, contact):
         """
         Subscribe self to contact.
@@ -107,11 +177,14 @@ class Contact(db.Model):
         The notice is also placed on <self>'s feed so they can know that
         they sent it.
         """
+        from pyaspora.diaspora.models import DiasporaPost
         from pyaspora.post.models import Post
 
         assert(self.user or contact.user)
         p = Post(author=self)
         db.session.add(p)
+        if self.user:
+            DiasporaPost.get_for_post(p, commit=False)
 
         p.add_part(
             order=0,
@@ -132,17 +205,18 @@ class Contact(db.Model):
             p.share_with([contact])
         p.thread_modified()
 
+    @memoised_for_request
     def subscribed_to(self, contact):
         """
-        Check if the user is subscribed to <contact> and return the
-        Subscription object if so. If the user has no subscriptions to Contact
-        then None will be returned.
+        Check if the user is subscribed to <contact> (a Contact or a
+        ContactRecord) and return the Subscription object if so. If the user
+        has no subscriptions to Contact then None will be returned.
         """
         from pyaspora.roster.models import Subscription
         return db.session.query(Subscription). \
             filter(and_(
-                Subscription.from_contact == self,
-                Subscription.to_contact == contact,
+                Subscription.from_id == self.id,
+                Subscription.to_id == contact.id,
             )).first()
 
     def friends(self):
@@ -163,3 +237,27 @@ class Contact(db.Model):
         friends = db.session.query(Contact).join(Subscription.from_contact). \
             filter(Subscription.to_contact == self)
         return friends
+
+
+class ContactRecord(Record):
+    """
+    The columns of a Contact, and of its User, DiasporaContact, bio and
+    interests, that json_contact() shows to the public. "avatar" is the ID
+    of the avatar MimePart rather than the part itself.
+    """
+    __slots__ = ('id', 'realname', 'avatar', 'bio', 'user', 'diasp',
+                 'interests')
+
+
+class UserRecord(Record):
+    """
+    The columns of a User that json_contact() shows.
+    """
+    __slots__ = ('email',)
+
+
+class DiasporaRecord(Record):
+    """
+    The columns of a DiasporaContact that json_contact() shows.
+    """
+    __slots__ = ('username',)
@@ -63,6 +63,9 @@ Display a contact's "wall", which varies according to who is viewing it.
 
 {% if feed %}
     {{show_feed(feed)}}
+    {% if actions.more %}
+        {{button_form(actions.more, 'View older items', method='get')}}
+    {% endif %}
 {% else %}
     <p>No news to show.</p>
 {% endif %}
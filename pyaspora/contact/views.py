@@ -8,7 +8,7 @@ from __future__ import absolute_import
 
 from datetime import timedelta
 from flask import Blueprint, current_app, request, url_for, \
-    abort as flask_abort
+    abort as flask_abort, redirect as flask_redirect
 from hashlib import md5
 from lxml import etree
 from re import match as re_match
@@ -17,9 +17,14 @@ from sqlalchemy.orm import contains_eager
 from sqlalchemy.sql import desc, or_
 
 from pyaspora.contact.models import Contact
+from pyaspora.content.proxy import part_body
 from pyaspora.database import db
+from pyaspora.roster.graph import SubscriptionGraph
 from pyaspora.tag.views import json_tag
 from pyaspora.utils import get_server_name
+from pyaspora.utils.cache import cached_response
+from pyaspora.utils.pagination import more_link, page_size, paginate, \
+    request_cursor
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
     raw_response, redirect, render_response, send_xml
 from pyaspora.user.session import logged_in_user, require_logged_in_user
@@ -49,7 +54,13 @@ def avatar(contact_id):
     if not part:
         abort(404, 'Contact has no avatar', force_status=True)
 
-    return raw_response(part.body, part.type, expiry_delta=timedelta(hours=12))
+    body = part_body(part)
+    if body is None:
+        if part.remote and part.remote.too_large:
+            return flask_redirect(part.remote.url)
+        abort(503, 'Avatar temporarily unavailable', force_status=True)
+
+    return raw_response(body, part.type, expiry_delta=timedelta(hours=12))
 
 
 def _profile_base(contact_id, public=False):
@@ -67,7 +78,8 @@ def _profile_base(contact_id, public=False):
     viewing_as = None if public else logged_in_user()
 
     data = json_contact(contact, viewing_as)
-    limit = int(request.args.get('limit', 25))
+    size = page_size(25)
+    cursor = request_cursor()
 
     if viewing_as and request.args.get('refresh', False) and contact.diasp:
         try:
@@ -86,15 +98,36 @@ def _profile_base(contact_id, public=False):
                 contact, viewing_as)
             feed_query = or_(feed_query, shared_query)
 
-        feed = db.session.query(Share). \
+        query = db.session.query(Share). \
             join(Post). \
             filter(feed_query). \
-            order_by(desc(Post.thread_modified_at)). \
+            order_by(desc(Post.thread_modified_at), desc(Post.id)). \
             group_by(Post.id). \
-            options(contains_eager(Share.post)). \
-            limit(limit)
+            options(contains_eager(Share.post))
+        if cursor:
+            query = query.filter(Post.Queries.older_than(cursor))
+        feed, next_cursor = paginate(
+            query,
+            size,
+            lambda s: (s.post.thread_modified_at, s.post.id)
+        )
 
-        data['feed'] = json_posts([(s.post, s) for s in feed], viewing_as)
+        if viewing_as:
+            feed = Share.pair_with_posts(
+                [s.post for s in feed], viewing_as.contact)
+        else:
+            feed = [(s.post, s) for s in feed]
+        data['feed'] = json_posts(
+            feed,
+            viewing_as.contact if viewing_as else None
+        )
+        data['next'] = next_cursor
+        data['actions']['more'] = more_link(
+            request.endpoint,
+            next_cursor,
+            contact_id=contact.id,
+            public=request.args.get('public', None)
+        )
 
     add_logged_in_user_to_data(data, viewing_as)
     return data, contact
@@ -122,6 +155,18 @@ def feed(contact_id):
     An Atom feed of public events for the contact. Only available for contacts
     who are local to this server.
     """
+    return cached_response(
+        (
+            'atom',
+            contact_id,
+            request.args.get('limit', None),
+            request.args.get('before', None)
+        ),
+        lambda: _build_feed(contact_id)
+    )
+
+
+def _build_feed(contact_id):
     data, contact = _profile_base(contact_id, public=True)
     if not(contact.user and contact.user.activated):
         flask_abort(404, 'No such user')
@@ -154,7 +199,10 @@ def feed(contact_id):
         etree.SubElement(entry, "content").text = \
             "\n\n".join(p['body']['text'] for p in post['parts'])
 
-    return send_xml(doc)
+    from pyaspora.post.models import Post
+    tags = [contact.cache_tag('feed')] + \
+        [Post.cache_tag(post['id']) for post in data['feed']]
+    return send_xml(doc), tags
 
 
 def json_contact(contact, viewing_as=None):
@@ -216,11 +264,12 @@ def json_contact(contact, viewing_as=None):
         resp['bio'] = json_part(fake_part)
 
     if viewing_as:
+        graph = SubscriptionGraph.current()
         if viewing_as.id == contact.id:  # Viewing own profile
             resp['actions'].update({
                 'edit': url_for('users.info', _external=True)
             })
-        elif viewing_as.contact.subscribed_to(contact):  # Friend
+        elif graph.subscribed(viewing_as.contact.id, contact.id):  # Friend
             resp['actions'].update({
                 'remove': url_for(
                     'roster.unsubscribe',
@@ -1,8 +1,11 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, Integer, LargeBinary, String
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, LargeBinary, \
+    String
+from sqlalchemy.orm import backref, relationship
+from sqlalchemy.sql.expression import false
 
-from pyaspora.database import db
+from pyaspora.database import Record, db
 
 
 class MimePart(db.Model):
@@ -30,3 +33,40 @@ class MimePart(db.Model):
         doesn't exist.
         """
         return db.session.query(cls).get(part_id)
+
+
+class MimePartRecord(Record):
+    """
+    The columns of a MimePart that the renderers use. The body may be None if
+    it wasn't needed.
+    """
+    __slots__ = ('id', 'type', 'body', 'text_preview')
+
+
+class RemotePart(db.Model):
+    """
+    Where a MimePart received from another node came from. If remote media is
+    fetched lazily the part's body is left empty and is downloaded, through
+    the media cache, the first time it is viewed.
+
+    Fields:
+        part_id - the database primary key of the MimePart
+        url - the location of the body on the remote node
+        etag - the ETag the remote node sent with the body, if any
+        last_modified - the Last-Modified header sent with the body, if any
+        content_hash - SHA-256 hex digest of the body, once downloaded
+        too_large - whether the body is larger than REMOTE_MEDIA_MAX_SIZE, so
+                    is never downloaded and viewers are sent to <url> instead
+    """
+    __tablename__ = 'remote_parts'
+    part_id = Column(Integer, ForeignKey('mime_parts.id'), primary_key=True)
+    url = Column(String, nullable=False)
+    etag = Column(String, nullable=True)
+    last_modified = Column(String, nullable=True)
+    content_hash = Column(String, nullable=True)
+    too_large = Column(Boolean, nullable=False, default=False,
+                       server_default=false())
+
+    part = relationship(MimePart, single_parent=True,
+                        backref=backref('remote', uselist=False,
+                                        cascade='all, delete-orphan'))
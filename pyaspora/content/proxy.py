@@ -0,0 +1,167 @@
+"""
+A caching proxy for media held on other nodes. Parts that were only recorded
+by URL (see RemotePart) are downloaded on first view and kept in an on-disk
+cache, with the least-recently viewed items evicted once the cache is full.
+"""
+from __future__ import absolute_import
+
+from flask import current_app
+from hashlib import sha256
+from os import fdopen, listdir, makedirs, path, remove, rename, stat, utime
+from tempfile import gettempdir, mkstemp
+from threading import BoundedSemaphore, Lock
+from traceback import format_exc
+try:
+    from urllib.request import Request, urlopen
+except:
+    from urllib2 import Request, urlopen
+
+from pyaspora.database import db
+from pyaspora.diaspora.protocol import USER_AGENT
+
+_fetch_slots = None
+_fetch_slots_lock = Lock()
+
+
+def lazy_fetch_enabled():
+    """
+    Whether media from other nodes should be recorded by URL rather than
+    downloaded when it is received.
+    """
+    return current_app.config.get('FEATURES', {}).get(
+        'lazy_remote_media', False)
+
+
+def shown_inline(mime_type):
+    """
+    Whether media of type <mime_type> from another node is shown inline in a
+    Post. Pictures are; anything else is linked to.
+    """
+    return bool(mime_type and mime_type.startswith('image/'))
+
+
+def part_body(part):
+    """
+    Return the body of MimePart <part>, fetching it from the remote node if it
+    has not been downloaded yet. Returns None if the body can't be fetched
+    right now (the node is down or too many fetches are already running), or
+    ever, if the item is too big; in that case the part's RemotePart is
+    marked as too large, and viewers should be sent to the remote URL.
+    """
+    if part.body or not part.remote:
+        return part.body
+    if part.remote.too_large:
+        return None
+
+    cache_file = path.join(
+        _cache_dir(),
+        sha256(part.remote.url.encode('utf-8')).hexdigest()
+    )
+    try:
+        with open(cache_file, 'rb') as f:
+            body = f.read()
+    except (IOError, OSError):
+        pass
+    else:
+        utime(cache_file, None)  # Recently used
+        return body
+
+    slots = _get_fetch_slots()
+    if not slots.acquire(False):
+        return None
+    try:
+        body, mime_type = _download(part.remote.url)
+    except Exception:
+        current_app.logger.debug(format_exc())
+        return None
+    finally:
+        slots.release()
+
+    if body is None:
+        part.remote.too_large = True
+        db.session.add(part.remote)
+        db.session.commit()
+        return None
+
+    _store(cache_file, body)
+    if mime_type and mime_type != part.type:
+        # The type recorded was only a guess from the URL
+        part.type = mime_type
+        db.session.add(part)
+        for link in part.posts:
+            link.inline = shown_inline(mime_type)
+            db.session.add(link)
+        db.session.commit()
+    return body
+
+
+def _get_fetch_slots():
+    global _fetch_slots
+    with _fetch_slots_lock:
+        if _fetch_slots is None:
+            _fetch_slots = BoundedSemaphore(
+                current_app.config.get('REMOTE_MEDIA_CONCURRENCY', 4))
+    return _fetch_slots
+
+
+def _cache_dir():
+    cache_dir = current_app.config.get('REMOTE_MEDIA_CACHE') or \
+        path.join(gettempdir(), 'pyaspora-media')
+    if not path.isdir(cache_dir):
+        try:
+            makedirs(cache_dir)
+        except OSError:
+            pass  # Created by another request
+    return cache_dir
+
+
+def _download(url):
+    """
+    Fetch <url>, returning the body and MIME type. The body is None if it is
+    larger than the configured limit.
+    """
+    max_size = current_app.config.get('REMOTE_MEDIA_MAX_SIZE',
+                                      5 * 1024 * 1024)
+    req = Request(url)
+    req.add_header('User-Agent', USER_AGENT)
+    resp = urlopen(req, timeout=10)
+    body = resp.read(max_size + 1)
+    if len(body) > max_size:
+        return None, None
+    return body, resp.info().get('Content-Type')
+
+
+def _store(cache_file, body):
+    """
+    Write <body> into the cache, then evict the least recently used items
+    until the cache is back within its size limit.
+    """
+    cache_dir = path.dirname(cache_file)
+    fd, temp_name = mkstemp(dir=cache_dir, prefix='.')
+    with fdopen(fd, 'wb') as f:
+        f.write(body)
+    rename(temp_name, cache_file)
+
+    max_size = current_app.config.get('REMOTE_MEDIA_CACHE_SIZE',
+                                      256 * 1024 * 1024)
+    entries = []
+    total = 0
+    for name in listdir(cache_dir):
+        if name.startswith('.'):
+            continue  # Being written
+        full_name = path.join(cache_dir, name)
+        try:
+            info = stat(full_name)
+        except OSError:
+            continue
+        entries.append((info.st_mtime, info.st_size, full_name))
+        total += info.st_size
+
+    for _, size, full_name in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            remove(full_name)
+        except OSError:
+            pass
+        total -= size
@@ -159,6 +159,12 @@ def pyaspora_share(part, fmt, url):
 
     payload = loads(part.mime_part.body.decode('utf-8'))
     author = payload['author']
+    if payload.get('pending'):
+        # Reshare received before the post it reshares
+        return render_template_string(
+            "shared {{name}}'s post (not yet available)",
+            name=author['username']
+        )
     return render_template_string(
         "shared <a href='{{profile}}'>{{name}}</a>'s post",
         profile=url_for(
@@ -175,16 +181,24 @@ def poll_question(part, fmt, url):
     """
     A question sent as part of a poll from a Diaspora node.
     """
+    from pyaspora.diaspora.models import DiasporaPollVote
+
     if not part.inline:
         return
 
+    votes = getattr(part, 'votes', None)
+    if votes is None:
+        votes = DiasporaPollVote.count_for_poll(part.mime_part.id)
+
     if fmt == 'text/plain':
-        return 'Question: {0}'.format(part.mime_part.body.decode('utf-8'))
+        return 'Question: {0} ({1} votes)'.format(
+            part.mime_part.body.decode('utf-8'), votes)
 
     if fmt == 'text/html':
         return render_template_string(
-            "Question: <strong>{{question}}</strong>",
-            question=part.mime_part.body.decode('utf-8')
+            "Question: <strong>{{question}}</strong> ({{votes}} votes)",
+            question=part.mime_part.body.decode('utf-8'),
+            votes=votes
         )
 
     return None
@@ -193,18 +207,28 @@ def poll_question(part, fmt, url):
 @renderer(['application/x-diaspora-poll-answer'])
 def poll_answer(part, fmt, url):
     """
-    A question sent as part of a poll from a Diaspora node.
+    An answer sent as part of a poll from a Diaspora node, with the number
+    of votes it has received.
     """
+    from pyaspora.diaspora.models import DiasporaPollVote
+
     if not part.inline:
         return
 
+    votes = getattr(part, 'votes', None)
+    if votes is None:
+        votes = DiasporaPollVote.count_for_answer(part.mime_part.id)
+
     if fmt == 'text/plain':
-        return '- {0}'.format(part.mime_part.body.decode('utf-8'))
+        return '- {0} ({1})'.format(
+            part.mime_part.body.decode('utf-8'), votes)
 
     if fmt == 'text/html':
         return render_template_string(
-            "<ul style='margin: 0em'><li>{{question}}</li></ul>",
-            question=part.mime_part.body.decode('utf-8')
+            "<ul style='margin: 0em'><li>{{question}} "
+            "<em>({{votes}})</em></li></ul>",
+            question=part.mime_part.body.decode('utf-8'),
+            votes=votes
         )
 
     return None
@@ -213,7 +237,9 @@ def poll_answer(part, fmt, url):
 @renderer(['application/x-diaspora-poll-participation'])
 def poll_participation(part, fmt, url):
     """
-    A question sent as part of a poll from a Diaspora node.
+    A vote in a poll from a Diaspora node. New votes are tallied by
+    DiasporaPollVote instead, so this only renders votes received before
+    that.
     """
     if not part.inline:
         return
@@ -275,10 +301,10 @@ def diaspora_profile(part, fmt, url):
     Renders a Diaspora profile received from a remote server. Diaspora has
     rather more feature-rich profiles than Pyaspora.
     """
-    payload = loads(part.mime_part.body.decode('utf-8'))
-    payload['parsed_bio'] = _markdown_to_html(payload.get('bio', None) or '')
     if fmt != 'text/html' or not part.inline:
         return None
+    payload = loads(part.mime_part.body.decode('utf-8'))
+    payload['parsed_bio'] = _markdown_to_html(payload.get('bio', None) or '')
 
     templ = """
     <p>{{parsed_bio or '(no info)' |safe}}</p>
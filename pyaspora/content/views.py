@@ -1,9 +1,11 @@
 from __future__ import absolute_import
 
 from datetime import timedelta
-from flask import Blueprint
+from flask import Blueprint, redirect
 
 from pyaspora.content.models import MimePart
+from pyaspora.content.proxy import part_body
+from pyaspora.post.models import Post
 from pyaspora.user.session import logged_in_user
 from pyaspora.utils.rendering import abort, raw_response
 
@@ -22,12 +24,20 @@ def raw(part_id):
 
     # If anyone has shared this part with us (or the public), we get to view
     # it.
-    for link in part.posts:
-        if link.post.has_permission_to_view(logged_in):
-            return raw_response(
-                part.body,
-                part.type,
-                expiry_delta=timedelta(days=365)
-            )
+    viewable = Post.viewable_ids(
+        [link.post_id for link in part.posts],
+        logged_in.contact if logged_in else None
+    )
+    if viewable:
+        body = part_body(part)
+        if body is None:
+            if part.remote and part.remote.too_large:
+                return redirect(part.remote.url)
+            abort(503, 'Content temporarily unavailable', force_status=True)
+        return raw_response(
+            body,
+            part.type,
+            expiry_delta=timedelta(days=365)
+        )
 
     abort(403, 'Forbidden')
@@ -1,5 +1,132 @@
 from __future__ import absolute_import
 
+from flask import current_app
 from flask.ext.sqlalchemy import SQLAlchemy
+from sqlalchemy import MetaData, Table, inspect
+from sqlalchemy.schema import CreateColumn
 
 db = SQLAlchemy()
+
+
+def add_missing_columns():
+    """
+    Add columns that the models define but which are missing from tables
+    created by an older version of Pyaspora. db.create_all() only creates
+    missing tables, so this covers the simple case of a new column on an
+    existing table. New columns must be nullable or have a server default.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            engine.execute('ALTER TABLE {0} ADD COLUMN {1}'.format(
+                table.name,
+                CreateColumn(column).compile(dialect=engine.dialect)
+            ))
+
+
+def add_missing_indexes():
+    """
+    Create indexes that the models define but which are missing from tables
+    created by an older version of Pyaspora, as db.create_all() only creates
+    the indexes of tables it creates.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    for table in db.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+def drop_old_indexes(table_name, names):
+    """
+    Drop the indexes called <names> from table <table_name>, where an older
+    version of Pyaspora created them but the models no longer define them.
+    """
+    engine = db.engine
+    if table_name not in inspect(engine).get_table_names():
+        return
+    table = Table(table_name, MetaData(), autoload=True, autoload_with=engine)
+    for index in table.indexes:
+        if index.name in names:
+            index.drop(engine)
+
+
+def in_chunks(fetch, ids):
+    """
+    For lookups that can only be written as "IN (...)" with a literal list of
+    IDs: call <fetch> with successive slices of <ids>, each no longer than
+    IN_LIST_LIMIT so as to stay within the database's limit on bound
+    parameters, and yield every row the returned queries give.
+    """
+    ids = list(ids)
+    size = current_app.config.get('IN_LIST_LIMIT', 500)
+    for start in range(0, len(ids), size):
+        for row in fetch(ids[start:start + size]):
+            yield row
+
+
+def insert_unless_duplicate(table, values):
+    """
+    Insert a row with column <values> into <table>, unless it would clash with
+    the primary key or a unique column of a row that is already there, such
+    as one written by another request since this one looked. Returns whether
+    the row was inserted.
+    """
+    dialect = db.engine.dialect.name
+    statement = table.insert().values(**values)
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).values(**values).on_conflict_do_nothing()
+    elif dialect == 'sqlite':
+        statement = statement.prefix_with('OR IGNORE')
+    elif dialect == 'mysql':
+        statement = statement.prefix_with('IGNORE')
+    return db.session.execute(statement).rowcount == 1
+
+
+class Record(object):
+    """
+    A light, read-only copy of some columns of a database row, for read paths
+    that only copy values out (such as serialising a feed) and don't need
+    what it costs to load and track a whole model object. Subclasses name the
+    columns in __slots__, and are made with the values in that order.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+
+def select_rows(statement):
+    """
+    Run the Core select <statement> and return its rows. Python 2.7's sqlite3
+    leaves the cursor without a description when a "WITH RECURSIVE" select
+    finds no rows, which SQLAlchemy takes to mean the statement doesn't return
+    rows at all, so that case gives an empty list instead of an error.
+    """
+    result = db.session.execute(statement)
+    if not result.returns_rows:
+        return []
+    return result
+
+
+def records(record_type, statement):
+    """
+    Run the Core select <statement> and yield a <record_type> made from the
+    columns of each row, in order.
+    """
+    for row in select_rows(statement):
+        yield record_type(*row)
@@ -1,16 +1,93 @@
 from __future__ import absolute_import
 
+from flask import current_app
+from hashlib import sha256
+from mimetypes import guess_type
 try:
-    from urllib.request import urlopen
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
 except:
-    from urllib2 import urlopen
+    from urllib2 import HTTPError, Request, urlopen
 
-from pyaspora.content.models import MimePart
+from pyaspora.content.models import MimePart, RemotePart
 
 
-def import_url_as_mimepart(url):
-    resp = urlopen(url, timeout=30)
+def import_url_as_mimepart(url, previous=None):
+    """
+    Create a MimePart for the media at <url>. If remote media is fetched
+    lazily only the URL is recorded, and the body is downloaded (and the real
+    MIME type found) when the part is first viewed. Media larger than
+    REMOTE_MEDIA_MAX_SIZE is never stored; the part records the URL and is
+    marked as too large, so that viewers are sent to the remote node for it.
+
+    If <previous> is a MimePart fetched earlier for the same item (such as a
+    contact's current avatar) it is revalidated with a conditional request,
+    and returned in place of a new part if the body hasn't changed.
+    """
+    from pyaspora.content.proxy import lazy_fetch_enabled
+    source = previous.remote if previous else None
+    if source and source.url != url:
+        source = None
+
+    if lazy_fetch_enabled():
+        if source:
+            return previous
+        return _url_only_mimepart(url)
+
+    req = Request(url)
+    if source and source.etag:
+        req.add_header('If-None-Match', source.etag)
+    if source and source.last_modified:
+        req.add_header('If-Modified-Since', source.last_modified)
+    try:
+        resp = urlopen(req, timeout=30)
+    except HTTPError as e:
+        if source and e.code == 304:
+            return previous
+        raise
+
+    max_size = current_app.config.get('REMOTE_MEDIA_MAX_SIZE',
+                                      5 * 1024 * 1024)
+    body = resp.read(max_size + 1)
+    headers = resp.info()
+    if len(body) > max_size:
+        mp = _url_only_mimepart(url)
+        mp.type = headers.get('Content-Type') or mp.type
+        mp.remote.too_large = True
+        return mp
+    content_hash = sha256(body).hexdigest()
+    if previous and previous.body:
+        previous_hash = (previous.remote and previous.remote.content_hash) \
+            or sha256(previous.body).hexdigest()
+        if previous_hash == content_hash:
+            # Same picture, perhaps under a new URL
+            if not previous.remote:
+                previous.remote = RemotePart()
+            previous.remote.url = url
+            previous.remote.etag = headers.get('ETag')
+            previous.remote.last_modified = headers.get('Last-Modified')
+            previous.remote.content_hash = content_hash
+            return previous
+
+    mp = MimePart()
+    mp.type = headers.get('Content-Type')
+    mp.body = body
+    mp.remote = RemotePart(
+        url=url,
+        etag=headers.get('ETag'),
+        last_modified=headers.get('Last-Modified'),
+        content_hash=content_hash
+    )
+    return mp
+
+
+def _url_only_mimepart(url):
+    """
+    A MimePart that only records <url>, with a MIME type guessed from the URL
+    until the body is fetched.
+    """
     mp = MimePart()
-    mp.type = resp.info().get('Content-Type')
-    mp.body = resp.read()
+    mp.type = guess_type(url)[0] or 'application/octet-stream'
+    mp.body = b''
+    mp.remote = RemotePart(url=url)
     return mp
@@ -10,20 +10,24 @@ from flask import current_app, url_for
 from json import dumps
 from lxml import etree
 from re import compile as re_compile
+from uuid import uuid4
 try:
     from urllib.parse import urljoin
-    from urllib.request import urlopen
 except:
-    from urllib2 import urlopen
     from urlparse import urljoin
 
 from pyaspora import db
+from pyaspora.database import in_chunks
+from pyaspora.contact.models import Contact
 from pyaspora.content.models import MimePart
+from pyaspora.content.proxy import shown_inline
 from pyaspora.diaspora import import_url_as_mimepart
 from pyaspora.diaspora.models import DiasporaContact, DiasporaPart, \
-    DiasporaPost, TryLater
+    DiasporaPendingReshare, DiasporaPollVote, DiasporaPost, MessageQueue, \
+    TryLater
 from pyaspora.diaspora.protocol import DiasporaMessageBuilder
-from pyaspora.post.models import Post
+from pyaspora.post.models import Post, PostAudience, Share
+from pyaspora.roster.graph import SubscriptionGraph
 from pyaspora.roster.models import Subscription
 from pyaspora.tag.models import Tag
 from pyaspora.utils.rendering import ensure_timezone
@@ -191,6 +195,91 @@ class TagMixin:
         return Tag.parse_line(tl, create=True)
 
 
+class RelayableMixin:
+    """
+    Mix-in for messages (comments, votes) that the author of the parent Post
+    must pass on to everyone else who can see the parent.
+    """
+    public_relay = True
+
+    @classmethod
+    def forward(cls, u_from, posts, node):
+        """
+        Share the new Posts <posts> with everyone their parents are shared
+        with, and queue <node> to be relayed to the remote Contacts amongst
+        them. The audience is worked out once for all of <posts>, so a
+        message attached to several parents only goes to each recipient once.
+        """
+        if not posts:
+            return
+
+        audience = cls._audience(
+            [p.id for p in posts] + [p.parent_id for p in posts])
+        targets = []
+        for post in posts:
+            new_ids = audience.get(post.parent_id, set()) - \
+                audience.get(post.id, set())
+            if new_ids:
+                post.share_with(
+                    list(in_chunks(Contact.get_many, new_ids)),
+                    audience_list=True
+                )
+            targets.append((post.parent, new_ids))
+
+        cls.relay(u_from, targets, node)
+
+    @classmethod
+    def relay(cls, u_from, targets, node):
+        """
+        Queue <node> to be relayed on behalf of the authors of the parent
+        Posts in <targets>, a list of (parent, contact_ids) pairs, to the
+        remote Contacts amongst <contact_ids>. Public threads also go to
+        everyone following the thread.
+        """
+        parent_sig = [n for n in node if n.tag == 'parent_author_signature']
+        assert(not parent_sig)
+
+        relays = {}
+        followers = {}
+        for parent, contact_ids in targets:
+            root = parent.root()
+            public = cls.public_relay and root.is_public
+            if public:
+                # Public threads also go to everyone following the thread
+                if root.author_id not in followers:
+                    followers[root.author_id] = SubscriptionGraph.current(). \
+                        followers(root.author_id)
+                contact_ids = contact_ids | followers[root.author_id]
+
+            # Only the parent's author can relay, and we need their key
+            host = u_from or parent.author.user
+            if host:
+                relays.setdefault((host, public), set()).update(contact_ids)
+
+        payload = etree.tostring(node)
+        for (host, public), contact_ids in relays.items():
+            MessageQueue.queue_relay(host, payload, contact_ids, public)
+        db.session.commit()
+
+    @classmethod
+    def _audience(cls, post_ids):
+        """
+        The IDs of the Contacts each of the Posts with IDs <post_ids> is
+        shared with, as a dict of sets keyed by Post ID.
+        """
+        def shares(ids):
+            return db.session.query(Share.post_id, Share.contact_id). \
+                filter(Share.post_id.in_(ids))
+
+        audience = {}
+        for post_id, contact_id in in_chunks(shares, post_ids):
+            audience.setdefault(post_id, set()).add(contact_id)
+        members = in_chunks(PostAudience.members_for_posts, post_ids)
+        for post_id, contact_id, shared_at in members:
+            audience.setdefault(post_id, set()).add(contact_id)
+        return audience
+
+
 @diaspora_message_handler('/XML/post/request')
 class Subscribe(MessageHandlerBase):
     """
@@ -236,21 +325,30 @@ class Profile(TagMixin, MessageHandlerBase):
         c_from.realname = " ".join(
             data.get(k, '') or '' for k in ('first_name', 'last_name')
         )
-        c_from.bio = MimePart(
-            text_preview=data.get('bio', '(bio)'),
-            body=dumps(data).encode('utf-8'),
-            type='application/x-pyaspora-diaspora-profile'
-        )
+        bio = dumps(data).encode('utf-8')
+        if not c_from.bio or c_from.bio.body != bio:
+            c_from.bio = MimePart(
+                text_preview=data.get('bio', '(bio)'),
+                body=bio,
+                type='application/x-pyaspora-diaspora-profile'
+            )
+
+        old_avatar = c_from.avatar
         if 'image_url' in data:
             mp = import_url_as_mimepart(urljoin(
                 c_from.diasp.server,
                 data['image_url']
-            ))
+            ), previous=old_avatar)
             mp.text_preview = u'(picture for {0})'.format(c_from.realname)
             c_from.avatar = mp
         else:
             c_from.avatar = None
 
+        # Don't leave the replaced picture lying around in the database
+        if old_avatar and old_avatar is not c_from.avatar and \
+                old_avatar.remote and not old_avatar.posts:
+            db.session.delete(old_avatar)
+
         c_from.interests = cls.find_tags(data['tag_string'] or '')
 
         db.session.add(c_from)
@@ -361,6 +459,10 @@ class PostMessage(TagMixin, MessageHandlerBase):
         )
         db.session.commit()
 
+        # Complete any reshares of this post that arrived before it
+        DiasporaPendingReshare.resolve(data['guid'])
+        db.session.commit()
+
     @classmethod
     def generate(cls, u_from, c_to, post, text):
         diasp = DiasporaPost.get_for_post(post)
@@ -441,7 +543,8 @@ class PrivateMessage(SignableMixin, TagMixin, MessageHandlerBase):
         cls.struct_to_xml(req, [
             {'diaspora_handle': u_from.contact.diasp.username},
             {'participant_handles': ';'.join(
-                s.contact.diasp.username for s in post.shares
+                s.contact.diasp.username
+                for s in Share.all_for_posts([post.id], load_contacts=True)
                 if s.contact.diasp
             )}
         ])
@@ -465,7 +568,7 @@ class PostParticipation(SignableMixin, MessageHandlerBase):
         if not post:
             raise TryLater()
         post = post.post  # Underlying Post object
-        if post.is_public():
+        if post.is_public:
             return
 
         participant = DiasporaContact.get_by_username(
@@ -497,7 +600,7 @@ class PostParticipation(SignableMixin, MessageHandlerBase):
 
 
 @diaspora_message_handler('/XML/post/comment')
-class SubPost(SignableMixin, TagMixin, MessageHandlerBase):
+class SubPost(RelayableMixin, SignableMixin, TagMixin, MessageHandlerBase):
     """
     A comment on a top-level post. In Pyaspora these are posts in their own
     right, but the federation protocol treats these differently.
@@ -564,7 +667,7 @@ class SubPost(SignableMixin, TagMixin, MessageHandlerBase):
             # If the parent has signed this then it must have already been
             # via the hub.
             if 'parent_author_signature' not in data:
-                cls.forward(u_to, p, node)
+                cls.forward(u_to, [p], node)
 
     @classmethod
     def generate(cls, u_from, c_to, post, text):
@@ -585,36 +688,14 @@ class SubPost(SignableMixin, TagMixin, MessageHandlerBase):
                 cls.generate_signature(u_from, req)
         return req
 
-    @classmethod
-    def forward(cls, u_from, post, node):
-        parent_sig = [n for n in node if n.tag == 'parent_author_signature']
-        assert(not parent_sig)
-        if u_from:
-            etree.SubElement(node, "parent_author_signature").text = \
-                cls.generate_signature(u_from, node)
-
-        def _builder(u_from, c_to, n):
-            return n
-        already_shared = set([s.contact_id for s in post.shares])
-        targets = [s.contact for s in post.parent.shares
-                   if s.contact_id not in already_shared]
-        post.share_with(targets)
-        is_public = (post.root().is_public())
-        if is_public:
-            targets += list(post.author.followers())
-        targets = [c for c in targets if not c.user]
-        for target in targets:
-            if is_public:
-                cls.send_public(None, target, n=node, fn=_builder)
-            else:
-                cls.send(u_from, target, n=node, fn=_builder)
-
 
 @diaspora_message_handler('/XML/post/message')
-class SubPM(SignableMixin, TagMixin, MessageHandlerBase):
+class SubPM(RelayableMixin, SignableMixin, TagMixin, MessageHandlerBase):
     """
     A response to a private message thread.
     """
+    public_relay = False
+
     @classmethod
     def receive(cls, xml, c_from, u_to):
         data = cls.as_dict(xml)
@@ -649,7 +730,13 @@ class SubPM(SignableMixin, TagMixin, MessageHandlerBase):
             body=data['text'].encode('utf-8'),
         ), order=0, inline=True)
         p.tags = cls.find_tags(data['text'])
-        p.share_with([s.contact for s in p.root().shares])
+        p.share_with(
+            [
+                s.contact for s in
+                Share.all_for_posts([p.root().id], load_contacts=True)
+            ],
+            audience_list=True
+        )
         p.thread_modified()
         p.diasp = DiasporaPost(guid=data['guid'], type='private')
         db.session.add(p)
@@ -659,7 +746,7 @@ class SubPM(SignableMixin, TagMixin, MessageHandlerBase):
             # If the parent has signed this then it must have already been
             # via the hub.
             if 'parent_author_signature' not in data:
-                cls.forward(u_to, p, node)
+                cls.forward(u_to, [p], node)
 
     @classmethod
     def generate(cls, u_from, c_to, post, text):
@@ -682,34 +769,99 @@ class SubPM(SignableMixin, TagMixin, MessageHandlerBase):
                 cls.generate_signature(u_from, req)
         return req
 
-    @classmethod
-    def forward(cls, u_from, post, node):
-        parent_sig = [n for n in node if n.tag == 'parent_author_signature']
-        assert(not parent_sig)
-        if u_from:
-            etree.SubElement(node, "parent_author_signature").text = \
-                cls.generate_signature(u_from, node)
-
-        def _builder(u_from, c_to, n):
-            return n
-        already_shared = set([s.contact_id for s in post.shares])
-        targets = [s.contact for s in post.parent.shares
-                   if s.contact_id not in already_shared]
-        post.share_with(targets)
-        targets = [c for c in targets if not c.user]
-        for target in targets:
-            cls.send(u_from, target, n=node, fn=_builder)
-
 
 @diaspora_message_handler('/XML/post/like')
-class Like(MessageHandlerBase):
+class Like(RelayableMixin, SignableMixin, MessageHandlerBase):
     """
-    A post being "liked". Pyaspora doesn't do likes, this is ignored.
+    A post being "liked", or un-liked if "positive" is false. Likes are
+    recorded against the Post rather than becoming Posts themselves. Only
+    likes of top-level posts are exchanged with other nodes.
     """
     @classmethod
     def receive(cls, xml, c_from, u_to):
-        # Pyaspora does not support likes
-        pass
+        data = cls.as_dict(xml)
+        if data.get('target_type', 'Post') != 'Post':
+            return
+        author = DiasporaContact.get_by_username(
+            data['diaspora_handle'], True, False
+        )
+        assert(author)
+        author = author.contact
+        parent = DiasporaPost.get_by_guid(data['parent_guid'])
+        if not parent:
+            raise TryLater()
+        parent = parent.post
+
+        if u_to:
+            assert(parent.shared_with(c_from))
+        node = xml[0][0]
+        if 'parent_author_signature' in data:
+            assert(
+                cls.valid_signature(
+                    parent.author, data['parent_author_signature'], node
+                )
+            )
+            if not current_app.config.get('ALLOW_INSECURE_COMPAT', False):
+                assert(
+                    cls.valid_signature(author, data['author_signature'], node)
+                )
+        else:
+            assert(cls.valid_signature(author, data['author_signature'], node))
+
+        if data['positive'] == 'true':
+            changed = parent.like(author)
+        else:
+            changed = parent.unlike(author)
+        db.session.commit()
+
+        # If the parent has signed this then it must have already been via
+        # the hub.
+        if changed and 'parent_author_signature' not in data and \
+                (not(u_to) or parent.author_id == u_to.contact.id):
+            audience = cls._audience([parent.id]).get(parent.id, set())
+            cls.relay(u_to, [
+                (parent, audience - set([author.id, c_from.id]))
+            ], node)
+
+    @classmethod
+    def generate(cls, u_from, post, positive):
+        req = etree.Element('like')
+        cls.struct_to_xml(req, [
+            {'positive': 'true' if positive else 'false'},
+            {'guid': str(uuid4())},
+            {'target_type': 'Post'},
+            {'parent_guid': post.diasp.guid},
+            {'diaspora_handle':
+                DiasporaContact.get_for_contact(u_from.contact).username}
+        ])
+        etree.SubElement(req, 'author_signature').text = \
+            cls.generate_signature(u_from, req)
+        return req
+
+    @classmethod
+    def queue_outgoing(cls, u_from, post, positive):
+        """
+        Queue User <u_from>'s like (or un-like) of Post <post> to be sent to
+        other nodes with the other queued messages, so that it is delivered
+        once per node. The caller must commit the session.
+        """
+        if post.parent or not post.diasp:
+            return
+        node = cls.generate(u_from, post, positive)
+        if post.author.user:
+            # This node hosts the thread, so relay to everyone who can see it
+            audience = cls._audience([post.id]).get(post.id, set())
+            cls.relay(None, [(post, audience - set([u_from.contact.id]))],
+                      node)
+        elif post.author.diasp:
+            # The author's node relays it to everyone else
+            MessageQueue.queue_relay(
+                u_from,
+                etree.tostring(node),
+                [post.author_id],
+                post.is_public,
+                relay=False
+            )
 
 
 @diaspora_message_handler('/XML/post/relayable_retraction')
@@ -754,18 +906,9 @@ class Photo(MessageHandlerBase):
         photo_url = urljoin(
             data['remote_photo_path'], data['remote_photo_name']
         )
-        resp = urlopen(photo_url, timeout=10)
-        mime = resp.info().get('Content-Type')
-        part = MimePart(
-            type=mime,
-            body=resp.read(),
-            text_preview='(picture)'
-        )
-        parent.add_part(
-            part,
-            order=0,
-            inline=bool(mime.startswith('image/'))
-        )
+        part = import_url_as_mimepart(photo_url)
+        part.text_preview = '(picture)'
+        parent.add_part(part, order=0, inline=shown_inline(part.type))
         parent.thread_modified()
         db.session.add(parent)
         db.session.add(DiasporaPart(part=part, guid=data['guid']))
@@ -780,63 +923,34 @@ class Reshare(MessageHandlerBase):
     @classmethod
     def receive(cls, xml, c_from, u_to):
         data = cls.as_dict(xml)
-        shared = DiasporaPost.get_by_guid(data['root_guid'])
-        if not shared:
-            # Try to pull it from the Atom feed
-            author = DiasporaContact.get_by_username(
-                data['root_diaspora_id'], True, True
-            )
-            if not author:
-                raise TryLater()
-            author.import_public_posts()
-            shared = DiasporaPost.get_by_guid(data['root_guid'])
-
-        if not shared:
-            # Fall back to poking the origin server
-            post_url = urljoin(author.server, "/p/{0}.xml".format(
-                data['root_guid']
-            ))
-            resp = urlopen(post_url, timeout=10)
-            current_app.logger.debug(
-                'Injecting downloaded message into processing loop'
-            )
-            process_incoming_message(resp.read(), author.contact, None)
-            shared = DiasporaPost.get_by_guid(data['root_guid'])
-
-        if not shared:
-            # Failed
-            current_app.logger.warning(
-                'Could not find post being reshared (with GUID {0})'.format(
-                    data['root_guid']
-                )
-            )
-            raise TryLater()
-        shared = shared.post
+        if DiasporaPost.get_by_guid(data['guid']):
+            return
         created = datetime.strptime(data['created_at'], '%Y-%m-%d %H:%M:%S %Z')
         post = Post(author=c_from, created_at=created)
-        share_part = MimePart(
-            type='application/x-pyaspora-share',
-            body=dumps({
-                'post': {'id': shared.id},
-                'author': {
-                    'id': shared.author_id,
-                    'name': shared.author.realname,
-                }
-            }).encode('utf-8'),
-            text_preview=u"shared {0}'s post".format(shared.author.realname)
-        )
-        post.add_part(share_part, order=0, inline=True)
-        order = 0
-        for part in shared.parts:
-            if part.mime_part.type != 'application/x-pyaspora-share':
-                order += 1
-                post.add_part(part.mime_part, inline=part.inline, order=order)
-        if not post.tags:
-            post.tags = shared.tags
+
+        shared = DiasporaPost.get_by_guid(data['root_guid'])
+        if shared:
+            cls.attach_root(post, shared.post)
+        else:
+            # Store it now and fill in the content when the root arrives
+            post.add_part(MimePart(
+                type='application/x-pyaspora-share',
+                body=dumps({
+                    'post': {'guid': data['root_guid']},
+                    'author': {'username': data['root_diaspora_id']},
+                    'pending': True
+                }).encode('utf-8'),
+                text_preview=u'shared a post'
+            ), order=0, inline=True)
+            post.pending_reshare = DiasporaPendingReshare(
+                root_guid=data['root_guid'],
+                root_username=data['root_diaspora_id']
+            )
+
         if u_to:
             post.share_with([c_from])
             if u_to.contact.subscribed_to(c_from):
-                p.share_with([u_to.contact])
+                post.share_with([u_to.contact])
         else:
             post.share_with([c_from], show_on_wall=True)
         post.thread_modified()
@@ -848,6 +962,45 @@ class Reshare(MessageHandlerBase):
         db.session.add(post)
         db.session.commit()
 
+    @classmethod
+    def attach_root(cls, post, shared):
+        """
+        Fill in reshare Post <post> with the content of the Post <shared> that
+        it reshares, replacing any placeholder left when the reshare arrived
+        first.
+        """
+        share_body = dumps({
+            'post': {'id': shared.id},
+            'author': {
+                'id': shared.author_id,
+                'name': shared.author.realname,
+            }
+        }).encode('utf-8')
+        share_preview = u"shared {0}'s post".format(shared.author.realname)
+
+        share_part = [
+            p.mime_part for p in post.parts
+            if p.mime_part.type == 'application/x-pyaspora-share'
+        ]
+        if share_part:
+            share_part[0].body = share_body
+            share_part[0].text_preview = share_preview
+            db.session.add(share_part[0])
+        else:
+            post.add_part(MimePart(
+                type='application/x-pyaspora-share',
+                body=share_body,
+                text_preview=share_preview
+            ), order=0, inline=True)
+
+        order = 0
+        for part in shared.parts:
+            if part.mime_part.type != 'application/x-pyaspora-share':
+                order += 1
+                post.add_part(part.mime_part, inline=part.inline, order=order)
+        if not post.tags:
+            post.tags = shared.tags
+
     @classmethod
     def generate(cls, u_from, c_to, post, reshare):
         req = etree.Element('reshare')
@@ -866,14 +1019,14 @@ class Reshare(MessageHandlerBase):
 
 
 @diaspora_message_handler('/XML/post/poll_participation')
-class PollParticipation(MessageHandlerBase, SignableMixin):
+class PollParticipation(RelayableMixin, MessageHandlerBase, SignableMixin):
     """
     A vote in a poll
     """
     @classmethod
     def receive(cls, xml, c_from, u_to):
         data = cls.as_dict(xml)
-        if DiasporaPost.get_by_guid(data['guid']):
+        if DiasporaPollVote.get_by_guid(data['guid']):
             return
         author = DiasporaContact.get_by_username(
             data['diaspora_handle'], True, False
@@ -889,54 +1042,42 @@ class PollParticipation(MessageHandlerBase, SignableMixin):
 
         answer_part = DiasporaPart.get_by_guid(data['poll_answer_guid'])
         assert answer_part, 'Poll participation must have stored answer'
-
-        new_part = MimePart(
-            type='application/x-diaspora-poll-participation',
-            body=dumps({
-                'poll_guid': data['parent_guid'],
-                'answer_guid': data['poll_answer_guid'],
-                'answer_text': answer_part.part.body.decode('utf-8')
-            })
-        )
+        assert answer_part.part.type == 'application/x-diaspora-poll-answer' \
+            and [pp for pp in answer_part.part.posts if pp.post_id in posts], \
+            'Poll participation must choose an answer to its poll'
 
         node = xml[0][0]
         assert(cls.valid_signature(author, data['author_signature'], node))
 
-        saved = []
-        for parent in posts.values():
-            # FIXME: we should validate parent_author_signature against, err
-            # the right post.
-            if u_to and not parent.shared_with(c_from):
-                continue
-            p = Post(author=author, parent=parent)
-            saved.append(p)
-            p.add_part(new_part, order=0, inline=True)
-
-            if u_to:
-                p.share_with([p.author])
-                if parent.shared_with(u_to.contact):
-                    p.share_with([u_to.contact])
-            else:
-                p.share_with([p.author], show_on_wall=True)
-            if p.author.id != c_from.id:
-                p.share_with([c_from])
-
-            p.thread_modified()
-
-            p.diasp = DiasporaPost(
-                guid=data['guid'],
-                type='limited' if u_to else 'public'
-            )
-            db.session.add(p)
+        # FIXME: we should validate parent_author_signature against, err
+        # the right post.
+        parents = [
+            parent for parent in posts.values()
+            if not(u_to) or parent.shared_with(c_from)
+        ]
+        if not parents or DiasporaPollVote.has_voted(poll_part.part, author):
+            return
 
+        db.session.add(DiasporaPollVote(
+            guid=data['guid'],
+            poll_part_id=poll_part.part_id,
+            answer_part_id=answer_part.part_id,
+            voter_id=author.id
+        ))
+        for parent in parents:
+            parent.thread_modified()
         db.session.commit()
 
-        for p in saved:
-            if not(u_to) or (p.parent.author_id == u_to.contact.id):
-                # If the parent has signed this then it must have already been
-                # via the hub.
-                if 'parent_author_signature' not in data:
-                    cls.forward(u_to, p, node)
+        # If the parent has signed this then it must have already been via
+        # the hub.
+        if 'parent_author_signature' not in data:
+            audience = cls._audience([parent.id for parent in parents])
+            cls.relay(u_to, [
+                (parent, audience.get(parent.id, set()) -
+                 set([author.id, c_from.id]))
+                for parent in parents
+                if not(u_to) or (parent.author_id == u_to.contact.id)
+            ], node)
 
 
 @diaspora_message_handler('/XML/post/account_deletion')
@@ -960,7 +1101,9 @@ class AccountDeletion(MessageHandlerBase):
             type="text/plain"
         )
         db.session.add(participant)
-        db.session.query(Subscription).filter(
+        subs = db.session.query(Subscription).filter(
             Subscription.to_contact == participant.contact
-        ).delete()
+        )
+        for sub in subs:
+            db.session.delete(sub)
         db.session.commit()
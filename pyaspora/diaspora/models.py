@@ -1,12 +1,13 @@
 from __future__ import absolute_import
 
 from base64 import b64decode
+from Crypto.PublicKey import RSA
 from datetime import datetime, timedelta
 from flask import current_app, request, url_for
 from json import load as json_load
-from lxml import html
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, LargeBinary, \
-    String
+from lxml import etree, html
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, \
+    LargeBinary, String, UniqueConstraint
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.sql import and_, or_
 from sqlalchemy.sql.expression import func
@@ -21,13 +22,15 @@ except:
     from urlparse import urljoin, urlsplit, urlunsplit
 
 from pyaspora import db
+from pyaspora.database import in_chunks
 from pyaspora.contact.models import Contact
 from pyaspora.content.models import MimePart
+from pyaspora.content.rendering import render
 from pyaspora.diaspora import import_url_as_mimepart
-from pyaspora.diaspora.protocol import DiasporaMessageParser, USER_AGENT, \
-    WebfingerRequest
-from pyaspora.post.models import Post
-from pyaspora.post.views import json_post
+from pyaspora.diaspora.protocol import DiasporaMessageBuilder, \
+    DiasporaMessageParser, USER_AGENT, WebfingerRequest, post_envelope
+from pyaspora.post.models import Post, PostPart
+from pyaspora.tag.models import PostTag
 
 
 class TryLater(Exception):
@@ -70,6 +73,18 @@ class DiasporaContact(db.Model):
     def get_by_guid(cls, guid):
         return db.session.query(cls).filter(cls.guid == guid).first()
 
+    @classmethod
+    def allocate_missing(cls):
+        """
+        Give a Diaspora identity to any local User's Contact that pre-dates
+        these being created with the User. The caller must commit the session.
+        """
+        from pyaspora.user.models import User
+        contacts = db.session.query(Contact).join(User). \
+            outerjoin(cls).filter(cls.contact_id == None)
+        for contact in contacts:
+            cls.get_for_contact(contact, commit=False)
+
     @classmethod
     def get_by_username(cls, addr, import_contact=True, commit=True):
         dcontact = db.session.query(DiasporaContact).filter(
@@ -237,17 +252,24 @@ class MessageQueue(db.Model):
     """
     Messages that have been received but that cannot be actioned until the
     User's public key has been unlocked (at which point they will be deleted).
+    Relayed messages and likes waiting to be sent on to other nodes are also
+    held here, as they need to be signed with the sending User's key.
 
     Fields:
         id - an integer identifier uniquely identifying the message in the
              queue
         local_id - the User receiving/sending the message
-        remote_id - the Contact the message is to/from
+        remote_id - the Contact the message is to/from. For public outgoing
+                    messages this is any Contact on the destination node.
         format - the protocol format of the payload
         body - the message payload, in a protocol-specific format
     """
     INCOMING = 'application/x-diaspora-slap'
     PUBLIC_INCOMING = 'application/x-diaspora-public-slap'
+    OUTGOING = 'application/x-pyaspora-relay'
+    PUBLIC_OUTGOING = 'application/x-pyaspora-public-relay'
+    SEND = 'application/x-pyaspora-send'
+    PUBLIC_SEND = 'application/x-pyaspora-public-send'
 
     __tablename__ = 'message_queue'
     id = Column(Integer, primary_key=True)
@@ -260,8 +282,15 @@ class MessageQueue(db.Model):
     last_attempted_at = Column(DateTime(timezone=True),
                                nullable=True)
     error = Column(LargeBinary, nullable=True)
+    __table_args__ = (
+        # For the Queries below, which fetch the oldest pending items first
+        Index('ix_message_queue_user_format_created',
+              local_id, format, created_at),
+        Index('ix_message_queue_format_created', format, created_at),
+    )
 
     local_user = relationship('User', backref='message_queue')
+    remote = relationship('Contact')
 
     class Queries:
         @classmethod
@@ -276,6 +305,23 @@ class MessageQueue(db.Model):
                 )
             )
 
+        @classmethod
+        def pending_outgoing_for_user(cls, user):
+            return and_(
+                MessageQueue.format.in_([
+                    MessageQueue.OUTGOING,
+                    MessageQueue.PUBLIC_OUTGOING,
+                    MessageQueue.SEND,
+                    MessageQueue.PUBLIC_SEND
+                ]),
+                MessageQueue.local_user == user,
+                or_(
+                    MessageQueue.last_attempted_at == None,
+                    MessageQueue.last_attempted_at <=
+                    datetime.now() - timedelta(minutes=5)
+                )
+            )
+
         @classmethod
         def pending_public_items(cls):
             return and_(
@@ -339,6 +385,135 @@ class MessageQueue(db.Model):
         ).order_by(cls.created_at)
         cls.process_queue(queue_items, user, max_items)
 
+    @classmethod
+    def has_pending_outgoing(cls, user):
+        return bool(db.session.query(cls.id).filter(
+            cls.Queries.pending_outgoing_for_user(user)
+        ).first())
+
+    @classmethod
+    def queue_relay(cls, user, payload, contact_ids, public, relay=True):
+        """
+        Queue the relayable XML <payload> to be passed on by <user> to the
+        remote Contacts with IDs <contact_ids>. Public messages are only
+        queued once per destination node. If <relay> is False the payload is
+        <user>'s own message, and is sent as-is rather than countersigned as
+        the parent's author. The caller must commit the session.
+        """
+        if relay:
+            formats = (cls.OUTGOING, cls.PUBLIC_OUTGOING)
+        else:
+            formats = (cls.SEND, cls.PUBLIC_SEND)
+        if not contact_ids:
+            return
+
+        def remotes(ids):
+            return db.session.query(DiasporaContact). \
+                join(Contact). \
+                filter(DiasporaContact.contact_id.in_(ids)). \
+                filter(~Contact.user.has()). \
+                order_by(DiasporaContact.server)
+        seen_servers = set()
+        for remote in in_chunks(remotes, contact_ids):
+            if public:
+                if remote.server in seen_servers:
+                    continue
+                seen_servers.add(remote.server)
+            db.session.add(cls(
+                local_user=user,
+                remote_id=remote.contact_id,
+                format=formats[1] if public else formats[0],
+                body=payload
+            ))
+
+    @classmethod
+    def process_outgoing_queue(cls, user, max_items=None):
+        """
+        Send on up to <max_items> of the oldest messages <user> is relaying,
+        grouped by destination node, and return how many were dealt with.
+        Each distinct payload is signed and encrypted once and the envelopes
+        shared between recipients. An item that can't be built is marked with
+        its error without holding up the rest, and a node that fails is
+        skipped until the next attempt. Each delivery is committed as it is
+        made, so a failure doesn't undo the deliveries before it.
+        """
+        queue_items = db.session.query(cls).filter(
+            cls.Queries.pending_outgoing_for_user(user)
+        ).order_by(cls.created_at)
+        if max_items:
+            queue_items = queue_items.limit(max_items)
+        queue_items = queue_items.all()
+
+        by_server = {}
+        for qi in queue_items:
+            if qi.too_old_for_retry or not qi.remote or not qi.remote.diasp:
+                db.session.delete(qi)
+                continue
+            by_server.setdefault(qi.remote.diasp.server, []).append(qi)
+            # Record the attempt first so other requests leave it alone
+            qi.last_attempted_at = datetime.now()
+            db.session.add(qi)
+        username = DiasporaContact.get_for_contact(
+            user.contact, commit=False).username
+        db.session.commit()
+
+        builders = {}
+        public_envelopes = {}
+        for server, server_items in by_server.items():
+            for qi in server_items:
+                public = qi.format in (cls.PUBLIC_OUTGOING, cls.PUBLIC_SEND)
+                try:
+                    if qi.body not in builders:
+                        builders[qi.body] = qi._build_outgoing(user, username)
+                    builder = builders[qi.body]
+                    if public and qi.body not in public_envelopes:
+                        public_envelopes[qi.body] = \
+                            builder.create_salmon_envelope(None)
+                except Exception:
+                    err = format_exc()
+                    current_app.logger.error(err)
+                    qi.error = err.encode('utf-8')
+                    db.session.add(qi)
+                    db.session.commit()
+                    continue
+
+                try:
+                    if public:
+                        post_envelope(
+                            '{0}receive/public'.format(server),
+                            public_envelopes[qi.body]
+                        )
+                    else:
+                        builder.post(
+                            '{0}receive/users/{1}'.format(
+                                server, qi.remote.diasp.guid),
+                            RSA.importKey(qi.remote.public_key)
+                        )
+                except Exception:
+                    # Leave the node's remaining items for the next attempt
+                    current_app.logger.warning(format_exc())
+                    break
+                else:
+                    db.session.delete(qi)
+                    db.session.commit()
+
+        return len(queue_items)
+
+    def _build_outgoing(self, user, username):
+        """
+        Prepare the message builder for an outgoing payload from <user>, whose
+        Diaspora handle is <username>, adding the parent author's signature on
+        behalf of <user> if it is being relayed.
+        """
+        from pyaspora.diaspora.actions import SignableMixin
+        node = etree.fromstring(self.body)
+        relay = self.format in (self.OUTGOING, self.PUBLIC_OUTGOING)
+        if relay and \
+                not [n for n in node if n.tag == 'parent_author_signature']:
+            etree.SubElement(node, 'parent_author_signature').text = \
+                SignableMixin.generate_signature(user, node)
+        return DiasporaMessageBuilder(node, username, user._unlocked_key)
+
     def process_incoming(self, user=None):
         from pyaspora.diaspora.actions import process_incoming_message
 
@@ -384,18 +559,60 @@ class DiasporaPost(db.Model):
     def get_by_guid(cls, guid):
         return db.session.query(cls).filter(cls.guid == guid).first()
 
+    @classmethod
+    def allocate_missing(cls):
+        """
+        Give a GUID to any locally-authored Post that pre-dates these being
+        created with the Post. The caller must commit the session.
+        """
+        from pyaspora.user.models import User
+        posts = db.session.query(Post).join(Contact).join(User). \
+            outerjoin(cls).filter(cls.post_id == None)
+        for post in posts:
+            cls.get_for_post(post, commit=False)
+
+    @classmethod
+    def texts_for_posts(cls, posts):
+        """
+        The plain-text form of each of <posts> as sent to other nodes, in a
+        dict keyed by Post ID. Parts and tags are fetched in bulk, and only
+        the text/plain rendering of each part is produced.
+        """
+        post_ids = [p.id for p in posts]
+        if not post_ids:
+            return {}
+        bodies = dict((post_id, []) for post_id in post_ids)
+        tags = dict((post_id, []) for post_id in post_ids)
+        post_parts = in_chunks(
+            lambda ids: PostPart.get_parts_for_posts(ids).order_by(
+                PostPart.order),
+            post_ids
+        )
+        for post_part in post_parts:
+            url = url_for('content.raw', part_id=post_part.mime_part_id,
+                          _external=True)
+            bodies[post_part.post_id].append(
+                render(post_part, 'text/plain', url))
+        for post_tag in in_chunks(PostTag.get_tags_for_posts, post_ids):
+            tags[post_tag.post_id].append(post_tag.tag.name)
+
+        texts = {}
+        for post_id in post_ids:
+            text = "\n\n".join(bodies[post_id])
+            if tags[post_id]:
+                text += '\n( ' + ' '.join(
+                    '#{0}'.format(t) for t in tags[post_id]
+                ) + ' )'
+            texts[post_id] = text
+        return texts
+
     def as_text(self):
-        json = json_post(self.post, children=False)
-        text = "\n\n".join([p['body']['text'] for p in json['parts']])
-        if self.post.tags:
-            text += '\n( ' + ' '.join(
-                '#{0}'.format(t.name) for t in self.post.tags
-            ) + ' )'
-        return text
+        return self.texts_for_posts([self.post])[self.post.id]
 
     def send_to(self, targets, private=False):
         from pyaspora.diaspora.actions import PostMessage, PrivateMessage, \
             SubPost, SubPM
+        from pyaspora.roster.graph import SubscriptionGraph
 
         post = self.post
 
@@ -451,7 +668,7 @@ class DiasporaPost(db.Model):
                 )
         else:
             # Can only send to followers
-            followers = set([c.id for c in post.author.followers()])
+            followers = SubscriptionGraph.current().followers(post.author_id)
             targets = [t for t in targets if t.id in followers]
             for target in targets:
                 sender.send(post.author.user, target, post=post, text=text)
@@ -495,3 +712,226 @@ class DiasporaPart(db.Model):
     @classmethod
     def get_by_guid(cls, guid):
         return db.session.query(cls).filter(cls.guid == guid).first()
+
+
+class DiasporaPollVote(db.Model):
+    """
+    A vote in a poll attached to a Diaspora post. Votes are tallied against
+    the answer they chose rather than being stored as Posts in the poll's
+    thread, so a popular poll doesn't bury the thread.
+
+    Fields:
+        guid - the Diaspora GUID of the poll participation
+        poll_part_id - the MimePart holding the poll question
+        answer_part_id - the MimePart holding the chosen answer
+        voter_id - the Contact that voted
+        voted_at - when the vote was received
+    """
+    __tablename__ = 'diaspora_poll_votes'
+    guid = Column(String, primary_key=True)
+    poll_part_id = Column(Integer, ForeignKey('mime_parts.id'),
+                          nullable=False)
+    answer_part_id = Column(Integer, ForeignKey('mime_parts.id'),
+                            nullable=False, index=True)
+    voter_id = Column(Integer, ForeignKey('contacts.id'), nullable=False)
+    voted_at = Column(DateTime(timezone=True),
+                      nullable=False, default=func.now())
+    __table_args__ = (
+        UniqueConstraint(poll_part_id, voter_id),
+    )
+
+    @classmethod
+    def get_by_guid(cls, guid):
+        return db.session.query(cls).filter(cls.guid == guid).first()
+
+    @classmethod
+    def has_voted(cls, poll_part, voter):
+        """
+        Whether Contact <voter> has already voted in the poll whose question
+        is MimePart <poll_part>.
+        """
+        return db.session.query(cls).filter(and_(
+            cls.poll_part_id == poll_part.id,
+            cls.voter_id == voter.id
+        )).first() is not None
+
+    @classmethod
+    def tally_parts(cls, parts):
+        """
+        Set "votes" on each poll question and answer among the PartRecords
+        <parts>, counting the votes for all of them with one query.
+        """
+        questions = [
+            part.mime_part.id for part in parts
+            if part.mime_part.type == 'application/x-diaspora-poll-question'
+        ]
+        if not questions:
+            return
+        tallies = {}
+        rows = in_chunks(
+            lambda ids: db.session.query(
+                cls.poll_part_id, cls.answer_part_id, func.count(cls.guid)
+            ).filter(cls.poll_part_id.in_(ids)).
+            group_by(cls.poll_part_id, cls.answer_part_id),
+            questions
+        )
+        for poll_part_id, answer_part_id, votes in rows:
+            tallies[poll_part_id] = tallies.get(poll_part_id, 0) + votes
+            tallies[answer_part_id] = votes
+        for part in parts:
+            if part.mime_part.type in (
+                'application/x-diaspora-poll-question',
+                'application/x-diaspora-poll-answer'
+            ):
+                part.votes = tallies.get(part.mime_part.id, 0)
+
+    @classmethod
+    def count_for_poll(cls, poll_part_id):
+        """
+        The number of votes cast in the poll whose question is the MimePart
+        with ID <poll_part_id>.
+        """
+        return db.session.query(func.count(cls.guid)). \
+            filter(cls.poll_part_id == poll_part_id).scalar()
+
+    @classmethod
+    def count_for_answer(cls, answer_part_id):
+        """
+        The number of votes for the answer that is the MimePart with ID
+        <answer_part_id>.
+        """
+        return db.session.query(func.count(cls.guid)). \
+            filter(cls.answer_part_id == answer_part_id).scalar()
+
+
+class DiasporaPendingReshare(db.Model):
+    """
+    A reshare that arrived before the post it reshares. The reshare is stored
+    straight away with a placeholder and is completed when the root post
+    turns up, either by normal delivery or by a later fetch from the origin
+    node. Fetches only happen when the public queue is run (see
+    run_public_queue), never while a message is being received, so that a
+    slow origin node cannot hold up delivery to this node.
+
+    Fields:
+        post_id - the local Post that represents the reshare
+        root_guid - the Diaspora GUID of the post being reshared
+        root_username - the Diaspora handle of the root post's author
+        created_at - when the reshare was received
+        last_attempted_at - when the root post was last fetched, if ever
+    """
+    __tablename__ = 'diaspora_pending_reshares'
+    post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True)
+    root_guid = Column(String, nullable=False, index=True)
+    root_username = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True),
+                        nullable=False, default=func.now())
+    last_attempted_at = Column(DateTime(timezone=True), nullable=True)
+
+    post = relationship('Post', single_parent=True,
+                        backref=backref('pending_reshare', uselist=False))
+
+    class Queries:
+        @classmethod
+        def due_for_fetch(cls):
+            return or_(
+                DiasporaPendingReshare.last_attempted_at == None,
+                DiasporaPendingReshare.last_attempted_at <=
+                datetime.now() - timedelta(minutes=5)
+            )
+
+    @classmethod
+    def resolve(cls, root_guid):
+        """
+        The post with GUID <root_guid> has arrived, so complete any reshares
+        that were waiting for it. The caller must commit the session.
+        """
+        from pyaspora.diaspora.actions import Reshare
+        root = DiasporaPost.get_by_guid(root_guid)
+        if not root:
+            return
+        pending = db.session.query(cls).filter(cls.root_guid == root_guid)
+        for item in pending:
+            Reshare.attach_root(item.post, root.post)
+            db.session.add(item.post)
+            db.session.delete(item)
+
+    @classmethod
+    def process_fetch_queue(cls, max_items=None):
+        """
+        Try to fetch the root posts for pending reshares from their origin
+        nodes. A node that fails is skipped for the rest of this run, so
+        one unresponsive node only costs a single timeout.
+        """
+        queue_items = db.session.query(cls).filter(
+            cls.Queries.due_for_fetch()
+        ).order_by(cls.created_at)
+        failed_hosts = set()
+        processed = 0
+        for item in queue_items.all():
+            if max_items and processed >= max_items:
+                return
+            host = item.root_username.split('@')[-1]
+            if host in failed_hosts:
+                continue
+
+            processed += 1
+            if item.too_old_for_retry:
+                current_app.logger.warning(
+                    'Giving up on post being reshared (with GUID {0})'.format(
+                        item.root_guid
+                    )
+                )
+                db.session.delete(item)
+                db.session.commit()
+                continue
+
+            # Record the attempt first so other requests leave it alone
+            item.last_attempted_at = datetime.now()
+            root_guid = item.root_guid
+            db.session.add(item)
+            db.session.commit()
+
+            try:
+                item.fetch()
+                db.session.commit()
+            except Exception:
+                current_app.logger.debug(format_exc())
+                db.session.rollback()
+                failed_hosts.add(host)
+                continue
+
+            cls.resolve(root_guid)
+            db.session.commit()
+
+    def fetch(self):
+        """
+        Pull the root post from its author's node, first from their public
+        feed and then by asking the origin server for the post directly.
+        """
+        from pyaspora.diaspora.actions import process_incoming_message
+        if DiasporaPost.get_by_guid(self.root_guid):
+            return
+
+        author = DiasporaContact.get_by_username(self.root_username)
+        if not author:
+            raise TryLater()
+
+        author.import_public_posts()
+        if DiasporaPost.get_by_guid(self.root_guid):
+            return
+
+        post_url = urljoin(author.server, "/p/{0}.xml".format(self.root_guid))
+        req = Request(post_url)
+        req.add_header('User-Agent', USER_AGENT)
+        resp = urlopen(req, timeout=10)
+        current_app.logger.debug(
+            'Injecting downloaded message into processing loop'
+        )
+        process_incoming_message(resp.read(), author.contact, None)
+
+    @property
+    def too_old_for_retry(self):
+        if not self.last_attempted_at:
+            return False
+        return self.last_attempted_at > self.created_at + timedelta(hours=24)
@@ -63,6 +63,8 @@ class DiasporaMessageBuilder:
         self.message = message
         self.author_username = author_username
         self.private_key = private_key
+        self.ciphertext = None
+        self.encrypted_payload = None
 
     def xml_to_string(self, doc, xml_declaration=False):
         """
@@ -99,14 +101,16 @@ class DiasporaMessageBuilder:
 
     def create_ciphertext(self):
         """
-        Encrypt the header.
+        Encrypt the header. The result is kept, as the encrypter is stateful
+        and the same ciphertext must go to every recipient.
         """
-        to_encrypt = self.pkcs7_pad(
-            self.create_decrypted_header(),
-            AES.block_size
-        )
-        out = self.outer_encrypter.encrypt(to_encrypt)
-        return out
+        if self.ciphertext is None:
+            to_encrypt = self.pkcs7_pad(
+                self.create_decrypted_header(),
+                AES.block_size
+            )
+            self.ciphertext = self.outer_encrypter.encrypt(to_encrypt)
+        return self.ciphertext
 
     def create_outer_aes_key_bundle(self):
         """
@@ -166,10 +170,13 @@ class DiasporaMessageBuilder:
 
     def create_encrypted_payload(self):
         """
-        Encrypt the payload XML with the inner (body) key.
+        Encrypt the payload XML with the inner (body) key. As with the header,
+        this is only done once per message.
         """
-        to_encrypt = self.pkcs7_pad(self.create_payload(), AES.block_size)
-        return self.inner_encrypter.encrypt(to_encrypt)
+        if self.encrypted_payload is None:
+            to_encrypt = self.pkcs7_pad(self.create_payload(), AES.block_size)
+            self.encrypted_payload = self.inner_encrypter.encrypt(to_encrypt)
+        return self.encrypted_payload
 
     def create_salmon_envelope(self, recipient_public_key):
         """
@@ -232,14 +239,22 @@ class DiasporaMessageBuilder:
         """
         Actually send the message to an HTTP/HTTPs endpoint.
         """
-        xml = url_quote(
-            self.create_salmon_envelope(recipient_public_key))
-        data = urlencode({
-            'xml': xml
-        })
-        req = Request(url)
-        req.add_header('User-Agent', USER_AGENT)
-        return urlopen(req, data.encode("ascii"), timeout=60)
+        return post_envelope(
+            url,
+            self.create_salmon_envelope(recipient_public_key)
+        )
+
+
+def post_envelope(url, envelope):
+    """
+    Send an already-built Salmon envelope to an HTTP/HTTPs endpoint.
+    """
+    data = urlencode({
+        'xml': url_quote(envelope)
+    })
+    req = Request(url)
+    req.add_header('User-Agent', USER_AGENT)
+    return urlopen(req, data.encode("ascii"), timeout=60)
 
 
 class DiasporaMessageParser:
@@ -0,0 +1,10 @@
+{#
+Sends on a user's queued outgoing items. The feed loads this out of sight.
+#}
+{%- extends "layout.tpl" %}
+
+{% block content %}
+<h2>Sending Outgoing Items</h2>
+
+<p><span class="processing-count">{{count}}</span> items processed so far.</p>
+{% endblock %}
@@ -13,7 +13,8 @@ from flask import abort, Blueprint, current_app, jsonify, make_response, \
     request, url_for
 from json import dumps
 from lxml import etree
-from sqlalchemy.sql import desc
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import and_, desc
 from traceback import format_exc
 try:
     from urllib.parse import urlsplit
@@ -23,17 +24,24 @@ except:
 from pyaspora import db
 from pyaspora.contact.models import Contact
 from pyaspora.diaspora.actions import process_incoming_message
-from pyaspora.diaspora.models import DiasporaContact, DiasporaPost, \
-    MessageQueue, TryLater
+from pyaspora.diaspora.models import DiasporaContact, \
+    DiasporaPendingReshare, DiasporaPost, MessageQueue, TryLater
 from pyaspora.diaspora.protocol import DiasporaMessageParser
 from pyaspora.post.models import Post, Share
 from pyaspora.user.models import User
 from pyaspora.user.session import require_logged_in_user
+from pyaspora.utils.cache import cached_response
 from pyaspora.utils.rendering import add_logged_in_user_to_data, \
     redirect, render_response, send_xml
 
 blueprint = Blueprint('diaspora', __name__, template_folder='templates')
 
+# Number of posts in each page of a User's public JSON feed
+PUBLIC_FEED_PAGE_SIZE = 25
+
+# Number of outgoing messages sent on between checks of the time allowed
+OUTGOING_BATCH_SIZE = 10
+
 
 @blueprint.route('/.well-known/host-meta', methods=['GET'])
 def host_meta():
@@ -41,6 +49,10 @@ def host_meta():
     Return a WebFinder host-meta, which points the client to the end-point
     for webfinger querying.
     """
+    return cached_response(('host-meta',), _build_host_meta)
+
+
+def _build_host_meta():
     ns = 'http://docs.oasis-open.org/ns/xri/xrd-1.0'
     doc = etree.Element("{%s}XRD" % ns, nsmap={None: ns})
     etree.SubElement(
@@ -53,7 +65,7 @@ def host_meta():
         ) + '{uri}',
         type='application/xrd+xml'
     )
-    return send_xml(doc)
+    return send_xml(doc), ()
 
 
 @blueprint.route('/diaspora/webfinger/<string:contact_addr>', methods=['GET'])
@@ -62,11 +74,18 @@ def webfinger(contact_addr):
     Returns the Webfinger profile for a contact called <contact> (in
     "user@host" form).
     """
+    return cached_response(
+        ('webfinger', contact_addr),
+        lambda: _build_webfinger(contact_addr)
+    )
+
+
+def _build_webfinger(contact_addr):
     contact_id, _ = contact_addr.split('@')
     c = Contact.get(int(contact_id))
-    if not c or not c.user or not c.user.activated:
+    if not c or not c.user or not c.user.activated or not c.diasp:
         abort(404, 'No such contact')
-    diasp = DiasporaContact.get_for_contact(c)
+    diasp = c.diasp  # Allocated when the User is created
 
     ns = 'http://docs.oasis-open.org/ns/xri/xrd-1.0'
     doc = etree.Element("{%s}XRD" % ns, nsmap={None: ns})
@@ -110,7 +129,7 @@ def webfinger(contact_addr):
         href=b64encode(c.public_key.encode('ascii'))
     )
 
-    return send_xml(doc)
+    return send_xml(doc), [c.cache_tag('profile')]
 
 
 @blueprint.route('/diaspora/hcard/<string:guid>', methods=['GET'])
@@ -120,6 +139,10 @@ def hcard(guid):
     preferred to use the primary key, but the protocol insists on
     fetch-by-GUID.
     """
+    return cached_response(('hcard', guid), lambda: _build_hcard(guid))
+
+
+def _build_hcard(guid):
     diasp = DiasporaContact.get_by_guid(guid)
     if diasp is None or not diasp.contact.user:
         abort(404, 'No such contact')
@@ -194,7 +217,8 @@ def hcard(guid):
     dd = etree.SubElement(dl, 'dd')
     etree.SubElement(dd, 'a', **{'class': "searchable"}).text = 'true'
 
-    return send_xml(doc, content_type='text/html')
+    return send_xml(doc, content_type='text/html'), \
+        [c.cache_tag('profile')]
 
 
 @blueprint.route('/receive/users/<string:guid>/', methods=['POST'])
@@ -265,20 +289,45 @@ def receive_public():
 def json_feed(guid):
     """
     Look up the User identified by GUID and return the User's public feed
-    as Diaspora-style JSON.
+    as Diaspora-style JSON. The feed is returned a page at a time, most
+    recently active first; pass the Unix time <max_time> to fetch the items
+    active before that time.
     """
+    max_time = request.args.get('max_time', None)
+    if max_time is not None:
+        try:
+            max_time = datetime.utcfromtimestamp(int(max_time))
+        except (ValueError, OverflowError):
+            abort(400, 'Invalid max_time')
+
+    return cached_response(
+        ('people', guid, max_time),
+        lambda: _build_json_feed(guid, max_time)
+    )
+
+
+def _build_json_feed(guid, max_time):
     contact = DiasporaContact.get_by_guid(guid)
     if not(contact and contact.contact.user):
         abort(404, 'No such contact')
 
     feed_query = Post.Queries.public_wall_for_contact(contact.contact)
+    if max_time is not None:
+        feed_query = and_(
+            feed_query,
+            Post.thread_modified_at < max_time
+        )
     feed = db.session.query(Post).join(Share).filter(feed_query). \
+        options(joinedload(Post.diasp)). \
         order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id).limit(99)
+        group_by(Post.id).limit(PUBLIC_FEED_PAGE_SIZE).all()
+
+    # Not yet given a GUID by /setup
+    feed = [post for post in feed if post.diasp]
+    texts = DiasporaPost.texts_for_posts(feed)
 
     ret = []
     for post in feed:
-        text = DiasporaPost.get_for_post(post, commit=False).as_text()
         rep = {
             "author": {
                 "diaspora_id": contact.username,
@@ -286,16 +335,21 @@ def json_feed(guid):
                 "guid": contact.guid,
             },
             "created_at": post.created_at.isoformat(),
-            "text": text,
+            "text": texts[post.id],
             "public": True,
             "post_type": "StatusMessage",
             "guid": post.diasp.guid,
-            "interacted_at": post.root().thread_modified_at.isoformat(),
+            # Only top-level posts appear on the wall
+            "interacted_at": post.thread_modified_at.isoformat(),
             "provider_display_name": None,
         }
         ret.append(rep)
 
-    return jsonify(ret)
+    resp = make_response(dumps(ret))
+    resp.headers['Content-Type'] = 'application/json'
+    tags = [contact.contact.cache_tag('feed')] + \
+        [Post.cache_tag(post.id) for post in feed]
+    return resp, tags
 
 
 @blueprint.route('/diaspora/run_queue', methods=['GET'])
@@ -326,6 +380,36 @@ def run_queue(_user):
         return redirect(url_for('feed.view'))
 
 
+@blueprint.route('/diaspora/run_outgoing_queue', methods=['GET'])
+@require_logged_in_user
+def run_outgoing_queue(_user):
+    """
+    Send on the messages the logged-in User is relaying or sending, a batch
+    at a time for up to ten seconds. The feed loads this in the background
+    whilst any are waiting, and it refreshes itself until they have all been
+    attempted, so no page waits on other nodes.
+    """
+    start = datetime.now()
+    sent = int(request.args.get('sent', 0))
+    while datetime.now() < start + timedelta(seconds=10):
+        count = MessageQueue.process_outgoing_queue(
+            _user, max_items=OUTGOING_BATCH_SIZE)
+        if not count:
+            break
+        sent += count
+
+    data = {'count': sent}
+    if MessageQueue.has_pending_outgoing(_user):
+        data['next'] = url_for('.run_outgoing_queue', sent=sent,
+                               _external=True)
+    add_logged_in_user_to_data(data, _user)
+
+    resp = make_response(render_response('diaspora_outgoing_queue.tpl', data))
+    if 'next' in data:
+        resp.headers['Refresh'] = '1;{0}'.format(data['next'])
+    return resp
+
+
 @blueprint.route('/diaspora/run_public_queue', methods=['GET'])
 @require_logged_in_user
 def run_public_queue(_user):
@@ -333,6 +417,7 @@ def run_public_queue(_user):
         MessageQueue.Queries.pending_public_items()
     ).order_by(MessageQueue.created_at)
     MessageQueue.process_queue(queue_items, None)
+    DiasporaPendingReshare.process_fetch_queue()
     return redirect(url_for('feed.view'))
 
 
@@ -0,0 +1,259 @@
+"""
+Materialised feeds for local Users. With the "timelines" feature enabled, a
+top-level Post is written to the timeline of every local User who should see
+it when it is shared or its thread is bumped, and the feed is read back from
+the User's own entries rather than being worked out on every view.
+"""
+from __future__ import absolute_import
+
+from flask import current_app
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, event
+from sqlalchemy.orm import Session, joinedload, relationship
+from sqlalchemy.sql import and_, desc, not_, or_, select, union
+
+from pyaspora.database import db, in_chunks
+from pyaspora.post.models import AudienceMember, Post, PostAudience, Share
+from pyaspora.roster.graph import SubscriptionGraph
+from pyaspora.roster.models import Subscription
+from pyaspora.tag.models import Interest, PostTag
+from pyaspora.utils.pagination import older_than
+
+
+class TimelineEntry(db.Model):
+    """
+    A top-level Post in a local User's feed.
+
+    Fields:
+        user_id - the User whose feed this is
+        post - the Post shown in the feed
+        post_id - the database primary key of the above
+        thread_modified_at - a copy of the Post's thread_modified_at, which
+                             the feed is sorted by
+    """
+    __tablename__ = 'timeline_entries'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    post_id = Column(Integer, ForeignKey('posts.id'),
+                     primary_key=True, index=True)
+    thread_modified_at = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (
+        Index('ix_timeline_entries_user_modified',
+              user_id, thread_modified_at, post_id),
+    )
+
+    post = relationship(Post)
+
+    @classmethod
+    def enabled(cls):
+        return current_app.config.get('FEATURES', {}).get('timelines', False)
+
+    @classmethod
+    def computed_feed(cls, user, cursor=None, since=None, limit=None):
+        """
+        Work out <user>'s feed from scratch: everything shared with them,
+        public posts by Contacts they are subscribed to and public posts
+        tagged with their interests, newest thread first. Returns a query for
+        the top-level Posts.
+
+        Only Posts after the pagination cursor <cursor> are included if it is
+        given, and only those bumped or shared since the DateTime <since> if
+        that is given. If <limit> is given, no more than that many Posts are
+        returned.
+        """
+        # Each way into the feed is a separate query that starts from the
+        # User's own rows (their Shares, AudienceLists, subscriptions and
+        # interests), so it can use an index and stop after <limit> rows
+        # rather than testing every Share on the node; the UNION then merges
+        # the branches.
+        hidden_by_me = Post.Queries.hidden_by_contact(user.contact)
+        posts = db.session.query(Post.id, Post.thread_modified_at)
+        shared_with_me = posts.join(Share, Share.post_id == Post.id). \
+            filter(Post.Queries.shared_with_contact(user.contact)). \
+            filter(not_(Share.hidden))
+        on_list = PostAudience.audience_id == AudienceMember.audience_id
+        listed_for_me = posts.select_from(AudienceMember). \
+            join(PostAudience, on_list). \
+            join(Post, Post.id == PostAudience.post_id). \
+            filter(AudienceMember.contact_id == user.contact.id). \
+            filter(not_(hidden_by_me))
+        by_friends = posts.select_from(Subscription). \
+            join(Share, Share.contact_id == Subscription.to_id). \
+            join(Post, Post.id == Share.post_id). \
+            filter(Subscription.from_id == user.contact.id). \
+            filter(and_(Share.public, not_(Share.hidden))). \
+            filter(not_(hidden_by_me))
+        tagged = posts.select_from(Interest). \
+            join(PostTag, PostTag.tag_id == Interest.tag_id). \
+            join(Post, Post.id == PostTag.post_id). \
+            join(Share, Share.post_id == Post.id). \
+            filter(Interest.contact_id == user.contact.id). \
+            filter(and_(Share.public, not_(Share.hidden))). \
+            filter(not_(hidden_by_me))
+
+        ordering = (desc(Post.thread_modified_at), desc(Post.id))
+        selects = []
+        branches = (
+            (shared_with_me, Share.shared_at),
+            (listed_for_me, PostAudience.shared_at),
+            (by_friends, Share.shared_at),
+            (tagged, Share.shared_at)
+        )
+        for branch, shared_at in branches:
+            branch = branch.filter(Post.parent_id == None)
+            if cursor:
+                branch = branch.filter(Post.Queries.older_than(cursor))
+            if since is not None:
+                branch = branch.filter(or_(
+                    Post.thread_modified_at > since,
+                    shared_at > since
+                ))
+            branch = branch.distinct().order_by(*ordering).limit(limit)
+            # SQLite only allows LIMIT in a UNION inside a subquery
+            branch = branch.subquery()
+            selects.append(select([branch.c.id]))
+        feed = union(*selects).alias('feed')
+
+        return db.session.query(Post). \
+            join(feed, feed.c.id == Post.id). \
+            order_by(*ordering). \
+            limit(limit). \
+            options(joinedload(Post.diasp))
+
+    @classmethod
+    def page_for_user(cls, user, cursor=None):
+        """
+        A query for the entries in <user>'s timeline, newest first, starting
+        after the pagination cursor <cursor> if given.
+        """
+        query = db.session.query(cls). \
+            filter(cls.user_id == user.id). \
+            order_by(desc(cls.thread_modified_at), desc(cls.post_id)). \
+            options(joinedload(cls.post).joinedload(Post.diasp))
+        if cursor:
+            anchor = db.session.query(cls.thread_modified_at).filter(and_(
+                cls.user_id == user.id,
+                cls.post_id == cursor[1]
+            ))
+            query = query.filter(older_than(
+                cursor, cls.thread_modified_at, cls.post_id, anchor))
+        return query
+
+    @classmethod
+    def post_updated(cls, post):
+        """
+        Note that <post>'s thread has been shared further or bumped, so that
+        the timelines are brought up to date when the session is committed.
+        """
+        if cls.enabled():
+            db.session().info.setdefault('timeline_posts', set()). \
+                add(post.root())
+
+    @classmethod
+    def hide(cls, user, post):
+        """
+        Remove <post> from <user>'s timeline. The caller must commit the
+        session.
+        """
+        db.session.query(cls).filter(and_(
+            cls.user_id == user.id,
+            cls.post_id == post.id
+        )).delete(synchronize_session=False)
+
+    @classmethod
+    def fan_out(cls, post):
+        """
+        Bring the timelines up to date for the top-level Post <post>, adding
+        it for any local User who should now see it and moving it to the top
+        of the feeds that already have it. The caller must commit the session.
+        """
+        from pyaspora.user.models import User
+
+        shares = db.session.query(
+            Share.contact_id, Share.public, Share.hidden
+        ).filter(Share.post_id == post.id).all()
+        hidden = set(c for c, public, hid in shares if hid)
+        walls = set(c for c, public, hid in shares if public and not hid)
+        contact_ids = set(c for c, public, hid in shares if not hid)
+        contact_ids.update(
+            m.contact_id for m in PostAudience.members_for_posts([post.id]))
+        if walls:
+            # Public posts also reach subscribers and those interested
+            contact_ids.update(SubscriptionGraph.current().followers_of(walls))
+            interested = db.session.query(Interest.contact_id). \
+                join(PostTag, PostTag.tag_id == Interest.tag_id). \
+                filter(PostTag.post_id == post.id)
+            contact_ids.update(i.contact_id for i in interested)
+        contact_ids -= hidden
+
+        def users(ids):
+            return db.session.query(User.id).filter(User.contact_id.in_(ids))
+        user_ids = set(u.id for u in in_chunks(users, contact_ids))
+
+        existing = db.session.query(cls.user_id).filter(cls.post_id == post.id)
+        new_ids = user_ids - set(e.user_id for e in existing)
+
+        db.session.query(cls).filter(cls.post_id == post.id).update(
+            {'thread_modified_at': post.thread_modified_at},
+            synchronize_session=False
+        )
+        for user_id in new_ids:
+            db.session.add(cls(
+                user_id=user_id,
+                post_id=post.id,
+                thread_modified_at=post.thread_modified_at
+            ))
+        if new_ids:
+            db.session.flush()
+            for user_id in new_ids:
+                cls._trim(user_id)
+
+    @classmethod
+    def rebuild(cls, user):
+        """
+        Replace <user>'s timeline with the newest items in their computed
+        feed. The caller must commit the session.
+        """
+        limit = current_app.config.get('TIMELINE_LENGTH', 1000)
+        db.session.query(cls).filter(cls.user_id == user.id). \
+            delete(synchronize_session=False)
+        for post in cls.computed_feed(user, limit=limit):
+            db.session.add(cls(
+                user_id=user.id,
+                post_id=post.id,
+                thread_modified_at=post.thread_modified_at
+            ))
+
+    @classmethod
+    def rebuild_all(cls):
+        """
+        Rebuild the timeline of every local User. The caller must commit the
+        session.
+        """
+        from pyaspora.user.models import User
+        for user in db.session.query(User):
+            cls.rebuild(user)
+
+    @classmethod
+    def _trim(cls, user_id):
+        """
+        Drop the oldest entries from the timeline of User <user_id> once it
+        holds more than TIMELINE_LENGTH.
+        """
+        limit = current_app.config.get('TIMELINE_LENGTH', 1000)
+        cutoff = db.session.query(cls.thread_modified_at). \
+            filter(cls.user_id == user_id). \
+            order_by(desc(cls.thread_modified_at)). \
+            offset(limit).limit(1).scalar()
+        if cutoff is not None:
+            db.session.query(cls).filter(and_(
+                cls.user_id == user_id,
+                cls.thread_modified_at <= cutoff
+            )).delete(synchronize_session=False)
+
+
+@event.listens_for(Session, 'before_commit')
+def _fan_out_committed(session):
+    posts = session.info.pop('timeline_posts', None)
+    if posts:
+        session.flush()
+        for post in posts:
+            TimelineEntry.fan_out(post)
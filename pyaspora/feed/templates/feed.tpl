@@ -20,4 +20,8 @@ Display the user's "feed".
     on topics that interest you.</p>
 {% endif %}
 
+{% if actions.send_queued %}
+    <iframe src="{{actions.send_queued}}" style="display: none"></iframe>
+{% endif %}
+
 {% endblock %}
@@ -1,19 +1,26 @@
 from __future__ import absolute_import
 
-from flask import Blueprint, request, url_for
-from sqlalchemy.sql import and_, desc, not_, or_
-from sqlalchemy.orm import aliased, contains_eager, joinedload
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import timedelta
+from dateutil.parser import parse as parse_datetime
+from flask import Blueprint, jsonify, request, url_for
+from sqlalchemy.sql import and_, func
 
 from pyaspora.database import db
+from pyaspora.feed.models import TimelineEntry
 from pyaspora.post.models import Post, Share
-from pyaspora.post.views import json_posts
-from pyaspora.tag.models import PostTag, Tag
+from pyaspora.post.views import json_posts, json_share
 from pyaspora.user.session import require_logged_in_user
-from pyaspora.utils.rendering import add_logged_in_user_to_data, \
+from pyaspora.utils.pagination import more_link, page_size, paginate, \
+    request_cursor
+from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
     redirect, render_response
 
 blueprint = Blueprint('feed', __name__, template_folder='templates')
 
+# How far before the client's token to look for changes
+SYNC_OVERLAP = timedelta(seconds=5)
+
 
 @blueprint.route('/', methods=['GET'])
 @require_logged_in_user
@@ -25,44 +32,154 @@ def view(_user):
     if MessageQueue.has_pending_items(_user):
         return redirect(url_for('diaspora.run_queue', _external=True))
 
-    limit = int(request.args.get('limit', 10))
-    friend_ids = [f.id for f in _user.contact.friends()]
-    clauses = [Post.Queries.shared_with_contact(_user.contact)]
-    if friend_ids:
-        clauses.append(
-            Post.Queries.authored_by_contacts_and_public(friend_ids))
-    tag_ids = [t.id for t in _user.contact.interests]
-    if tag_ids:
-        clauses.append(Tag.Queries.public_posts_for_tags(tag_ids))
-    feed_query = or_(*clauses)
-    my_share = aliased(Share)
-    feed = db.session.query(Share).join(Post). \
-        outerjoin(  # Stuff user hasn't hidden
-            my_share,
-            and_(
-                Post.id == my_share.post_id,
-                my_share.contact == _user.contact
-            )
-        ). \
-        outerjoin(PostTag).outerjoin(Tag). \
-        filter(feed_query). \
-        filter(or_(my_share.hidden == None, not_(my_share.hidden))). \
-        filter(Post.parent == None). \
-        order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id). \
-        options(contains_eager(Share.post)). \
-        options(joinedload(Share.post, Post.diasp)). \
-        limit(limit)
+    size = page_size()
+    cursor = request_cursor()
+    if TimelineEntry.enabled():
+        entries, next_cursor = paginate(
+            TimelineEntry.page_for_user(_user, cursor),
+            size,
+            lambda e: (e.thread_modified_at, e.post_id)
+        )
+        feed = Share.pair_with_posts(
+            [e.post for e in entries], _user.contact)
+    else:
+        posts, next_cursor = paginate(
+            TimelineEntry.computed_feed(_user, cursor, limit=size + 1),
+            size,
+            lambda p: (p.thread_modified_at, p.id)
+        )
+        feed = Share.pair_with_posts(posts, _user.contact)
 
     data = {
-        'feed': json_posts([(s.post, s) for s in feed], _user, True),
-        'limit': limit,
-    }
-    if len(data['feed']) >= limit:
-        data['actions'] = {
-            'more': url_for('feed.view', limit=limit + 10, _external=True)
+        'feed': json_posts(feed, _user.contact, True),
+        'next': next_cursor,
+        'actions': {
+            'more': more_link('feed.view', next_cursor)
         }
+    }
+
+    # Messages to other nodes are sent on in the background
+    if MessageQueue.has_pending_outgoing(_user):
+        data['actions']['send_queued'] = url_for(
+            'diaspora.run_outgoing_queue', _external=True)
 
     add_logged_in_user_to_data(data, _user)
 
     return render_response('feed.tpl', data)
+
+
+@blueprint.route('/sync', methods=['GET'])
+@require_logged_in_user
+def sync(_user):
+    """
+    The changes to the logged-in user's feed since the point given by the
+    "since" token from an earlier call, so that clients can stay current
+    without fetching the whole feed again. Returns top-level Posts that are
+    new or have been bumped (without their children), new child Posts in
+    those threads, new Shares of the threads and the IDs of Posts the user
+    has hidden, along with a token for the next call.
+
+    If no token is given, or too much has changed, "reset" is set and the
+    newest page of the feed is returned in full instead.
+    """
+    now = db.session.query(func.now()).scalar()
+    since = _read_sync_token()
+    size = page_size()
+    data = {
+        'token': _sync_token(now),
+        'reset': since is None,
+        'posts': [],
+        'children': [],
+        'shares': [],
+        'hidden': [],
+    }
+
+    if since is not None:
+        # Look back a little, as times are stored to the second on some
+        # databases and a transaction may commit after stamping its rows
+        since -= SYNC_OVERLAP
+        changed = TimelineEntry.computed_feed(
+            _user, since=since, limit=size + 1).all()
+        data['reset'] = len(changed) > size
+
+    if data['reset']:
+        feed = TimelineEntry.computed_feed(_user, limit=size).all()
+        data['posts'] = json_posts(
+            Share.pair_with_posts(feed, _user.contact), _user.contact, True)
+        return jsonify(data)
+
+    root_ids = [p.id for p in changed]
+    data['posts'] = json_posts(
+        Share.pair_with_posts(changed, _user.contact),
+        _user.contact,
+        True,
+        children=False
+    )
+
+    children = _new_children(root_ids, _user, since)
+    data['children'] = json_posts(
+        children, _user.contact, True, children=False)
+    for (post, share), item in zip(children, data['children']):
+        item['parent'] = post.parent_id
+
+    if root_ids:
+        shares = Share.all_for_posts(root_ids, load_contacts=True)
+        for share in shares:
+            if share.shared_at <= since:
+                continue
+            item = json_share(share)
+            item['post'] = share.post_id
+            data['shares'].append(item)
+
+    hidden = db.session.query(Share.post_id).filter(and_(
+        Share.contact_id == _user.contact.id,
+        Share.hidden,
+        Share.hidden_at > since
+    ))
+    data['hidden'] = [h.post_id for h in hidden]
+
+    return jsonify(data)
+
+
+def _sync_token(when):
+    return urlsafe_b64encode(when.isoformat().encode('ascii')). \
+        decode('ascii')
+
+
+def _read_sync_token():
+    token = request.args.get('since', None)
+    if not token:
+        return None
+    try:
+        return parse_datetime(
+            urlsafe_b64decode(token.encode('ascii')).decode('ascii'))
+    except (TypeError, ValueError):
+        abort(400, 'Invalid token')
+
+
+def _new_children(root_ids, user, since):
+    """
+    (post, share) pairs for the child Posts in the threads <root_ids> that
+    <user> can see and that were created after <since>.
+    """
+    if not root_ids:
+        return []
+    threads = []
+    shares = {}
+    for post, share in Post.threads_for_posts(root_ids, user.contact):
+        if post.id not in shares:
+            threads.append(post)
+            shares[post.id] = share
+    viewable = Post.viewable_ids(shares.keys(), user.contact)
+
+    # New replies may be under old ones, so the whole thread is checked
+    found = []
+    placed = set(root_ids)
+    for post in threads:
+        if post.id not in viewable or post.parent_id not in placed:
+            continue
+        placed.add(post.id)
+        if post.created_at > since:
+            found.append((post, shares[post.id]))
+    return found
+
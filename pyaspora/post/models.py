@@ -1,13 +1,22 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer
-from sqlalchemy.orm import backref, contains_eager, relationship
-from sqlalchemy.sql import and_, not_
-from sqlalchemy.sql.expression import func
+from hashlib import sha256
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Index, \
+    Integer, String, event
+from sqlalchemy.orm import Session, aliased, backref, contains_eager, \
+    joinedload, relationship
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql import and_, case, desc, not_, or_, select
+from sqlalchemy.sql.expression import false, func, literal
 
-from pyaspora.content.models import MimePart
+from pyaspora.content.models import MimePart, MimePartRecord
 from pyaspora.contact.models import Contact
-from pyaspora.database import db
+from pyaspora.database import Record, db, in_chunks, \
+    insert_unless_duplicate, records, select_rows
+from pyaspora.utils.cache import invalidate_on_commit
+from pyaspora.utils.memo import request_memo
+from pyaspora.utils.pagination import older_than
 
 
 class Share(db.Model):
@@ -24,15 +33,24 @@ class Share(db.Model):
         hidden - whether the author has hidden the post from their feed
         shared_at - the DateTime the Post was shared with the Contact (that
                     is, the Share creation date)
+        hidden_at - the DateTime the Post was hidden, if it has been
     """
     __tablename__ = 'shares'
     contact_id = Column(Integer, ForeignKey('contacts.id'), primary_key=True)
-    post_id = Column(Integer, ForeignKey('posts.id'),
-                     primary_key=True, index=True)
+    post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True)
     public = Column(Boolean, nullable=False)
     hidden = Column(Boolean, nullable=False, default=False)
     shared_at = Column(DateTime(timezone=True),
                        nullable=False, default=func.now())
+    hidden_at = Column(DateTime(timezone=True), nullable=True)
+    __table_args__ = (
+        # Public (or not hidden) Shares of a Post, for the tag feed, threads
+        # and the "tagged" branch of the feed
+        Index('ix_shares_post_public_hidden', post_id, public, hidden),
+        # A Contact's visible Shares (the "by friends" branch of the feed and
+        # public walls) and those hidden since a sync
+        Index('ix_shares_contact_hidden_public', contact_id, hidden, public),
+    )
 
     contact = relationship(Contact, backref="feed", order_by='Share.shared_at')
 
@@ -40,6 +58,152 @@ class Share(db.Model):
     def get_for_posts(cls, post_ids):
         return db.session.query(cls).filter(cls.post_id.in_(post_ids))
 
+    @classmethod
+    def all_for_posts(cls, post_ids, load_contacts=False):
+        """
+        All the Shares of the Posts with IDs <post_ids>, including one (not
+        saved) for each Contact who can see a Post through an AudienceList
+        but has no Share of their own. If <load_contacts> is True the
+        Contacts are loaded too.
+        """
+        query = cls.get_for_posts(post_ids)
+        if load_contacts:
+            query = query.options(joinedload(cls.contact))
+        shares = query.all()
+        listed = cls._listed_without_share(post_ids, shares)
+        contacts = {}
+        if load_contacts and listed:
+            contacts = dict((c.id, c) for c in in_chunks(
+                Contact.get_many, set(c for p, c, a in listed)))
+        for post_id, contact_id, shared_at in listed:
+            shares.append(cls.through_audience(
+                post_id, contact_id, shared_at, contacts.get(contact_id)))
+        shares.sort(key=lambda s: s.post_id)
+        return shares
+
+    @classmethod
+    def records_for_posts(cls, post_ids):
+        """
+        As all_for_posts(), but as ShareRecords read without loading any
+        model objects.
+        """
+        if not post_ids:
+            return []
+        shares = list(records(ShareRecord, select([
+            cls.post_id, cls.contact_id, cls.shared_at, cls.public
+        ]).where(cls.post_id.in_(post_ids))))
+        for listed in cls._listed_without_share(post_ids, shares):
+            shares.append(ShareRecord(*(listed + (False,))))
+        shares.sort(key=lambda s: s.post_id)
+        return shares
+
+    @classmethod
+    def _listed_without_share(cls, post_ids, shares):
+        """
+        Sorted (post ID, contact ID, shared at) tuples for each Contact who
+        can see one of the Posts with IDs <post_ids> through an AudienceList,
+        but has no Share among <shares>.
+        """
+        have = set((s.post_id, s.contact_id) for s in shares)
+        listed = {}
+        for member in PostAudience.members_for_posts(post_ids):
+            key = (member.post_id, member.contact_id)
+            if key not in have and (key not in listed or
+                                    member.shared_at < listed[key]):
+                listed[key] = member.shared_at
+        return [
+            (post_id, contact_id, shared_at)
+            for (post_id, contact_id), shared_at in sorted(listed.items())
+        ]
+
+    @classmethod
+    def pair_with_posts(cls, posts, contact):
+        """
+        Pair each of <posts> with the Share through which Contact <contact>
+        sees it: their own Share if they have one (or are on an AudienceList
+        the Post is shared with), otherwise a public one.
+        """
+        post_ids = [p.id for p in posts]
+        shares = {}
+        if post_ids:
+            for share in cls.get_for_posts(post_ids).filter(cls.public):
+                shares[share.post_id] = share
+            listed = PostAudience.members_for_posts(post_ids, contact). \
+                order_by(desc(PostAudience.shared_at))
+            for member in listed:
+                shares[member.post_id] = cls.through_audience(
+                    member.post_id, contact.id, member.shared_at, contact)
+            mine = cls.get_for_posts(post_ids).filter(
+                cls.contact_id == contact.id)
+            for share in mine:
+                shares[share.post_id] = share
+        return [(post, shares.get(post.id)) for post in posts]
+
+    @classmethod
+    def through_audience(cls, post_id, contact_id, shared_at, contact=None):
+        """
+        A Share, not saved, standing for the Post with ID <post_id> being
+        shared with the Contact with ID <contact_id> (<contact>, if given)
+        through an AudienceList at DateTime <shared_at>. Adding it to the
+        session gives the Contact a Share of their own, for example to hide
+        the Post.
+        """
+        share = cls(
+            contact_id=contact_id,
+            post_id=post_id,
+            public=False,
+            hidden=False,
+            shared_at=shared_at
+        )
+        if contact is not None:
+            # Not through the backref, which would add the Share to the
+            # session
+            set_committed_value(share, 'contact', contact)
+        return share
+
+
+class ShareRecord(Record):
+    """
+    The columns of a Share that json_share() and json_post() use.
+    """
+    __slots__ = ('post_id', 'contact_id', 'shared_at', 'public')
+
+
+class PostLike(db.Model):
+    """
+    A Contact "liking" a Post. Likes are not Posts in their own right; the
+    number of likes is also kept on the Post so displaying it is free.
+
+    Fields:
+        post - the Post that was liked
+        post_id - the database primary key of the above
+        contact - the Contact that liked the Post
+        contact_id - the database primary key of the above
+        liked_at - the DateTime the Post was liked
+    """
+    __tablename__ = 'post_likes'
+    post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True)
+    contact_id = Column(Integer, ForeignKey('contacts.id'),
+                        primary_key=True, index=True)
+    liked_at = Column(DateTime(timezone=True),
+                      nullable=False, default=func.now())
+
+    contact = relationship(Contact)
+
+    @classmethod
+    def liked_by(cls, post_ids, contact):
+        """
+        The IDs of those Posts with IDs <post_ids> that Contact <contact>
+        likes.
+        """
+        if not post_ids:
+            return set()
+        likes = db.session.query(cls.post_id).filter(and_(
+            cls.post_id.in_(post_ids),
+            cls.contact_id == contact.id
+        ))
+        return set(like.post_id for like in likes)
+
 
 class PostPart(db.Model):
     """
@@ -80,6 +244,191 @@ class PostPart(db.Model):
             filter(cls.post_id.in_(post_ids)). \
             options(contains_eager(cls.mime_part))
 
+    @classmethod
+    def records_for_posts(cls, post_ids):
+        """
+        PartRecords for all the PostParts of the Posts with IDs <post_ids>, in
+        order, read without loading any model objects. Only inline parts are
+        displayed from their bodies, so the bodies of attachments are left
+        out.
+        """
+        if not post_ids:
+            return []
+        rows = db.session.execute(
+            select([
+                cls.post_id, cls.inline, MimePart.id, MimePart.type,
+                case([(cls.inline, MimePart.body)]), MimePart.text_preview
+            ]).
+            select_from(cls.__table__.join(MimePart.__table__)).
+            where(cls.post_id.in_(post_ids)).
+            order_by(cls.order)
+        )
+        return (
+            PartRecord(row[0], row[1], MimePartRecord(*row[2:]))
+            for row in rows
+        )
+
+
+class PartRecord(Record):
+    """
+    The columns of a PostPart that json_part() uses, with a MimePartRecord as
+    its mime_part. Poll questions and answers also get the number of votes
+    they have as "votes" if these were counted in bulk.
+    """
+    __slots__ = ('post_id', 'inline', 'mime_part', 'votes')
+
+
+class AudienceList(db.Model):
+    """
+    A frozen list of Contacts that a Post can be shared with in one go, such
+    as the members of a SubscriptionGroup or all of a User's friends at the
+    time of posting. Lists never change once made, and every Post shared
+    with the same Contacts uses the same list, so sharing with a large
+    audience doesn't write a Share for each of them.
+
+    Fields:
+        id - an integer identifier uniquely identifying this list in the node
+        digest - a hash of the member Contact IDs, for finding an existing
+                 list with the same members
+    """
+    __tablename__ = 'audience_lists'
+    id = Column(Integer, primary_key=True)
+    digest = Column(String, nullable=False)
+    __table_args__ = (
+        # One list per set of members, even when posts race to create it
+        Index('ix_audience_lists_digest_unique', digest, unique=True),
+    )
+
+    @classmethod
+    def for_contacts(cls, contact_ids):
+        """
+        The AudienceList whose members are the Contacts with IDs
+        <contact_ids>, creating it if there isn't one already. If another
+        request creates the same list first, that list is used instead. The
+        caller must commit the session.
+        """
+        contact_ids = sorted(set(contact_ids))
+        digest = sha256(
+            ','.join(str(c) for c in contact_ids).encode('ascii')
+        ).hexdigest()
+        lookup = db.session.query(cls).filter(cls.digest == digest)
+        audience = lookup.first()
+        if audience:
+            return audience
+        if not insert_unless_duplicate(cls.__table__, {'digest': digest}):
+            return lookup.one()  # Made by another request since we looked
+        audience = lookup.one()
+        db.session.bulk_insert_mappings(AudienceMember, [
+            {'audience_id': audience.id, 'contact_id': c}
+            for c in contact_ids
+        ])
+        return audience
+
+    @classmethod
+    def merge_duplicates(cls):
+        """
+        Fold AudienceLists that have the same members into the oldest of
+        them. Older databases can have these from posts that were made at the
+        same time, before each set of members was limited to one list. The
+        caller must commit the session.
+        """
+        keep = dict(
+            db.session.query(cls.digest, func.min(cls.id)).
+            group_by(cls.digest).
+            having(func.count(cls.id) > 1)
+        )
+        if not keep:
+            return
+        duplicates = db.session.query(cls.id, cls.digest). \
+            filter(cls.digest.in_(list(keep))). \
+            filter(~cls.id.in_(list(keep.values())))
+        for duplicate_id, digest in duplicates.all():
+            # A Post shared with both lists only needs to keep one
+            kept = aliased(PostAudience)
+            on_both = [
+                row.post_id for row in
+                db.session.query(PostAudience.post_id).join(kept, and_(
+                    kept.post_id == PostAudience.post_id,
+                    kept.audience_id == keep[digest]
+                )).filter(PostAudience.audience_id == duplicate_id)
+            ]
+            if on_both:
+                db.session.query(PostAudience).filter(and_(
+                    PostAudience.audience_id == duplicate_id,
+                    PostAudience.post_id.in_(on_both)
+                )).delete(synchronize_session=False)
+            db.session.query(PostAudience). \
+                filter(PostAudience.audience_id == duplicate_id). \
+                update({'audience_id': keep[digest]},
+                       synchronize_session=False)
+            db.session.query(AudienceMember). \
+                filter(AudienceMember.audience_id == duplicate_id). \
+                delete(synchronize_session=False)
+            db.session.query(cls).filter(cls.id == duplicate_id). \
+                delete(synchronize_session=False)
+
+
+class AudienceMember(db.Model):
+    """
+    A Contact on an AudienceList.
+
+    Fields:
+        audience_id - the database primary key of the AudienceList
+        contact_id - the database primary key of the Contact
+    """
+    __tablename__ = 'audience_members'
+    audience_id = Column(Integer, ForeignKey('audience_lists.id'),
+                         primary_key=True)
+    contact_id = Column(Integer, ForeignKey('contacts.id'),
+                        primary_key=True, index=True)
+
+
+class PostAudience(db.Model):
+    """
+    A Post being shared with every Contact on an AudienceList. A Contact's
+    own Share of the Post, for example one marking it hidden, takes
+    precedence.
+
+    Fields:
+        post_id - the database primary key of the Post
+        audience_id - the database primary key of the AudienceList
+        shared_at - the DateTime the Post was shared with the list
+    """
+    __tablename__ = 'post_audiences'
+    post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True)
+    audience_id = Column(Integer, ForeignKey('audience_lists.id'),
+                         primary_key=True, index=True)
+    shared_at = Column(DateTime(timezone=True),
+                       nullable=False, default=func.now())
+
+    @classmethod
+    def members_for_posts(cls, post_ids, contact=None):
+        """
+        A query for (post_id, contact_id, shared_at) for each Contact on the
+        AudienceLists that the Posts with IDs <post_ids> are shared with, or
+        only for Contact <contact> if given. A Contact appears once for each
+        list they are on.
+        """
+        query = db.session.query(
+            cls.post_id,
+            AudienceMember.contact_id,
+            cls.shared_at
+        ).join(
+            AudienceMember,
+            AudienceMember.audience_id == cls.audience_id
+        ).filter(cls.post_id.in_(post_ids))
+        if contact:
+            query = query.filter(AudienceMember.contact_id == contact.id)
+        return query
+
+
+class PostRecord(Record):
+    """
+    The columns of a Post that json_post() uses.
+    """
+    __slots__ = ('id', 'parent_id', 'author_id', 'created_at', 'like_count',
+                 'reply_count')
+
 
 class Post(db.Model):
     """
@@ -93,11 +442,18 @@ class Post(db.Model):
         parent - if this Post is a comment on another Post, this links to the
                  parent Post. May be None.
         parent_id - the database primary key for the above
+        root_post - if this Post is a comment, the top-level Post of the
+                    thread it is in. May be None.
+        root_id - the database primary key for the above
         thread_modified_at - last modification of the post or children, only
                              set on posts with no parent (top-level items)
-        shares - Shares of this Post (occurrences in feeds/on walls)
+        shares - Shares of this Post (occurrences in feeds/on walls), not
+                 including those through AudienceLists
         parts - PostParts that this Post consists of (the Post contents)
         children - Posts that have this post as the parent
+        like_count - the number of Contacts that like this Post
+        reply_count - the number of Posts that have this Post as the parent
+        is_public - whether anybody has shared this Post publicly
     """
     __tablename__ = 'posts'
     id = Column(Integer, primary_key=True)
@@ -105,14 +461,23 @@ class Post(db.Model):
                        nullable=False, index=True)
     parent_id = Column(Integer, ForeignKey('posts.id'), nullable=True,
                        default=None, index=True)
+    root_id = Column(Integer, ForeignKey('posts.id'), nullable=True,
+                     default=None, index=True)
     created_at = Column(DateTime(timezone=True),
                         nullable=False, default=func.now())
     thread_modified_at = Column(DateTime(timezone=True), nullable=True)
-
+    like_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    reply_count = Column(Integer, nullable=False, default=0,
+                         server_default='0')
+    is_public = Column(Boolean, nullable=False, default=False,
+                       server_default=false())
     author = relationship(Contact, backref='posts')
     parts = relationship(PostPart, backref='post', order_by=PostPart.order)
-    children = relationship('Post',
+    children = relationship('Post', foreign_keys=[parent_id],
                             backref=backref('parent', remote_side=[id]))
+    root_post = relationship('Post', foreign_keys=[root_id],
+                             remote_side=[id])
     shares = relationship(Share, backref='post')
 
     class Queries:
@@ -129,15 +494,72 @@ class Post(db.Model):
         def author_shared_with(cls, author, target):
             return and_(
                 Post.author_id == author.id,
-                Share.contact_id == target.contact.id,
-                not_(Share.hidden),
+                or_(
+                    and_(
+                        Share.contact_id == target.contact.id,
+                        not_(Share.hidden)
+                    ),
+                    and_(
+                        cls.listed_for_contact(target.contact),
+                        not_(cls.hidden_by_contact(target.contact))
+                    )
+                ),
                 Post.parent_id == None
             )
 
+        @classmethod
+        def listed_for_contact(cls, contact):
+            return db.session.query(PostAudience).filter(and_(
+                PostAudience.post_id == Post.id,
+                AudienceMember.audience_id == PostAudience.audience_id,
+                AudienceMember.contact_id == contact.id
+            )).exists()
+
+        @classmethod
+        def hidden_by_contact(cls, contact):
+            own_share = aliased(Share)
+            return db.session.query(own_share).filter(and_(
+                own_share.post_id == Post.id,
+                own_share.contact_id == contact.id,
+                own_share.hidden
+            )).exists()
+
         @classmethod
         def shared_with_contact(cls, contact):
             return Share.contact_id == contact.id
 
+        @classmethod
+        def viewable_by(cls, contact=None, post=None):
+            """
+            Whether Contact <contact> (or the public, if None) is permitted
+            to view <post> (an alias of Post, or Post itself if None), by
+            the same rules as Post.viewable_ids().
+            """
+            if post is None:
+                post = Post
+            if not contact:
+                return post.is_public
+            own_share = aliased(Share)
+            shares = db.session.query(own_share).filter(and_(
+                own_share.post_id == post.id,
+                own_share.contact_id == contact.id
+            ))
+            listed = db.session.query(PostAudience).filter(and_(
+                PostAudience.post_id == post.id,
+                AudienceMember.audience_id == PostAudience.audience_id,
+                AudienceMember.contact_id == contact.id
+            )).exists()
+            return and_(
+                # Hidden status trumps everything else
+                not_(shares.filter(own_share.hidden).exists()),
+                or_(
+                    shares.exists(),
+                    listed,
+                    post.is_public,
+                    post.author_id == contact.id
+                )
+            )
+
         @classmethod
         def authored_by_contacts_and_public(cls, contact_ids):
             return and_(
@@ -150,6 +572,12 @@ class Post(db.Model):
         def children_for_posts(cls, post_ids):
             return Post.parent_id.in_(post_ids)
 
+        @classmethod
+        def older_than(cls, cursor):
+            anchor = db.session.query(Post.thread_modified_at). \
+                filter(Post.id == cursor[1])
+            return older_than(cursor, Post.thread_modified_at, Post.id, anchor)
+
     @classmethod
     def get(cls, postid):
         """
@@ -157,15 +585,222 @@ class Post(db.Model):
         """
         return db.session.query(cls).get(postid)
 
+    @classmethod
+    def threads_for_posts(cls, post_ids, viewing_as=None, window=None):
+        """
+        (PostRecord, ShareRecord) pairs for all the descendants of the Posts
+        with IDs <post_ids>, at any depth, each with a Share through which
+        Contact <viewing_as> (or the public, if None) might see it. Parents
+        come before their children, and siblings oldest first. A Post appears
+        once per such Share, and the caller must still check permissions,
+        skipping the replies under any Post that can't be viewed.
+
+        If <window> is given, only the newest <window> replies to each Post
+        that <viewing_as> may view are included, so the cost doesn't grow
+        with the size of the thread.
+        """
+        def newest_replies(parent_id):
+            reply = aliased(cls)
+            return db.session.query(reply.id). \
+                filter(reply.parent_id == parent_id). \
+                filter(cls.Queries.viewable_by(viewing_as, reply)). \
+                order_by(desc(reply.created_at), desc(reply.id)). \
+                limit(window)
+
+        thread = db.session.query(
+            cls.id.label('id'),
+            literal(1).label('depth')
+        ).filter(cls.Queries.children_for_posts(post_ids))
+        if window:
+            thread = thread.filter(cls.id.in_(newest_replies(cls.parent_id)))
+        thread = thread.cte('thread', recursive=True)
+        child = aliased(cls)
+        children = db.session.query(child.id, thread.c.depth + 1). \
+            filter(child.parent_id == thread.c.id)
+        if window:
+            children = children.filter(
+                child.id.in_(newest_replies(thread.c.id)))
+        thread = thread.union_all(children)
+        query = db.session.query(
+            cls.id, cls.parent_id, cls.author_id, cls.created_at,
+            cls.like_count, cls.reply_count
+        ). \
+            join(thread, cls.id == thread.c.id). \
+            order_by(thread.c.depth, cls.created_at, cls.id)
+        shares = (Share.post_id, Share.contact_id, Share.shared_at,
+                  Share.public)
+        if not viewing_as:
+            query = query.join(Share, Share.post_id == cls.id). \
+                filter(Share.public). \
+                add_columns(*shares)
+            return (
+                (PostRecord(*row[:6]), ShareRecord(*row[6:]))
+                for row in select_rows(query.statement)
+            )
+
+        # Posts the viewer can only see through an AudienceList are paired
+        # with a stand-in for the Share they would otherwise have had
+        listed_at = db.session.query(func.min(PostAudience.shared_at)). \
+            filter(and_(
+                PostAudience.post_id == cls.id,
+                AudienceMember.audience_id == PostAudience.audience_id,
+                AudienceMember.contact_id == viewing_as.id
+            )). \
+            as_scalar()
+        query = query.outerjoin(Share, and_(
+            Share.post_id == cls.id,
+            or_(Share.public, Share.contact_id == viewing_as.id)
+        )). \
+            add_columns(*(shares + (listed_at,))). \
+            filter(or_(Share.post_id != None, listed_at != None))
+        return (
+            (
+                PostRecord(*row[:6]),
+                ShareRecord(*row[6:10]) if row[6] is not None else
+                ShareRecord(row[0], viewing_as.id, row[10], False)
+            )
+            for row in select_rows(query.statement)
+        )
+
+    @classmethod
+    def viewable_reply_counts(cls, post_ids, contact=None):
+        """
+        A dict of the number of replies that Contact <contact> (or the public,
+        if None) may view, for each of the Posts with IDs <post_ids> that has
+        replies that aren't public. Every reply to any other Post is public,
+        so its reply_count can be shown as it is.
+        """
+        reply = aliased(cls)
+        private = in_chunks(
+            lambda ids: db.session.query(reply.parent_id).filter(and_(
+                reply.parent_id.in_(ids),
+                not_(reply.is_public)
+            )).distinct(),
+            post_ids
+        )
+        counts = dict((row.parent_id, 0) for row in private)
+        counts.update(in_chunks(
+            lambda ids: db.session.query(
+                reply.parent_id, func.count(reply.id)
+            ).filter(and_(
+                reply.parent_id.in_(ids),
+                cls.Queries.viewable_by(contact, reply)
+            )).group_by(reply.parent_id),
+            list(counts.keys())
+        ))
+        return counts
+
+    @classmethod
+    def recount_replies(cls):
+        """
+        Recalculate reply_count for every Post, for databases from before it
+        was kept. The caller must commit the session.
+        """
+        reply = aliased(cls)
+        count = db.session.query(func.count(reply.id)). \
+            filter(reply.parent_id == cls.id).as_scalar()
+        db.session.query(cls).update(
+            {'reply_count': count},
+            synchronize_session=False
+        )
+
+    @classmethod
+    def fill_thread_columns(cls):
+        """
+        Set root_id and is_public on Posts from before they were kept. The
+        caller must commit the session.
+        """
+        public = db.session.query(Share).filter(and_(
+            Share.post_id == cls.id,
+            Share.public
+        )).exists()
+        db.session.query(cls).filter(and_(public, not_(cls.is_public))). \
+            update({'is_public': True}, synchronize_session=False)
+
+        db.session.query(cls).filter(and_(
+            cls.parent_id != None,
+            cls.root_id == None
+        )).update({'root_id': cls.parent_id}, synchronize_session=False)
+        # Move each reply's root up a level at a time until it is top-level
+        while True:
+            root = aliased(cls)
+            root_root = db.session.query(root.root_id). \
+                filter(root.id == cls.root_id).as_scalar()
+            has_root = db.session.query(root). \
+                filter(and_(root.id == cls.root_id, root.root_id != None)). \
+                exists()
+            moved = db.session.query(cls).filter(has_root). \
+                update({'root_id': root_root}, synchronize_session=False)
+            if not moved:
+                break
+
+    @classmethod
+    def viewable_ids(cls, post_ids, contact=None):
+        """
+        The IDs, out of <post_ids>, of the Posts that Contact <contact> (or
+        the public, if None) is permitted to view, by the same rules as
+        has_permission_to_view(). Takes up to three queries for each
+        IN_LIST_LIMIT Posts, and answers are remembered for the rest of the
+        request.
+        """
+        memo = request_memo('post_permissions')
+        viewer_id = contact.id if contact else None
+        post_ids = set(post_ids)
+        unknown = [p for p in post_ids if (viewer_id, p) not in memo]
+        if unknown:
+            decided = {}
+            if contact:
+                # Hidden status trumps everything else
+                shares = in_chunks(
+                    lambda ids: db.session.query(
+                        Share.post_id, Share.hidden
+                    ).filter(and_(
+                        Share.contact_id == contact.id,
+                        Share.post_id.in_(ids)
+                    )),
+                    unknown
+                )
+                for share in shares:
+                    decided[share.post_id] = not share.hidden
+                listed = in_chunks(
+                    lambda ids: PostAudience.members_for_posts(ids, contact),
+                    [p for p in unknown if p not in decided]
+                )
+                for member in listed:
+                    decided[member.post_id] = True
+            # Posts already loaded in this session needn't be fetched again
+            posts = []
+            rest = []
+            for post_id in unknown:
+                if post_id in decided:
+                    continue
+                post = db.session.identity_map.get(identity_key(cls, post_id))
+                if post is None:
+                    rest.append(post_id)
+                else:
+                    posts.append(post)
+            posts += in_chunks(
+                lambda ids: db.session.query(
+                    cls.id, cls.author_id, cls.is_public
+                ).filter(cls.id.in_(ids)),
+                rest
+            )
+            for post in posts:
+                decided[post.id] = post.is_public or \
+                    viewer_id == post.author_id
+            for post_id in unknown:
+                memo[(viewer_id, post_id)] = decided.get(post_id, False)
+        return set(p for p in post_ids if memo[(viewer_id, p)])
+
     def has_permission_to_view(self, contact=None, share=False):
         """
         Whether the Contact <contact> is permitted to view this post.
         """
+        if share is False:  # we don't use None as there may be no Share
+            return self.id in Post.viewable_ids([self.id], contact)
+
         if contact:
             # Check for shares to the contact
-            if share is False:  # we don't use None as there may be no Share
-                share = self.shared_with(contact)
-
             if share:
                 # Hidden status trumps everything else
                 return not share.hidden
@@ -177,14 +812,14 @@ class Post(db.Model):
         if share and share.public:
             return True
 
-        return bool(self.is_public())
+        return self.is_public
 
     def viewable_children(self, contact=None):
         """
         List of child posts that the Contact <contact> is permitted to view
         """
-        return [child for child in self.children
-                if child.has_permission_to_view(contact)]
+        viewable = Post.viewable_ids([c.id for c in self.children], contact)
+        return [child for child in self.children if child.id in viewable]
 
     def add_part(self, mime_part, inline=False, order=1):
         """
@@ -196,15 +831,6 @@ class Post(db.Model):
         db.session.add(link)
         return link
 
-    def is_public(self):
-        """
-        Returns true if anybody has made this Post public.
-        """
-        return db.session.query(Share).filter(and_(
-            Share.public,
-            Share.post == self
-        )).first()
-
     def author_made_public(self):
         """
         Returns true if the original author made this Post public.
@@ -220,8 +846,17 @@ class Post(db.Model):
         Arrange to send this post to contacts on the remote node.
         """
         from pyaspora.diaspora.models import DiasporaPost
+        from pyaspora.user.models import User
         db.session.commit()  # write out shares
-        contacts = [c for c in contacts if not c.user]
+        if not contacts:
+            return
+        local = in_chunks(
+            lambda ids: db.session.query(User.contact_id).filter(
+                User.contact_id.in_(ids)),
+            [c.id for c in contacts]
+        )
+        local = set(u.contact_id for u in local)
+        contacts = [c for c in contacts if c.id not in local]
         if contacts:
             # Only public posts can be reshared by Diaspora
             if reshare_of and self.author_made_public() and \
@@ -240,59 +875,159 @@ class Post(db.Model):
             self._send_to_remotes(contacts, reshare_of)
 
     def share_with(self, contacts, show_on_wall=False, reshare_of=None,
-                   remote=True):
+                   remote=True, audience_list=False):
         """
         Share this Post with all the contacts in list <contacts>. This method
         doesn't share the post if the Contact already has this Post shared
-        with them.
+        with them. The existing Shares are fetched and the new ones written
+        in bulk, so this stays cheap for a large audience.
+
+        If <audience_list> is True (and the Post isn't being shown on their
+        walls) the Contacts are recorded as one AudienceList, shared with
+        other Posts with the same audience, rather than a Share each.
         """
+        from pyaspora.feed.models import TimelineEntry
+        from pyaspora.user.models import User
+
+        request_memo('post_permissions').clear()
+        contacts = list(contacts)
+        db.session.add(self)
+        for contact in contacts:
+            if contact.id is None:
+                db.session.add(contact)
+        # This also flushes the Post and any new Contacts, giving them IDs
+        existing = db.session.query(Share.contact_id).filter(
+            Share.post == self)
+        existing = set(s.contact_id for s in existing)
+        existing.update(
+            m.contact_id for m in PostAudience.members_for_posts([self.id]))
+
         new_shares = []
         for contact in contacts:
-            if not self.shared_with(contact):
+            if contact.id not in existing:
+                existing.add(contact.id)
                 new_shares.append(contact)
-                db.session.add(Share(contact=contact, post=self,
-                                     public=show_on_wall))
-                if contact.user and contact.id != self.author_id:
-                    contact.user.notify_event(commit=False)
+
+        if new_shares:
+            if audience_list and not show_on_wall:
+                audience = AudienceList.for_contacts(c.id for c in new_shares)
+                db.session.add(PostAudience(
+                    post_id=self.id,
+                    audience_id=audience.id
+                ))
+            else:
+                db.session.bulk_insert_mappings(Share, [
+                    {
+                        'contact_id': c.id,
+                        'post_id': self.id,
+                        'public': show_on_wall
+                    } for c in new_shares
+                ])
+                db.session.expire(self, ['shares'])
+            if show_on_wall:
+                self.is_public = True
+                invalidate_on_commit(
+                    *[c.cache_tag('feed') for c in new_shares])
+            User.notify_contacts(
+                [c.id for c in new_shares if c.id != self.author_id])
+            TimelineEntry.post_updated(self)
         if remote and self.author.user:
             # Only announce locally-generated content
             self._send_to_remotes(new_shares, reshare_of)
 
     def shared_with(self, contact):
         """
-        Returns a boolean indicating whether this Post has already been shared
-        with Contact <contact>.
+        Returns the Share through which this Post has already been shared
+        with Contact <contact>, or None if it hasn't. If the Contact can see
+        the Post through an AudienceList, the Share returned is a stand-in
+        which isn't saved.
         """
-        return db.session.query(Share).filter(and_(
+        share = db.session.query(Share).filter(and_(
             Share.contact == contact,
             Share.post == self
         )).first()
+        if share:
+            return share
+        listed = PostAudience.members_for_posts([self.id], contact). \
+            order_by(PostAudience.shared_at). \
+            first()
+        if listed:
+            return Share.through_audience(
+                self.id, contact.id, listed.shared_at, contact)
+        return None
 
     def hide(self, user):
         """
         Stop this post appearing in the feed of the user.
         """
+        from pyaspora.feed.models import TimelineEntry
+        invalidate_on_commit(user.contact.cache_tag('feed'))
+        request_memo('post_permissions').clear()
+        TimelineEntry.hide(user, self)
         share = self.shared_with(user.contact)
         if share:
             share.hidden = True
+            share.hidden_at = func.now()
             db.session.add(share)
             return
 
         # Can only make our own share for public posts
-        assert(self.is_public())
+        assert(self.is_public)
         db.session.add(Share(
             contact=user.contact,
             post=self,
             public=True,
-            hidden=True
+            hidden=True,
+            hidden_at=func.now()
         ))
 
+    def like(self, contact):
+        """
+        Record that Contact <contact> likes this Post. Returns False if they
+        already did, even if that like was only just recorded by another
+        request. Requires the caller commit the session.
+        """
+        if not insert_unless_duplicate(PostLike.__table__, {
+            'post_id': self.id,
+            'contact_id': contact.id
+        }):
+            return False
+        self.like_count = Post.like_count + 1
+        db.session.add(self)
+        return True
+
+    def unlike(self, contact):
+        """
+        Remove Contact <contact>'s like of this Post. Returns False if they
+        didn't like it (or another request has just removed it). Requires the
+        caller commit the session.
+        """
+        removed = db.session.query(PostLike).filter(and_(
+            PostLike.post_id == self.id,
+            PostLike.contact_id == contact.id
+        )).delete(synchronize_session=False)
+        if not removed:
+            return False
+        self.like_count = Post.like_count - 1
+        db.session.add(self)
+        return True
+
+    @classmethod
+    def cache_tag(cls, post_id):
+        """
+        The response-cache tag for cached documents that include the Post with
+        ID <post_id>.
+        """
+        return 'post:{0}'.format(post_id)
+
     def root(self):
         """
         The top-level post that started this thread.
         """
+        if self.root_post:
+            return self.root_post
         post = self
-        while post.parent:
+        while post.parent:  # Not yet flushed
             post = post.parent
         return post
 
@@ -301,11 +1036,29 @@ class Post(db.Model):
         Mark this thread as having been modified. This makes it "bubble up" in
         contact feeds. Requires the caller commit the session.
         """
+        from pyaspora.feed.models import TimelineEntry
         post = self.root()
         if when:
             if not(post.thread_modified_at) or post.thread_modified_at < when:
                 post.thread_modified_at = when
         else:
             post.thread_modified_at = func.now()
+        invalidate_on_commit(Post.cache_tag(post.id),
+                             post.author.cache_tag('feed'))
+        TimelineEntry.post_updated(post)
         if post.id != self.id:
             db.session.add(post)
+
+
+@event.listens_for(Session, 'before_flush')
+def _new_replies(session, flush_context, instances):
+    replies = {}
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.parent is not None:
+            obj.root_post = obj.parent.root()
+            replies[obj.parent] = replies.get(obj.parent, 0) + 1
+    for parent, count in replies.items():
+        if parent in session.new:
+            parent.reply_count = (parent.reply_count or 0) + count
+        else:
+            parent.reply_count = Post.reply_count + count
@@ -1,53 +1,100 @@
+from sqlalchemy.orm import joinedload, subqueryload
+
+from pyaspora.contact.models import Contact as ContactModel
 from pyaspora.contact.views import json_contact
+from pyaspora.database import db
+from pyaspora.post.models import Share
+from pyaspora.roster.graph import SubscriptionGraph
+from pyaspora.roster.models import Subscription, SubscriptionTag
 from pyaspora.roster.views import json_group
 
 
-class Target:
-    @classmethod
-    def _user_bothway_contacts(cls, user, parent=None):
-        return cls._contacts_intersect_interested(
-            user,
-            user.contact.friends(),
-            parent
-        )
+class Audience(object):
+    """
+    Who a User can reach with a new Post or a reply to <parent>, loaded once
+    in a fixed number of queries so that the Targets can answer every
+    question from memory.
+
+    Fields:
+        user - the User posting
+        parent - the Post being replied to, or None
+        friends - the Contacts the User is subscribed to
+        follower_ids - the IDs of Contacts subscribed to the User
+        groups - the User's SubscriptionGroups
+        members - the Contacts in each group, keyed by group ID
+        parent_shares - the Contacts the parent is shared with, keyed by ID
+    """
+    def __init__(self, user, parent=None):
+        self.user = user
+        self.parent = parent
+
+        # Eager-load what json_contact() shows about each friend
+        self.friends = user.contact.friends(). \
+            options(joinedload(ContactModel.diasp)). \
+            options(joinedload(ContactModel.user)). \
+            options(joinedload(ContactModel.avatar)). \
+            options(joinedload(ContactModel.bio)). \
+            options(subqueryload(ContactModel.interests)). \
+            all()
+
+        self.follower_ids = SubscriptionGraph.current(). \
+            followers(user.contact.id)
+
+        self.groups = user.groups
+        self.members = dict((g.id, []) for g in self.groups)
+        if self.groups:
+            members = db.session.query(
+                SubscriptionTag.group_id,
+                ContactModel
+            ).join(
+                Subscription,
+                Subscription.id == SubscriptionTag.subscription_id
+            ).join(
+                ContactModel,
+                ContactModel.id == Subscription.to_id
+            ).filter(SubscriptionTag.group_id.in_(self.members.keys()))
+            for group_id, contact in members:
+                self.members[group_id].append(contact)
+
+        self.parent_shares = {}
+        if parent:
+            shares = Share.all_for_posts([parent.id], load_contacts=True)
+            for share in shares:
+                self.parent_shares[share.contact_id] = share.contact
+
+    def wants_to_hear(self, contact, parent=True):
+        """
+        Whether <contact> wants to hear from the User: they follow the User
+        or, if <parent> is True, they can see the Post being replied to.
+        """
+        if contact.id in self.follower_ids:
+            return True
+        return parent and contact.id in self.parent_shares
 
-    @classmethod
-    def _user_bothway_contacts_for_post(cls, user, post):
-        return cls._post_intersect_contacts(
-            post,
-            cls._user_bothway_contacts(user)
-        )
+    def interested(self, contacts, parent=True):
+        """
+        Those of <contacts> who want to hear from the User.
+        """
+        return [c for c in contacts if self.wants_to_hear(c, parent)]
 
-    @classmethod
-    def _post_intersect_contacts(cls, post, contacts):
-        parent_shared_with = set(s.contact_id for s in post.shares)
-        return [c for c in contacts if c.id in parent_shared_with]
+    def can_see_parent(self, contacts):
+        """
+        Those of <contacts> who the Post being replied to is shared with.
+        """
+        return [c for c in contacts if c.id in self.parent_shares]
 
-    @classmethod
-    def _contacts_intersect_interested(cls, user, contacts, parent=None):
-        return [
-            c for c in contacts
-            if cls._contact_wants_to_hear_from_user(user.contact, c, parent)
-        ]
 
+class Target:
     @classmethod
     def _make_self_share(cls, post, on_wall=False):
         post.share_with([post.author], show_on_wall=on_wall)
 
-    @classmethod
-    def _contact_wants_to_hear_from_user(cls, user, contact, parent=None):
-        if contact.subscribed_to(user):
-            return True
-        if parent and parent.shared_with(contact):
-            return True
-        return False
-
 
 class Self(Target):
     name = 'self'
 
     @classmethod
-    def json_target(cls, user, parent_post=None):
+    def json_target(cls, audience):
         return {
             'name': cls.name,
             'description': 'Only visible to myself',
@@ -55,15 +102,15 @@ class Self(Target):
         }
 
     @classmethod
-    def permitted_for_new(cls, user):
+    def permitted_for_new(cls, audience):
         return True
 
     @classmethod
-    def permitted_for_reply(cls, user, parent_post):
+    def permitted_for_reply(cls, audience):
         return True
 
     @classmethod
-    def make_shares(cls, post, target, reshare_of=None):
+    def make_shares(cls, post, target, audience, reshare_of=None):
         cls._make_self_share(post)
 
 
@@ -71,11 +118,10 @@ class Contact(Target):
     name = 'contact'
 
     @classmethod
-    def json_target(cls, user, parent_post=None):
-        if parent_post:
-            user_list = cls._user_bothway_contacts_for_post(user, parent_post)
-        else:
-            user_list = cls._user_bothway_contacts(user)
+    def json_target(cls, audience):
+        user_list = audience.interested(audience.friends, parent=False)
+        if audience.parent:
+            user_list = audience.can_see_parent(user_list)
         return {
             'name': cls.name,
             'description': 'Share with one friend',
@@ -83,28 +129,24 @@ class Contact(Target):
         }
 
     @classmethod
-    def permitted_for_new(cls, user):
-        return bool(cls._user_bothway_contacts(user))
+    def permitted_for_new(cls, audience):
+        return bool(audience.interested(audience.friends, parent=False))
 
     @classmethod
-    def permitted_for_reply(cls, user, parent_post):
-        return bool(cls._user_bothway_contacts_for_post(user, parent_post))
+    def permitted_for_reply(cls, audience):
+        return bool(audience.can_see_parent(
+            audience.interested(audience.friends, parent=False)
+        ))
 
     @classmethod
-    def make_shares(cls, post, target, reshare_of=None):
+    def make_shares(cls, post, target, audience, reshare_of=None):
         cls._make_self_share(post)
-        contact = [
-            c for c in post.author.friends() if c.id == int(target)
-        ]
+        contact = [c for c in audience.friends if c.id == int(target)]
         if contact:
             contact = contact[0]
         else:
             return
-        if cls._contact_wants_to_hear_from_user(
-            post.author,
-            contact,
-            post.parent
-        ):
+        if audience.wants_to_hear(contact):
             post.share_with([contact], reshare_of=reshare_of)
 
 
@@ -112,82 +154,58 @@ class Group(Target):
     name = 'group'
 
     @classmethod
-    def json_target(cls, user, parent_post=None):
-        if parent_post:
+    def json_target(cls, audience):
+        if audience.parent:
             groups = (
-                g for g in user.groups if
-                cls._contacts_intersect_interested(
-                    user,
-                    cls._post_intersect_contacts(
-                        parent_post,
-                        [s.to_contact for s in g.subscriptions]
-                    ),
-                    parent_post
+                g for g in audience.groups if
+                audience.interested(
+                    audience.can_see_parent(audience.members[g.id])
                 )
             )
         else:
             groups = (
-                g for g in user.groups if
-                cls._contacts_intersect_interested(
-                    user,
-                    [s.to_contact for s in g.subscriptions]
-                )
+                g for g in audience.groups if
+                audience.interested(audience.members[g.id])
             )
         return {
             'name': cls.name,
             'description': 'Share with a group of friends',
-            'targets': [json_group(g, user) for g in groups]
+            'targets': [json_group(g, audience.user) for g in groups]
         }
 
     @classmethod
-    def permitted_for_new(cls, user):
-        return bool([
-            g for g in user.groups if
-            cls._contacts_intersect_interested(
-                user,
-                [s.to_contact for s in g.subscriptions]
-            )
-        ])
+    def permitted_for_new(cls, audience):
+        return any(
+            audience.interested(audience.members[g.id])
+            for g in audience.groups
+        )
 
     @classmethod
-    def permitted_for_reply(cls, user, parent_post):
-        for g in user.groups:
-            targets = cls._contacts_intersect_interested(
-                user,
-                [s.to_contact for s in g.subscriptions],
-                parent_post
+    def permitted_for_reply(cls, audience):
+        return any(
+            audience.can_see_parent(
+                audience.interested(audience.members[g.id])
             )
-            targets = cls._post_intersect_contacts(parent_post, targets)
-            if targets:
-                return True
-        return False
+            for g in audience.groups
+        )
 
     @classmethod
-    def make_shares(cls, post, target, reshare_of=None):
+    def make_shares(cls, post, target, audience, reshare_of=None):
         cls._make_self_share(post)
-        group = [
-            g for g in post.author.groups if g.id == int(target)
-        ]
+        group = [g for g in audience.groups if g.id == int(target)]
         if group:
             group = group[0]
         else:
             return
-        contacts = [
-            s.to_contact for s in g.subscriptions
-            if cls._contact_wants_to_hear_from_user(
-                post.author,
-                s.to_contact,
-                post.parent
-            )
-        ]
-        post.share_with(contacts, reshare_of=reshare_of)
+        contacts = audience.interested(audience.members[group.id])
+        post.share_with(contacts, reshare_of=reshare_of, audience_list=True)
 
 
 class AllFriends(Target):
     name = 'all_friends'
 
     @classmethod
-    def json_target(cls, user, parent_post=None):
+    def json_target(cls, audience):
         return {
             'name': cls.name,
             'description': 'Share with all my friends',
@@ -195,36 +213,30 @@ class AllFriends(Target):
         }
 
     @classmethod
-    def permitted_for_new(cls, user):
-        return bool(cls._user_bothway_contacts(user))
+    def permitted_for_new(cls, audience):
+        return bool(audience.interested(audience.friends, parent=False))
 
     @classmethod
-    def permitted_for_reply(cls, user, parent_post):
-        return bool(cls._post_intersect_contacts(
-            parent_post,
-            cls._user_bothway_contacts(user)
+    def permitted_for_reply(cls, audience):
+        return bool(audience.can_see_parent(
+            audience.interested(audience.friends, parent=False)
         ))
 
     @classmethod
-    def make_shares(cls, post, target, reshare_of=None):
+    def make_shares(cls, post, target, audience, reshare_of=None):
         cls._make_self_share(post)
         contacts = [
-            c for c in post.author.friends()
-            if cls._contact_wants_to_hear_from_user(
-                post.author,
-                c,
-                post.parent
-            )
-            and c.id != post.author_id
+            c for c in audience.interested(audience.friends)
+            if c.id != post.author_id
         ]
-        post.share_with(contacts, reshare_of=reshare_of)
+        post.share_with(contacts, reshare_of=reshare_of, audience_list=True)
 
 
 class ExistingViewers(Target):
     name = 'existing'
 
     @classmethod
-    def json_target(cls, user, parent_post=None):
+    def json_target(cls, audience):
         return {
             'name': cls.name,
             'description': 'Share with people who can see the item I am '
@@ -233,33 +245,28 @@ class ExistingViewers(Target):
         }
 
     @classmethod
-    def permitted_for_new(cls, user):
+    def permitted_for_new(cls, audience):
         return False
 
     @classmethod
-    def permitted_for_reply(cls, user, parent_post):
+    def permitted_for_reply(cls, audience):
         return True
 
     @classmethod
-    def make_shares(cls, post, target, reshare_of=None):
+    def make_shares(cls, post, target, audience, reshare_of=None):
         cls._make_self_share(post)
         contacts = [
-            s.contact for s in post.parent.shares
-            if cls._contact_wants_to_hear_from_user(
-                post.author,
-                s.contact,
-                post.parent
-            )
-            and s.contact_id != post.author_id
+            c for c in audience.parent_shares.values()
+            if c.id != post.author_id
         ]
-        post.share_with(contacts, reshare_of=reshare_of)
+        post.share_with(contacts, reshare_of=reshare_of, audience_list=True)
 
 
 class Public(Target):
     name = 'wall'
 
     @classmethod
-    def json_target(cls, user, parent_post=None):
+    def json_target(cls, audience):
         return {
             'name': cls.name,
             'description': 'Show to everyone on my wall',
@@ -267,15 +274,15 @@ class Public(Target):
         }
 
     @classmethod
-    def permitted_for_new(cls, user):
+    def permitted_for_new(cls, audience):
         return True
 
     @classmethod
-    def permitted_for_reply(cls, user, parent_post):
-        return parent_post.is_public()
+    def permitted_for_reply(cls, audience):
+        return audience.parent.is_public
 
     @classmethod
-    def make_shares(cls, post, target, reshare_of=None):
+    def make_shares(cls, post, target, audience, reshare_of=None):
         cls._make_self_share(post, True)
 
         post.implicit_share(post.author.followers(), reshare_of=reshare_of)
@@ -0,0 +1,23 @@
+{#
+Display a page of the replies to a Post.
+#}
+{% extends "layout.tpl" %}
+{% from 'widgets.tpl' import button_form, show_feed %}
+
+{% block content %}
+<h2>Replies</h2>
+
+<div id="related_item">
+    {{show_feed([post], logged_in)}}
+</div>
+
+{% if replies %}
+    {{show_feed(replies, logged_in)}}
+    {% if actions.more %}
+        {{button_form(actions.more, 'View older replies', method='get')}}
+    {% endif %}
+{% else %}
+    <p>No replies to show.</p>
+{% endif %}
+
+{% endblock %}
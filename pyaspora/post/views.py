@@ -1,17 +1,18 @@
 from __future__ import absolute_import
 
-from flask import Blueprint, request, url_for
+from flask import Blueprint, current_app, request, url_for
 from json import dumps
-from sqlalchemy.orm import joinedload
-from sqlalchemy.sql import and_, not_, or_
+from sqlalchemy.sql import and_, desc, not_, or_
 
 from pyaspora.content.models import MimePart
 from pyaspora.content.rendering import render, renderer_exists
 from pyaspora.contact.models import Contact
 from pyaspora.contact.views import json_contact
-from pyaspora.database import db
-from pyaspora.post.models import Post, PostPart, Share
-from pyaspora.post.targets import target_list, targets_by_name
+from pyaspora.database import db, in_chunks
+from pyaspora.post.models import Post, PostLike, PostPart, Share
+from pyaspora.post.targets import Audience, target_list, targets_by_name
+from pyaspora.utils.pagination import encode_cursor, more_link, older_than, \
+    page_size, paginate, request_cursor
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
     redirect, render_datetime, render_response
 from pyaspora.utils.validation import check_attachment_is_safe, post_param
@@ -35,57 +36,88 @@ def _base_cache():
     }
 
 
-def json_posts(posts_and_shares, viewing_as=None, show_shares=False):
+def json_posts(posts_and_shares, viewing_as=None, show_shares=False,
+               children=True):
     """
     Run a list of (post, share) pairs through json_post, giving a list
     of for-serialisation views of Posts. This call is more efficient than
-    calling json_post() repeatedly as data is cached.
+    calling json_post() repeatedly as data is cached. If 'children' is False
+    then child Posts will not be fetched; otherwise only the newest
+    REPLY_WINDOW replies to each Post are included, with a link to the rest.
     """
     cache = _base_cache()
     res = [
         json_post(p, viewing_as, s, cache=cache, children=False)
         for p, s in posts_and_shares
     ]
-    _fill_children(cache, viewing_as)
-    _fill_cache(cache, show_shares)
+    if children:
+        _fill_children(
+            cache,
+            viewing_as,
+            current_app.config.get('REPLY_WINDOW', 3)
+        )
+    _fill_cache(cache, show_shares, viewing_as)
     return res
 
 
-def _fill_children(c, viewing_as):
+def _fill_children(c, viewing_as, window=None):
     if 'post' not in c:
         return
 
-    while True:
-        fetch_ids = [k for k, v in c['post'].items() if v['children'] is None]
-        if not fetch_ids:
-            break
-        child_posts = db.session.query(Post).join(Share). \
-            filter(Post.Queries.children_for_posts(fetch_ids)). \
-            options(joinedload(Post.diasp)). \
-            order_by(Post.created_at).add_entity(Share)
-        if viewing_as:
-            child_posts = child_posts.filter(
-                or_(Share.public, Share.contact == viewing_as)
-            )
-        else:
-            child_posts = child_posts.filter(Share.public)
-        for i in fetch_ids:
-            c['post'][i]['children'] = []
-        for post, share in child_posts:
-            can_view = post.has_permission_to_view(
-                viewing_as,
-                share=share
-            )
-            if can_view:
-                c['post'][post.parent_id]['children'].append(
-                    json_post(
-                        post,
-                        viewing_as,
-                        share,
-                        children=False,
-                        cache=c
-                    )
+    fetch_ids = [k for k, v in c['post'].items() if v['children'] is None]
+    if not fetch_ids:
+        return
+    for i in fetch_ids:
+        c['post'][i]['children'] = []
+
+    # Whole threads come back in one query, parents first, so a reply can
+    # be placed as long as its parent was. The viewer's own Share is
+    # preferred to a public one.
+    threads = []
+    shares = {}
+    for post, share in Post.threads_for_posts(fetch_ids, viewing_as, window):
+        if post.id not in shares:
+            threads.append(post)
+        if post.id not in shares or \
+                (viewing_as and share.contact_id == viewing_as.id):
+            shares[post.id] = share
+    viewable = Post.viewable_ids(shares.keys(), viewing_as)
+
+    placed = set(fetch_ids)
+    oldest = {}
+    for post in threads:
+        if post.id not in viewable or post.parent_id not in placed:
+            continue
+        data = json_post(
+            post,
+            viewing_as,
+            shares[post.id],
+            children=False,
+            cache=c
+        )
+        data['children'] = []
+        c['post'][post.parent_id]['children'].append(data)
+        placed.add(post.id)
+        oldest.setdefault(post.parent_id, post)
+
+    if window:
+        _fill_reply_counts(c, viewing_as, placed)
+        for post_id in placed:
+            data = c['post'][post_id]
+            if data['replies'] <= window:
+                continue
+            before = None
+            if post_id in oldest:
+                before = encode_cursor(
+                    oldest[post_id].created_at,
+                    oldest[post_id].id
                 )
+            data['actions']['older_replies'] = url_for(
+                'posts.replies',
+                post_id=post_id,
+                before=before,
+                _external=True
+            )
 
 
 def json_post(post, viewing_as=None, share=None, children=True, cache=None):
@@ -108,28 +140,26 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
             'share': None,
             'comment': None,
             'hide': None,
+            'like': None,
+            'unlike': None,
+            'older_replies': None,
         },
         'tags': [],
-        'shares': None
+        'shares': None,
+        'likes': post.like_count,
+        'replies': post.reply_count,
+        'liked': False
     })
 
-    if children:
-        sorted_children = sorted(post.viewable_children(viewing_as),
-                                 key=lambda p: p.created_at)
-        data['children'] = [
-            json_post(
-                p,
-                viewing_as,
-                p.shared_with(viewing_as) if viewing_as else None,
-                cache=c
-            ) for p in sorted_children
-        ]
-
     if viewing_as:
         data['actions']['comment'] = url_for('posts.comment',
                                              post_id=post.id, _external=True)
         data['actions']['share'] = \
             url_for('posts.share', post_id=post.id, _external=True)
+        data['actions']['like'] = \
+            url_for('posts.like', post_id=post.id, _external=True)
+        data['actions']['unlike'] = \
+            url_for('posts.unlike', post_id=post.id, _external=True)
 
         if share and viewing_as and \
                 (share.public or share.contact_id == viewing_as.id):
@@ -137,23 +167,44 @@ def json_post(post, viewing_as=None, share=None, children=True, cache=None):
                                               post_id=post.id, _external=True)
 
     if not cache:
-        _fill_cache(c, bool(share))
+        if children:
+            _fill_children(c, viewing_as)
+        _fill_cache(c, bool(share), viewing_as)
 
     return data
 
 
-def _fill_cache(c, show_shares=False):
+def _fill_reply_counts(c, viewing_as, post_ids):
+    # Where some replies to a Post are limited, only count those the viewer
+    # may see
+    counted = c.setdefault('counted_replies', set())
+    post_ids = [p for p in post_ids if p not in counted]
+    counts = Post.viewable_reply_counts(post_ids, viewing_as)
+    for post_id in post_ids:
+        if post_id in counts:
+            c['post'][post_id]['replies'] = counts[post_id]
+    counted.update(post_ids)
+
+
+def _fill_cache(c, show_shares=False, viewing_as=None):
     # Fill the cache in bulk, which will also fill the entries
     post_ids = c['post'].keys()
     if post_ids:
-        for post_tag in PostTag.get_tags_for_posts(post_ids):
-            c['post'][post_tag.post_id]['tags'].append(json_tag(post_tag.tag))
-        post_parts = PostPart.get_parts_for_posts(post_ids). \
-            order_by(PostPart.order)
-        for post_part in post_parts:
-            c['post'][post_part.post_id]['parts'].append(json_part(post_part))
+        _fill_reply_counts(c, viewing_as, post_ids)
+        if viewing_as:
+            liked = in_chunks(
+                lambda ids: PostLike.liked_by(ids, viewing_as), post_ids)
+            for post_id in liked:
+                c['post'][post_id]['liked'] = True
+        for post_id, tag in in_chunks(PostTag.records_for_posts, post_ids):
+            c['post'][post_id]['tags'].append(json_tag(tag))
+        from pyaspora.diaspora.models import DiasporaPollVote
+        parts = list(in_chunks(PostPart.records_for_posts, post_ids))
+        DiasporaPollVote.tally_parts(parts)
+        for part in parts:
+            c['post'][part.post_id]['parts'].append(json_part(part))
         if show_shares:
-            for post_share in Share.get_for_posts(post_ids):
+            for post_share in in_chunks(Share.records_for_posts, post_ids):
                 post_id = post_share.post_id
                 if not c['post'][post_id]['shares']:
                     c['post'][post_id]['shares'] = []
@@ -161,9 +212,8 @@ def _fill_cache(c, show_shares=False):
                     json_share(post_share, cache=c)
                 )
     if c['contact']:
-        query = Contact.get_many(c['contact'].keys()). \
-            options(joinedload(Contact.diasp))
-        for contact in query:
+        contacts = in_chunks(Contact.get_many_records, c['contact'].keys())
+        for contact in contacts:
             c['contact'][contact.id].update(json_contact(contact))
 
 
@@ -250,6 +300,57 @@ def comment(post_id, _user):
     return render_response('posts_create_form.tpl', data)
 
 
+@blueprint.route('/<int:post_id>/replies', methods=['GET'])
+@require_logged_in_user
+def replies(post_id, _user):
+    """
+    Page through the replies to an existing Post, newest first.
+    """
+    post = Post.get(post_id)
+    if not post:
+        abort(404, 'No such post', force_status=True)
+    if not post.has_permission_to_view(_user.contact):
+        abort(403, 'Forbidden')
+
+    query = db.session.query(Post).join(Share). \
+        filter(Post.parent_id == post.id). \
+        filter(or_(
+            Share.public,
+            Share.contact == _user.contact,
+            Post.Queries.listed_for_contact(_user.contact)
+        )). \
+        order_by(desc(Post.created_at), desc(Post.id)). \
+        group_by(Post.id)
+    cursor = request_cursor()
+    if cursor:
+        anchor = db.session.query(Post.created_at). \
+            filter(Post.id == cursor[1])
+        query = query.filter(
+            older_than(cursor, Post.created_at, Post.id, anchor))
+    page, next_cursor = paginate(
+        query,
+        page_size(),
+        lambda p: (p.created_at, p.id)
+    )
+    viewable = Post.viewable_ids([p.id for p in page], _user.contact)
+
+    data = {
+        'post': json_post(post, _user.contact, children=False),
+        'replies': json_posts(
+            [(p, None) for p in reversed(page) if p.id in viewable],
+            _user.contact
+        ),
+        'next': next_cursor,
+        'actions': {
+            'more': more_link('posts.replies', next_cursor, post_id=post.id)
+        }
+    }
+
+    add_logged_in_user_to_data(data, _user)
+
+    return render_response('posts_replies.tpl', data)
+
+
 @require_logged_in_user
 def _get_share_for_post(post_id, _user):
     share = db.session.query(Share).filter(and_(
@@ -278,11 +379,50 @@ def hide(post_id, _user):
     return redirect(url_for('feed.view', _external=True))
 
 
+@blueprint.route('/<int:post_id>/like', methods=['POST'])
+@require_logged_in_user
+def like(post_id, _user):
+    """
+    Like an existing Post.
+    """
+    return _set_liked(post_id, _user, True)
+
+
+@blueprint.route('/<int:post_id>/unlike', methods=['POST'])
+@require_logged_in_user
+def unlike(post_id, _user):
+    """
+    Stop liking an existing Post.
+    """
+    return _set_liked(post_id, _user, False)
+
+
+def _set_liked(post_id, user, positive):
+    from pyaspora.diaspora.actions import Like
+
+    post = Post.get(post_id)
+    if not post:
+        abort(404, 'No such post', force_status=True)
+    if not post.has_permission_to_view(user.contact):
+        abort(403, 'Forbidden')
+
+    if positive:
+        changed = post.like(user.contact)
+    else:
+        changed = post.unlike(user.contact)
+    if changed:
+        Like.queue_outgoing(user, post, positive)
+    db.session.commit()
+
+    return redirect(url_for('feed.view', _external=True))
+
+
 def _base_create_form(user, parent=None):
+    audience = Audience(user, parent)
     if parent:
         targets = (
             t for t in target_list
-            if t.permitted_for_reply(user, parent)
+            if t.permitted_for_reply(audience)
         )
         if parent.diasp:
             targets = (
@@ -292,12 +432,12 @@ def _base_create_form(user, parent=None):
     else:
         targets = (
             t for t in target_list
-            if t.permitted_for_new(user)
+            if t.permitted_for_new(audience)
         )
 
     data = {
         'next': url_for('.create', _external=True),
-        'targets': [t.json_target(user, parent) for t in targets],
+        'targets': [t.json_target(audience) for t in targets],
         'use_advanced_form': False
     }
     add_logged_in_user_to_data(data, user)
@@ -326,6 +466,7 @@ def create(_user):
     """
     Create a new Post and Share it with the selected Contacts.
     """
+    from pyaspora.diaspora.models import DiasporaPost
     body = post_param('body')
     relationship = {
         'type': post_param('relationship_type', optional=True),
@@ -403,11 +544,13 @@ def create(_user):
 
     # Sigh, need an ID for the post for making shares
     db.session.add(post)
-    db.session.commit()
+    db.session.flush()
+    DiasporaPost.get_for_post(post, commit=False)
 
     targets_by_name[target['type']].make_shares(
         post,
         target['id'],
+        Audience(_user, post.parent),
         reshare_of=shared
     )
     db.session.commit()
@@ -0,0 +1,298 @@
+"""
+An in-process index of the subscription graph, so that "who does this Contact
+follow?", "who follows them?" and "does A follow B?" can be answered from
+memory rather than by a query each time.
+
+The graph is held as two CSR-style ("compressed sparse row") integer arrays,
+one by subscriber and one by the Contact subscribed to, built with a single
+query. Subscriptions made or dropped since are kept in a small overlay, which
+is folded into fresh arrays once it grows past GRAPH_OVERLAY_LIMIT changes.
+
+Each worker process keeps its own copy. Changes committed by this process are
+applied as they commit; changes committed by other processes are picked up by
+comparing a cheap signature of the subscriptions table (row count and highest
+ID) once per request, and the graph is rebuilt after GRAPH_TTL seconds in any
+case.
+"""
+from __future__ import absolute_import
+
+from array import array
+from bisect import bisect_left
+from flask import current_app, g, has_app_context
+from itertools import chain
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from threading import Lock
+from time import time
+
+from pyaspora.database import db
+from pyaspora.roster.models import Subscription
+
+_lock = Lock()
+_graph = None
+
+
+def _compress(edges, size):
+    """
+    Pack <edges>, a list of (node, neighbour) pairs with nodes below <size>,
+    into CSR arrays (offsets, neighbours): the neighbours of node N are
+    neighbours[offsets[N]:offsets[N + 1]], in ascending order.
+    """
+    edges = sorted(edges)
+    offsets = array('l', [0]) * (size + 1)
+    for node, neighbour in edges:
+        offsets[node + 1] += 1
+    for node in range(size):
+        offsets[node + 1] += offsets[node]
+    return offsets, array('l', (neighbour for node, neighbour in edges))
+
+
+def _row(csr, node):
+    offsets, neighbours = csr
+    if node + 1 >= len(offsets):
+        return neighbours[0:0]
+    return neighbours[offsets[node]:offsets[node + 1]]
+
+
+class SubscriptionGraph(object):
+    """
+    A snapshot of who is subscribed to whom, by Contact ID. Instances are
+    never modified once built, so they can be shared between threads.
+
+    Fields:
+        signature - (number of Subscriptions, highest Subscription ID) in the
+                    database state the graph reflects
+        built_at - when the arrays were built from the database, as a Unix
+                   time
+        added - (from ID, to ID) pairs subscribed since the arrays were built
+        removed - (from ID, to ID) pairs unsubscribed since then
+    """
+    def __init__(self, arrays, signature, built_at, added=frozenset(),
+                 removed=frozenset()):
+        self._forward, self._reverse = arrays
+        self.signature = signature
+        self.built_at = built_at
+        self.added = added
+        self.removed = removed
+
+    @classmethod
+    def build(cls):
+        """
+        Build the graph from the Subscriptions in the database, as seen by
+        the current transaction.
+        """
+        signature = _signature()
+        edges = db.session.query(Subscription.from_id, Subscription.to_id). \
+            all()
+        return cls._from_edges(edges, signature, time())
+
+    @classmethod
+    def current(cls):
+        """
+        The graph as seen by the current transaction, including any
+        Subscriptions it has added or removed but not yet committed.
+        """
+        global _graph
+        session = db.session()
+        pending = chain(session.new, session.deleted)
+        if any(isinstance(obj, Subscription) for obj in pending):
+            session.flush()
+        if session.info.get('graph_stale'):
+            # Bulk changes that can't be tracked; don't share the result
+            return cls.build()
+
+        changes = session.info.get('graph_changes', ())
+        with _lock:
+            graph = _graph
+        if graph is not None and graph.expired():
+            graph = None
+        if graph is not None and changes:
+            graph = graph.updated(changes)
+        if graph is not None and not _checked(graph):
+            if graph.signature != _signature():
+                graph = None
+        if graph is None:
+            graph = cls.build()
+            if not changes:
+                with _lock:
+                    _graph = graph
+        _checked(graph, True)
+        return graph
+
+    def friends(self, contact_id):
+        """
+        The IDs of the Contacts that Contact <contact_id> is subscribed to.
+        """
+        return self._neighbours(self._forward, contact_id, 0)
+
+    def followers(self, contact_id):
+        """
+        The IDs of the Contacts subscribed to Contact <contact_id>.
+        """
+        return self._neighbours(self._reverse, contact_id, 1)
+
+    def followers_of(self, contact_ids):
+        """
+        The IDs of the Contacts subscribed to any of <contact_ids>.
+        """
+        followers = set()
+        for contact_id in contact_ids:
+            followers.update(self.followers(contact_id))
+        return followers
+
+    def mutual(self, contact_id):
+        """
+        The IDs of the Contacts that Contact <contact_id> is subscribed to
+        and who are subscribed to them in return.
+        """
+        return self.friends(contact_id) & self.followers(contact_id)
+
+    def subscribed(self, from_id, to_id):
+        """
+        Whether Contact <from_id> is subscribed to Contact <to_id>.
+        """
+        edge = (from_id, to_id)
+        if edge in self.added:
+            return True
+        if edge in self.removed:
+            return False
+        return self._in_arrays(from_id, to_id)
+
+    def expired(self):
+        ttl = current_app.config.get('GRAPH_TTL', 600)
+        return time() - self.built_at > ttl
+
+    def updated(self, changes):
+        """
+        A copy of this graph with <changes> applied, a list of tuples
+        (subscribed, Subscription ID, from ID, to ID) in the order they were
+        made.
+        """
+        added = set(self.added)
+        removed = set(self.removed)
+        count, highest = self.signature
+        for subscribed, sub_id, from_id, to_id in changes:
+            edge = (from_id, to_id)
+            if subscribed:
+                count += 1
+                highest = max(highest or 0, sub_id)
+                removed.discard(edge)
+                if not self._in_arrays(from_id, to_id):
+                    added.add(edge)
+            else:
+                count -= 1
+                added.discard(edge)
+                if self._in_arrays(from_id, to_id):
+                    removed.add(edge)
+        graph = SubscriptionGraph(
+            (self._forward, self._reverse),
+            (count, highest),
+            self.built_at,
+            frozenset(added),
+            frozenset(removed)
+        )
+        limit = current_app.config.get('GRAPH_OVERLAY_LIMIT', 1000)
+        if len(added) + len(removed) > limit:
+            graph = graph._compacted()
+        return graph
+
+    @classmethod
+    def _from_edges(cls, edges, signature, built_at):
+        size = max(chain((e for edge in edges for e in edge), [-1])) + 1
+        return cls(
+            (
+                _compress(edges, size),
+                _compress([(to_id, from_id) for from_id, to_id in edges], size)
+            ),
+            signature,
+            built_at
+        )
+
+    def _compacted(self):
+        """
+        A copy of this graph with the overlay folded into the arrays.
+        """
+        offsets, neighbours = self._forward
+        edges = [
+            (node, neighbour)
+            for node in range(len(offsets) - 1)
+            for neighbour in neighbours[offsets[node]:offsets[node + 1]]
+            if (node, neighbour) not in self.removed
+        ]
+        edges.extend(self.added)
+        return self._from_edges(edges, self.signature, self.built_at)
+
+    def _in_arrays(self, from_id, to_id):
+        row = _row(self._forward, from_id)
+        index = bisect_left(row, to_id)
+        return index < len(row) and row[index] == to_id
+
+    def _neighbours(self, csr, node, side):
+        found = set(_row(csr, node))
+        for edge in self.removed:
+            if edge[side] == node:
+                found.discard(edge[1 - side])
+        for edge in self.added:
+            if edge[side] == node:
+                found.add(edge[1 - side])
+        return found
+
+
+def _signature():
+    return tuple(db.session.query(
+        func.count(Subscription.id),
+        func.max(Subscription.id)
+    ).one())
+
+
+def _checked(graph, checked=False):
+    """
+    Whether <graph> has already been checked against the database in this
+    request. If <checked> is True, note that it has.
+    """
+    if not has_app_context():
+        return False
+    if checked:
+        g.subscription_graph = graph
+    return getattr(g, 'subscription_graph', None) is graph
+
+
+@event.listens_for(Session, 'after_flush')
+def _note_changes(session, flush_context):
+    changes = [
+        (False, obj.id, obj.from_id, obj.to_id)
+        for obj in session.deleted if isinstance(obj, Subscription)
+    ] + [
+        (True, obj.id, obj.from_id, obj.to_id)
+        for obj in session.new if isinstance(obj, Subscription)
+    ]
+    if changes:
+        session.info.setdefault('graph_changes', []).extend(changes)
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+@event.listens_for(Session, 'after_bulk_update')
+def _note_bulk_changes(context):
+    if context.mapper.class_ is Subscription:
+        context.session.info['graph_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_committed(session):
+    global _graph
+    changes = session.info.pop('graph_changes', None)
+    stale = session.info.pop('graph_stale', None)
+    if not (changes or stale):
+        return
+    with _lock:
+        if stale or _graph is None:
+            _graph = None
+        else:
+            _graph = _graph.updated(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('graph_changes', None)
+    session.info.pop('graph_stale', None)
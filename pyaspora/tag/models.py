@@ -6,9 +6,10 @@ from __future__ import absolute_import
 
 from sqlalchemy import Column, ForeignKey, Integer, String
 from sqlalchemy.orm import joinedload, relationship
-from sqlalchemy.sql import and_, not_
+from sqlalchemy.sql import and_, not_, select
 
-from pyaspora.database import db
+from pyaspora.database import Record, db
+from pyaspora.utils.memo import memoised_for_request
 from pyaspora.utils.models import TagParseMixin
 
 
@@ -51,6 +52,28 @@ class PostTag(db.Model):
             options(joinedload(cls.tag)). \
             filter(cls.post_id.in_(post_ids))
 
+    @classmethod
+    def records_for_posts(cls, post_ids):
+        """
+        (post ID, TagRecord) pairs for the Tags of the Posts with IDs
+        <post_ids>, read without loading any model objects.
+        """
+        if not post_ids:
+            return []
+        rows = db.session.execute(
+            select([cls.post_id, Tag.id, Tag.name]).
+            select_from(cls.__table__.join(Tag.__table__)).
+            where(cls.post_id.in_(post_ids))
+        )
+        return ((row[0], TagRecord(*row[1:])) for row in rows)
+
+
+class TagRecord(Record):
+    """
+    The columns of a Tag that json_tag() shows.
+    """
+    __slots__ = ('id', 'name')
+
 
 class Tag(TagParseMixin, db.Model):
     '''
@@ -88,6 +111,7 @@ class Tag(TagParseMixin, db.Model):
             )
 
     @classmethod
+    @memoised_for_request
     def get_by_name(cls, name, create=True):
         """
         Look up a Tag by textual name. If create is true (the default) a new
@@ -9,6 +9,9 @@ Display the feed of posts about a particular Tag topic.
 
 {% if feed %}
     {{show_feed(feed)}}
+    {% if actions.more %}
+        {{button_form(actions.more, 'View older items', method='get')}}
+    {% endif %}
 {% else %}
     <p>No posts for this topic.</p>
 {% endif %}
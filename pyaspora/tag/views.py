@@ -9,6 +9,8 @@ from sqlalchemy.sql import desc
 from pyaspora.database import db
 from pyaspora.tag.models import PostTag, Tag
 from pyaspora.user.session import require_logged_in_user
+from pyaspora.utils.pagination import more_link, page_size, paginate, \
+    request_cursor
 from pyaspora.utils.rendering import abort, add_logged_in_user_to_data, \
     render_response
 
@@ -42,16 +44,27 @@ def feed(tag_name, _user):
 
     data = json_tag(tag)
 
-    posts = db.session.query(Post). \
+    query = db.session.query(Post). \
         join(PostTag). \
         join(Tag). \
         join(Share). \
         filter(Tag.Queries.public_posts_for_tags([tag.id])). \
-        order_by(desc(Post.thread_modified_at)). \
-        group_by(Post.id). \
-        limit(100)
+        order_by(desc(Post.thread_modified_at), desc(Post.id)). \
+        group_by(Post.id)
+    cursor = request_cursor()
+    if cursor:
+        query = query.filter(Post.Queries.older_than(cursor))
+    posts, next_cursor = paginate(
+        query,
+        page_size(),
+        lambda p: (p.thread_modified_at, p.id)
+    )
 
     data['feed'] = json_posts([(p, None) for p in posts])
+    data['next'] = next_cursor
+    data['actions'] = {
+        'more': more_link('tags.feed', next_cursor, tag_name=tag.name)
+    }
 
     add_logged_in_user_to_data(data, _user)
 
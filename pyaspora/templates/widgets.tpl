@@ -89,6 +89,9 @@ Standard widgets
             {% endfor %}
         </span>
     {% endif %}
+    {% if post.likes %}
+        - <span class="likes">liked by {{post.likes}}</span>
+    {% endif %}
     <p>
 
     {% if post.actions.comment %}
@@ -100,7 +103,15 @@ Standard widgets
     {% if post.actions.hide %}
         {{button_form(post.actions.hide,'Hide')}}
     {% endif %}
+    {% if post.liked and post.actions.unlike %}
+        {{button_form(post.actions.unlike,'Unlike')}}
+    {% elif post.actions.like %}
+        {{button_form(post.actions.like,'Like')}}
+    {% endif %}
 
+    {% if post.actions.older_replies %}
+        {{button_form(post.actions.older_replies, 'View earlier replies (%d in all)' % post.replies, method='get')}}
+    {% endif %}
     {% if post.children %}
         {{ loop(post.children) }}
     {% endif %}
@@ -7,11 +7,13 @@ from Crypto.PublicKey import RSA
 from datetime import datetime, timedelta
 from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
 from sqlalchemy.orm import backref, joinedload, relationship
+from sqlalchemy.sql import and_
 from sqlalchemy.sql.expression import func
 
 from pyaspora.contact.models import Contact
-from pyaspora.database import db
+from pyaspora.database import db, in_chunks
 from pyaspora.utils.email import send_template
+from pyaspora.utils.memo import memoised_for_request
 
 
 class User(db.Model):
@@ -36,7 +38,8 @@ class User(db.Model):
     id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, nullable=False)
     private_key = Column(String, nullable=False)
-    contact_id = Column(Integer, ForeignKey('contacts.id'), nullable=False)
+    contact_id = Column(Integer, ForeignKey('contacts.id'), nullable=False,
+                        index=True)
     activated = Column(DateTime(timezone=True), nullable=True, default=None)
     notification_hours = Column(Integer, nullable=True, default=None)
     last_notified = Column(DateTime(timezone=True), nullable=True,
@@ -46,6 +49,7 @@ class User(db.Model):
                            backref=backref('user', uselist=False))
 
     @classmethod
+    @memoised_for_request
     def get(cls, user_id):
         """
         Get a user by primary key ID. Returns None if the user cannot be found.
@@ -72,6 +76,25 @@ class User(db.Model):
         self.contact = contact
         db.session.add(self)
 
+    @classmethod
+    def notify_contacts(cls, contact_ids):
+        """
+        Call notify_event() for the local Users whose Contact IDs are in
+        <contact_ids>, fetching only those who want notifications in one go.
+        The caller must commit the session.
+        """
+        users = in_chunks(
+            lambda ids: db.session.query(cls).filter(and_(
+                cls.contact_id.in_(ids),
+                cls.activated != None,
+                cls.notification_hours != None,
+                cls.notification_hours != 0
+            )),
+            contact_ids
+        )
+        for user in users:
+            user.notify_event(commit=False)
+
     def notify_event(self, commit=True):
         """
         Let the user know that there are new things for them to view, according
@@ -142,3 +165,5 @@ class User(db.Model):
             format='PEM',
             pkcs=1
         ).decode("ascii")
+        if self.contact.id:
+            self.contact.profile_changed()
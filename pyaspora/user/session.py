@@ -10,6 +10,7 @@ from Crypto.PublicKey import RSA
 from flask import current_app, session
 
 from pyaspora.user.models import User
+from pyaspora.utils.memo import request_memo
 from pyaspora.utils.rendering import abort
 
 
@@ -26,12 +27,18 @@ def logged_in_user(fetch=True):
     if not private_key:
         return None
 
-    try:
-        unlocked_key = RSA.importKey(
-            private_key,
-            passphrase=current_app.secret_key
-        )
-    except (ValueError, IndexError, TypeError):
+    # Unlocking the key is slow, so only do it once per request
+    unlocked_keys = request_memo('unlocked_keys', database=False)
+    if private_key not in unlocked_keys:
+        try:
+            unlocked_keys[private_key] = RSA.importKey(
+                private_key,
+                passphrase=current_app.secret_key
+            )
+        except (ValueError, IndexError, TypeError):
+            unlocked_keys[private_key] = None
+    unlocked_key = unlocked_keys[private_key]
+    if not unlocked_key:
         return None
 
     if not fetch:
@@ -83,6 +83,7 @@ def create():
     """
     Create a new User (sign-up).
     """
+    from pyaspora.diaspora.models import DiasporaContact
     if not _can_create_account():
         abort(403, 'Disabled by site administrator')
 
@@ -101,6 +102,7 @@ def create():
     my_user.contact.realname = name
     my_user.generate_keypair(password)
     db.session.commit()
+    DiasporaContact.get_for_contact(my_user.contact)
 
     send_template(my_user.email, 'user_activate_email.tpl', {
         'link': url_for(
@@ -188,6 +190,7 @@ def edit(_user):
     as the profile photo and bio, the email address, name, password and
     interests.
     """
+    from pyaspora.diaspora.models import DiasporaPost
     from pyaspora.post.models import Post
 
     p = Post(author=_user.contact)
@@ -281,9 +284,13 @@ def edit(_user):
     if changed:
         db.session.add(p)
         db.session.add(_user.contact)
+        DiasporaPost.get_for_post(p, commit=False)
         p.share_with([_user.contact])
         p.thread_modified()
 
+    if 'name' in changed or 'avatar' in changed:
+        _user.contact.profile_changed()
+
     db.session.commit()
 
     return redirect(url_for('contacts.profile', contact_id=_user.contact.id))
@@ -0,0 +1,146 @@
+"""
+An in-process cache of serialised responses, for documents that other nodes
+fetch far more often than they change. Each entry carries a set of tags, and
+invalidate() drops every entry carrying a given tag.
+
+Each worker process keeps its own cache and invalidation only reaches the
+process that made the change, so entries also expire after
+RESPONSE_CACHE_TTL seconds to bound staleness across workers.
+"""
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from flask import current_app, request
+from hashlib import sha1
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from threading import Lock
+from time import time
+
+from pyaspora.database import db
+
+_lock = Lock()
+_entries = OrderedDict()
+_tags = {}
+
+
+class CachedResponse(object):
+    """
+    A serialised response held in the cache.
+
+    Fields:
+        body - the response body, as bytes
+        content_type - the Content-Type header to send
+        etag - a strong ETag derived from the body
+        last_modified - when the body was generated, as a Unix time
+        tags - tags that invalidate this entry
+    """
+    def __init__(self, body, content_type, tags):
+        self.body = body
+        self.content_type = content_type
+        self.etag = sha1(body).hexdigest()
+        self.last_modified = int(time())
+        self.tags = frozenset(tags)
+
+    def expired(self):
+        ttl = current_app.config.get('RESPONSE_CACHE_TTL', 300)
+        return time() - self.last_modified > ttl
+
+    def to_response(self):
+        """
+        Build a Flask response from the entry, answering conditional requests
+        with a 304 where the client's copy is current.
+        """
+        response = current_app.response_class(self.body)
+        response.headers['Content-Type'] = self.content_type
+        response.set_etag(self.etag)
+        response.last_modified = self.last_modified
+        return response.make_conditional(request)
+
+
+def cached_response(key, builder):
+    """
+    Return the response cached under <key> (scoped to the URL root the request
+    came in on, as documents embed external URLs). On a miss <builder> is
+    called with no arguments and must return a tuple (response, tags); the
+    response body is cached unless the response is an error.
+    """
+    key = (request.url_root,) + tuple(key)
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            if entry.expired():
+                _drop(key)
+                entry = None
+            else:
+                _entries[key] = _entries.pop(key)  # Recently used
+
+    if entry is None:
+        response, tags = builder()
+        if response.status_code != 200:
+            return response
+        entry = CachedResponse(
+            response.get_data(),
+            response.headers['Content-Type'],
+            tags
+        )
+        _store(key, entry)
+
+    return entry.to_response()
+
+
+def invalidate(*tags):
+    """
+    Drop all entries carrying any of <tags>.
+    """
+    with _lock:
+        for tag in tags:
+            for key in list(_tags.get(tag, ())):
+                _drop(key)
+
+
+def invalidate_on_commit(*tags):
+    """
+    Drop all entries carrying any of <tags> once the current database
+    transaction commits, so that a request running in the meantime can't
+    cache the old state again.
+    """
+    db.session().info.setdefault('invalidate_tags', set()).update(tags)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    tags = session.info.pop('invalidate_tags', None)
+    if tags:
+        invalidate(*tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_rolled_back(session):
+    session.info.pop('invalidate_tags', None)
+
+
+def _store(key, entry):
+    limit = current_app.config.get('RESPONSE_CACHE_ENTRIES', 1000)
+    with _lock:
+        _drop(key)
+        _entries[key] = entry
+        for tag in entry.tags:
+            _tags.setdefault(tag, set()).add(key)
+        while len(_entries) > limit:
+            _drop(next(iter(_entries)))
+
+
+def _drop(key):
+    """
+    Remove <key> from the cache. The caller must hold _lock.
+    """
+    entry = _entries.pop(key, None)
+    if entry is None:
+        return
+    for tag in entry.tags:
+        keys = _tags.get(tag)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del _tags[tag]
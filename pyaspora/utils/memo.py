@@ -0,0 +1,100 @@
+"""
+Memoisation of lookups for the length of one request. Model helpers that are
+called repeatedly with the same arguments while a page is built (the logged
+in User, Contacts by ID, subscription checks, Tags by name) keep their answers
+here rather than asking the database again.
+
+Memos live on flask.g and are cleared when the request is torn down. Memos of
+database lookups are also cleared whenever the session writes changes or
+rolls back, so a request never sees a stale answer to its own changes.
+"""
+from __future__ import absolute_import
+
+from flask import g, has_app_context
+from functools import wraps
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from pyaspora.database import Record, db
+
+
+def request_memo(name, database=True):
+    """
+    The memo dictionary <name> for this request, or an empty throwaway
+    dictionary outside of a request. If <database> is True the memo holds the
+    results of database lookups, and is cleared when the session writes.
+    """
+    if not has_app_context():
+        return {}
+    attr = 'database_memos' if database else 'memos'
+    memos = getattr(g, attr, None)
+    if memos is None:
+        memos = {}
+        setattr(g, attr, memos)
+    return memos.setdefault(name, {})
+
+
+def memoised_for_request(fn):
+    """
+    Decorator for a database lookup whose answer depends only on its
+    arguments, so that later calls with the same arguments in the same
+    request return the first answer. Model objects and Records are matched
+    by their IDs, so the lookup must only use the IDs of these. Goes beneath
+    @classmethod.
+    """
+    name = '{0}.{1}'.format(fn.__module__, fn.__name__)
+
+    @wraps(fn)
+    def _inner(*args, **kwargs):
+        # Flush as a query would, so stale answers are dropped first
+        session = db.session()
+        if session.autoflush:
+            session.flush()
+        try:
+            key = tuple(_memo_key(arg) for arg in args) + tuple(
+                (k, _memo_key(v)) for k, v in sorted(kwargs.items()))
+            memo = request_memo(name)
+            if key in memo:
+                return memo[key]
+        except TypeError:  # Unhashable argument
+            return fn(*args, **kwargs)
+        memo[key] = result = fn(*args, **kwargs)
+        return result
+    return _inner
+
+
+def _memo_key(value):
+    """
+    How <value> is told apart in a memo: model objects and Records by their
+    ID, so that a Record matches the object it was read from, and anything
+    else (including an object not yet given an ID) as itself.
+    """
+    if isinstance(value, (db.Model, Record)):
+        object_id = getattr(value, 'id', None)
+        if object_id is not None:
+            return object_id
+    return value
+
+
+def forget_request_memos(exception=None):
+    """
+    Drop all of this request's memos. Registered to run at request teardown.
+    """
+    if has_app_context():
+        g.database_memos = None
+        g.memos = None
+
+
+def _forget_database_memos():
+    if has_app_context():
+        g.database_memos = None
+
+
+@event.listens_for(Session, 'after_flush')
+def _flushed(session, flush_context):
+    _forget_database_memos()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _rolled_back(session):
+    _forget_database_memos()
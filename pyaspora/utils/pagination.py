@@ -0,0 +1,104 @@
+"""
+Keyset ("cursor") pagination for feeds, which are sorted newest thread first
+by (thread_modified_at, post ID). Each page is selected relative to the last
+item of the previous page rather than by offset, so later pages cost the same
+as the first.
+"""
+from __future__ import absolute_import
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from dateutil.parser import parse as parse_datetime
+from flask import current_app, request, url_for
+from sqlalchemy.sql import and_, func, or_
+
+from pyaspora.utils.rendering import abort
+
+
+def page_size(default=10):
+    """
+    The number of items the client asked for in the "limit" query parameter,
+    capped at MAX_PAGE_SIZE.
+    """
+    try:
+        size = int(request.args.get('limit', default))
+    except ValueError:
+        abort(400, 'Invalid limit')
+    if size < 1:
+        abort(400, 'Invalid limit')
+    return min(size, current_app.config.get('MAX_PAGE_SIZE', 50))
+
+
+def encode_cursor(when, item_id):
+    """
+    An opaque cursor for an item sorted at DateTime <when> with ID <item_id>.
+    """
+    raw = u'{0}|{1}'.format(when.isoformat() if when else '', item_id)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def request_cursor():
+    """
+    The cursor the client sent in the "before" query parameter, as a tuple of
+    (DateTime, item ID), or None if there isn't one.
+    """
+    cursor = request.args.get('before', None)
+    if not cursor:
+        return None
+    try:
+        when, item_id = urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8').split('|')
+        return (parse_datetime(when) if when else None, int(item_id))
+    except (TypeError, ValueError):
+        abort(400, 'Invalid cursor')
+
+
+def older_than(cursor, sort_col, id_col, anchor):
+    """
+    A filter clause for items that come after <cursor> in a newest-first
+    sort on (<sort_col>, <id_col>). <anchor> is a query for the sort value of
+    the cursor's item as stored (it is not correlated with the outer query),
+    which is compared in preference to the time in the cursor as some
+    databases (SQLite) store times in a form that doesn't compare equal to a
+    bound parameter. The time in the cursor still applies in case the item
+    has moved up since.
+    """
+    when, item_id = cursor
+    if when is None:
+        return and_(sort_col == None, id_col < item_id)
+    anchor = func.coalesce(
+        anchor.statement.correlate(None).as_scalar(),
+        when
+    )
+    return and_(
+        or_(
+            sort_col < anchor,
+            and_(sort_col == anchor, id_col < item_id)
+        ),
+        sort_col <= when
+    )
+
+
+def paginate(query, size, key):
+    """
+    Run <query>, which must already be sorted and filtered by the cursor,
+    for a page of <size> items. Returns the items and the cursor for the next
+    page (None if this is the last page). <key> gives the (DateTime, ID) sort
+    key of an item.
+    """
+    items = query.limit(size + 1).all()
+    if len(items) <= size:
+        return items, None
+    items = items[:size]
+    return items, encode_cursor(*key(items[-1]))
+
+
+def more_link(endpoint, cursor, **kwargs):
+    """
+    The URL of the page after this one, or None if there isn't one.
+    """
+    if not cursor:
+        return None
+    if 'limit' in request.args:
+        kwargs['limit'] = page_size()
+    kwargs.setdefault('alt', request.args.get('alt', None))
+    return url_for(endpoint, before=cursor, _external=True, **kwargs)
@@ -26,9 +26,37 @@ app.config['ALLOW_INSECURE_COMPAT'] = False
 
 # On/off features
 app.config['FEATURES'] = {
-    'gravatar': False  # Use Gravatars for users with no profile picture
+    'gravatar': False,  # Use Gravatars for users with no profile picture
+    'lazy_remote_media': False,  # Only download remote photos when viewed
+    'timelines': False,  # Store each user's feed; visit /setup after enabling
 }
 
+# Number of items kept in each user's stored feed
+app.config['TIMELINE_LENGTH'] = 1000
+
+# Longest literal list of IDs put in one "IN (...)" clause
+app.config['IN_LIST_LIMIT'] = 500
+
+# Largest number of items a client may ask for in one page of a feed
+app.config['MAX_PAGE_SIZE'] = 50
+
+# Number of the newest replies shown under each post in feeds
+app.config['REPLY_WINDOW'] = 3
+
+# Where lazily-fetched remote media is cached, and the limits on fetching it
+app.config['REMOTE_MEDIA_CACHE'] = '/tmp/pyaspora-media'
+app.config['REMOTE_MEDIA_CACHE_SIZE'] = 256 * 1024 * 1024  # bytes
+app.config['REMOTE_MEDIA_MAX_SIZE'] = 5 * 1024 * 1024  # bytes, per item
+app.config['REMOTE_MEDIA_CONCURRENCY'] = 4  # simultaneous downloads
+
+# Cache of documents served to other nodes (webfinger, hCard, public feeds)
+app.config['RESPONSE_CACHE_ENTRIES'] = 1000
+app.config['RESPONSE_CACHE_TTL'] = 300  # seconds, bounds staleness per worker
+
+# In-process index of who is subscribed to whom
+app.config['GRAPH_TTL'] = 600  # seconds, bounds staleness per worker
+app.config['GRAPH_OVERLAY_LIMIT'] = 1000  # changes kept before repacking
+
 assert app.secret_key, \
     'You need to edit quickstart.py to configure the application'
 
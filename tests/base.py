@@ -0,0 +1,84 @@
+"""
+Shared set-up for tests: a fresh SQLite database for each test, with two
+local users (Alice and Bob) who are friends, and test clients logged in as
+each of them.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyaspora import app, init_db
+from pyaspora.database import db
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        from pyaspora.roster import graph
+        from pyaspora.utils import cache
+
+        self.tmp_dir = tempfile.mkdtemp()
+        app.config.update({
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///{0}'.format(
+                os.path.join(self.tmp_dir, 'test.sqlite')),
+            'TESTING': True,
+            'SMTP_URL': None,
+            'FEATURES': {},
+        })
+        app.secret_key = 'test'
+        # In-process state belongs to the previous test's database
+        graph._graph = None
+        cache._entries.clear()
+        cache._tags.clear()
+
+        self.context = app.test_request_context('http://localhost/')
+        self.context.push()
+        init_db()
+        self.alice = self.make_user('Alice', 'alice@example.com')
+        self.bob = self.make_user('Bob', 'bob@example.com')
+        self.alice.contact.subscribe(self.bob.contact)
+        self.bob.contact.subscribe(self.alice.contact)
+        db.session.commit()
+        self.alice_id, self.bob_id = self.alice.id, self.bob.id
+
+        self.as_alice = self.client_for('alice@example.com')
+        self.as_bob = self.client_for('bob@example.com')
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(app).dispose()
+        self.context.pop()
+        shutil.rmtree(self.tmp_dir)
+
+    def make_user(self, name, email):
+        from pyaspora.user.models import User
+        user = User()
+        user.email = email
+        user.contact.realname = name
+        user.generate_keypair('password')
+        user.activate()
+        db.session.commit()
+        return user
+
+    def client_for(self, email):
+        client = app.test_client()
+        resp = client.post('/users/login', data={
+            'email': email,
+            'password': 'password'
+        })
+        self.assertIn(resp.status_code, (200, 302))
+        return client
+
+    def get_json(self, client, url):
+        resp = client.get(url + ('&' if '?' in url else '?') + 'alt=json')
+        self.assertEqual(resp.status_code, 200, resp.data)
+        return json.loads(resp.data.decode('utf-8'))
+
+    def create_post(self, client, body, **fields):
+        fields.setdefault('target_type', 'all_friends')
+        fields['body'] = body
+        resp = client.post('/posts/create', data=fields)
+        self.assertEqual(resp.status_code, 302, resp.data)
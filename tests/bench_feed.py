@@ -0,0 +1,65 @@
+"""
+Benchmark the first page of the computed home feed against the OR query it
+replaced, on seeded SQLite nodes of growing size. The viewer and their posts
+stay the same; only the Shares made by everybody else grow. Run from the top
+of the tree with the extra Share counts to try:
+
+    python -m tests.bench_feed 0 10000 50000
+"""
+from __future__ import absolute_import, print_function
+
+import sys
+import timeit
+
+from pyaspora.database import db
+from pyaspora.feed.models import TimelineEntry
+from tests.base import AppTestCase
+from tests.seed import seed_node
+from tests.test_computed_feed import or_query_feed
+
+PAGE_SIZE = 20
+RUNS = 20
+
+
+class FeedBenchmark(AppTestCase):
+    extra_shares = 0
+
+    def runTest(self):
+        seed_node(self.alice.contact.id, self.bob.contact.id + 1,
+                  extra_shares=self.extra_shares)
+        db.session.commit()
+        shares = db.session.execute('SELECT count(*) FROM shares').scalar()
+
+        timings = []
+        for feed in (or_query_feed, TimelineEntry.computed_feed):
+            query = feed(self.alice, limit=PAGE_SIZE + 1)
+            statement = query.statement
+            timings.append(self.best(
+                lambda: db.session.execute(statement).fetchall()))
+            timings.append(self.best(
+                lambda: feed(self.alice, limit=PAGE_SIZE + 1).all()))
+        print('{0:>8,}  {1:7.1f} ms  {3:7.1f} ms  {2:7.1f} ms / {4:5.1f} ms'.
+              format(shares, *timings))
+
+    def best(self, fn):
+        """
+        The fastest of RUNS calls to <fn>, in milliseconds.
+        """
+        db.session.expunge_all()
+        return min(timeit.repeat(fn, number=1, repeat=RUNS)) * 1000
+
+
+def main(sizes):
+    print('  shares  SQL before  SQL after   query().all() before/after')
+    for extra_shares in sizes:
+        case = FeedBenchmark()
+        case.extra_shares = extra_shares
+        case.setUp()
+        try:
+            case.runTest()
+        finally:
+            case.tearDown()
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [0, 10000, 50000])
@@ -0,0 +1,105 @@
+"""
+Fill the test database with a node's worth of Contacts, subscriptions,
+interests, Posts (about 40% of them replies), Shares and PostTags, as seen by
+one local Contact, for the query-plan tests, the feed tests and the feed
+benchmark.
+"""
+from __future__ import absolute_import
+
+import random
+from datetime import datetime, timedelta
+
+from pyaspora.database import db
+
+CONTACTS = 300
+POSTS = 3000
+TAGS = 300
+
+
+def seed_node(me, first_contact, contacts=CONTACTS, posts=POSTS,
+              extra_shares=0, rand=None):
+    """
+    Seed <contacts> remote Contacts, with IDs from <first_contact>, and
+    <posts> Posts by them. Contact ID <me> follows the first 100 and five
+    tags, and is sent a fifth of the Posts. <extra_shares> more Shares of
+    random Posts, by the Contacts <me> doesn't follow, grow the node while
+    leaving <me>'s own rows much the same. Returns the list of Contact IDs
+    and the (post ID, tag ID) pair of each Post. The caller must commit the
+    session.
+    """
+    rand = rand or random.Random(47)
+    conn = db.session.connection()
+    contact_ids = list(range(first_contact, first_contact + contacts))
+    conn.execute(
+        'INSERT INTO contacts (id, realname, public_key) '
+        'VALUES (?, ?, ?)',
+        [(c, 'Contact {0}'.format(c), 'key') for c in contact_ids]
+    )
+    conn.execute(
+        'INSERT INTO diaspora_contacts (contact_id, guid, username, '
+        'server) VALUES (?, ?, ?, ?)',
+        [
+            (c, 'guid{0}'.format(c), 'c{0}@node{1}.example'.format(
+                c, c % 7), 'https://node{0}.example/'.format(c % 7))
+            for c in contact_ids
+        ]
+    )
+    subscriptions = set((me, c) for c in contact_ids[:100])
+    for c in contact_ids:
+        for friend in rand.sample(contact_ids, 5):
+            if friend != c:
+                subscriptions.add((c, friend))
+    conn.execute(
+        'INSERT INTO subscriptions (from_id, to_id) VALUES (?, ?)',
+        list(subscriptions)
+    )
+    conn.execute(
+        'INSERT INTO tags (id, name) VALUES (?, ?)',
+        [(1000 + t, 'topic{0}'.format(t)) for t in range(TAGS)]
+    )
+    conn.execute(
+        'INSERT INTO interests (contact_id, tag_id) VALUES (?, ?)',
+        [(me, 1000 + t) for t in range(5)]
+    )
+
+    start = datetime(2020, 1, 1)
+    post_rows, shares, tags = [], [], []
+    roots = {}
+    first_post = 1000
+    for n in range(posts):
+        post_id = first_post + n
+        parent = root = None
+        if n > 100 and rand.random() < 0.4:
+            parent = first_post + rand.randint(0, n - 1)
+            root = roots[parent] or parent
+        roots[post_id] = root
+        when = start + timedelta(minutes=n)
+        author = rand.choice(contact_ids)
+        public = rand.random() < 0.5
+        post_rows.append((post_id, author, parent, root, when,
+                          None if parent else when, public))
+        shares.append((author, post_id, public, False, when))
+        if rand.random() < 0.2:
+            shares.append((me, post_id, False, rand.random() < 0.1, when))
+        tags.append((post_id, 1000 + rand.randint(0, TAGS - 1)))
+    for n in range(extra_shares):
+        post = rand.choice(post_rows)
+        shares.append((rand.choice(contact_ids[100:]), post[0], post[6],
+                       False, post[4]))
+    conn.execute(
+        'INSERT INTO posts (id, author_id, parent_id, root_id, '
+        'created_at, thread_modified_at, is_public) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        post_rows
+    )
+    conn.execute(
+        'INSERT OR IGNORE INTO shares (contact_id, post_id, public, '
+        'hidden, shared_at) VALUES (?, ?, ?, ?, ?)',
+        shares
+    )
+    conn.execute(
+        'INSERT OR IGNORE INTO post_tags (post_id, tag_id) '
+        'VALUES (?, ?)',
+        tags
+    )
+    return contact_ids, tags
@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+
+from sqlalchemy import event
+
+from pyaspora import init_db
+from pyaspora.database import db
+from pyaspora.post.models import AudienceList, AudienceMember, PostAudience
+from tests.base import AppTestCase
+
+
+class AudienceListTest(AppTestCase):
+    def test_same_members_same_list(self):
+        first = AudienceList.for_contacts([self.alice.contact.id,
+                                           self.bob.contact.id])
+        second = AudienceList.for_contacts([self.bob.contact.id,
+                                            self.alice.contact.id])
+        db.session.commit()
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(db.session.query(AudienceMember).filter(
+            AudienceMember.audience_id == first.id).count(), 2)
+
+    def test_list_made_by_another_request(self):
+        engine = db.get_engine(db.get_app())
+        raced = []
+
+        def race(conn, cursor, statement, parameters, context, many):
+            if 'INTO audience_lists' in statement and not raced:
+                raced.append(None)
+                other = engine.connect()
+                raced[0] = other.execute(
+                    AudienceList.__table__.insert().values(
+                        digest=parameters[0])
+                ).inserted_primary_key[0]
+                other.close()
+
+        event.listen(engine, 'before_cursor_execute', race)
+        try:
+            audience = AudienceList.for_contacts([self.bob.contact.id])
+            db.session.commit()
+        finally:
+            event.remove(engine, 'before_cursor_execute', race)
+        self.assertEqual(audience.id, raced[0])
+        self.assertEqual(db.session.query(AudienceList).count(), 1)
+
+    def test_duplicates_merged(self):
+        db.session.execute('DROP INDEX ix_audience_lists_digest_unique')
+        db.session.execute(
+            "INSERT INTO audience_lists (id, digest) VALUES "
+            "(1, 'same'), (2, 'same'), (3, 'same'), (4, 'other')")
+        db.session.execute(
+            'INSERT INTO audience_members (audience_id, contact_id) VALUES '
+            '(1, 10), (2, 10), (3, 10), (4, 11)')
+        db.session.execute(
+            'INSERT INTO post_audiences (post_id, audience_id, shared_at) '
+            'VALUES (100, 1, CURRENT_TIMESTAMP), (101, 2, CURRENT_TIMESTAMP),'
+            ' (100, 3, CURRENT_TIMESTAMP), (102, 4, CURRENT_TIMESTAMP)')
+        db.session.commit()
+
+        init_db()
+
+        self.assertEqual(
+            sorted(db.session.query(AudienceList.id, AudienceList.digest)),
+            [(1, 'same'), (4, 'other')]
+        )
+        self.assertEqual(
+            sorted(db.session.query(AudienceMember.audience_id,
+                                    AudienceMember.contact_id)),
+            [(1, 10), (4, 11)]
+        )
+        self.assertEqual(
+            sorted(db.session.query(PostAudience.post_id,
+                                    PostAudience.audience_id)),
+            [(100, 1), (101, 1), (102, 4)]
+        )
+        indexes = [row[0] for row in db.session.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn('ix_audience_lists_digest_unique', indexes)
@@ -0,0 +1,92 @@
+"""
+TimelineEntry.computed_feed() builds the home feed from a UNION of one query
+per way into it. These tests check it against the single OR query it
+replaced, on a seeded node.
+"""
+from __future__ import absolute_import
+
+from datetime import datetime
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import and_, desc, not_, or_
+
+from pyaspora.database import db
+from pyaspora.feed.models import TimelineEntry
+from pyaspora.post.models import Post, Share
+from pyaspora.roster.models import Subscription
+from pyaspora.tag.models import Interest, PostTag, Tag
+from tests.base import AppTestCase
+from tests.seed import seed_node
+
+
+def or_query_feed(user, cursor=None, since=None, limit=None):
+    """
+    <user>'s feed worked out as it was before the UNION: one query ORing the
+    ways into the feed, over every Share on the node.
+    """
+    friend_ids = db.session.query(Subscription.to_id). \
+        filter(Subscription.from_id == user.contact.id)
+    tag_ids = db.session.query(Interest.tag_id). \
+        filter(Interest.contact_id == user.contact.id)
+    feed_query = or_(
+        Post.Queries.shared_with_contact(user.contact),
+        Post.Queries.authored_by_contacts_and_public(friend_ids),
+        Tag.Queries.public_posts_for_tags(tag_ids)
+    )
+    my_share = aliased(Share)
+    query = db.session.query(Post).join(Share, Share.post_id == Post.id). \
+        outerjoin(my_share, and_(
+            Post.id == my_share.post_id,
+            my_share.contact_id == user.contact.id
+        )). \
+        outerjoin(PostTag).outerjoin(Tag). \
+        filter(feed_query). \
+        filter(or_(my_share.hidden == None, not_(my_share.hidden))). \
+        filter(Post.parent_id == None)
+    if cursor:
+        query = query.filter(Post.Queries.older_than(cursor))
+    if since is not None:
+        query = query.filter(or_(
+            Post.thread_modified_at > since,
+            Share.shared_at > since
+        ))
+    return query. \
+        order_by(desc(Post.thread_modified_at), desc(Post.id)). \
+        group_by(Post.id). \
+        limit(limit)
+
+
+class ComputedFeedTest(AppTestCase):
+    def setUp(self):
+        super(ComputedFeedTest, self).setUp()
+        seed_node(self.alice.contact.id, self.bob.contact.id + 1,
+                  contacts=150, posts=1000, extra_shares=2000)
+        db.session.commit()
+
+    def assertSameFeed(self, user, **kwargs):
+        expected = [p.id for p in or_query_feed(user, **kwargs)]
+        self.assertTrue(expected)
+        self.assertEqual(
+            [p.id for p in TimelineEntry.computed_feed(user, **kwargs)],
+            expected
+        )
+        return expected
+
+    def test_whole_feed(self):
+        for user in (self.alice, self.bob):
+            self.assertSameFeed(user)
+
+    def test_pages(self):
+        cursor = None
+        for page in range(5):
+            ids = self.assertSameFeed(self.alice, cursor=cursor, limit=20)
+            last = Post.get(ids[-1])
+            cursor = (last.thread_modified_at, last.id)
+
+    def test_since(self):
+        self.assertSameFeed(self.alice, since=datetime(2020, 1, 1, 12),
+                            limit=50)
+
+    def test_feed_page(self):
+        expected = [p.id for p in or_query_feed(self.alice, limit=20)]
+        feed = self.get_json(self.as_alice, '/feed/?limit=20')['feed']
+        self.assertEqual([p['id'] for p in feed], expected)
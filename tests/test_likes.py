@@ -0,0 +1,58 @@
+from __future__ import absolute_import
+
+from sqlalchemy import event
+
+from pyaspora.database import db
+from pyaspora.post.models import Post, PostLike
+from tests.base import AppTestCase
+
+
+class LikeTest(AppTestCase):
+    def setUp(self):
+        super(LikeTest, self).setUp()
+        self.create_post(self.as_alice, 'like me')
+        self.post_id = self.get_json(self.as_bob, '/feed/')['feed'][0]['id']
+
+    def like_count(self):
+        db.session.expire_all()
+        return Post.get(self.post_id).like_count
+
+    def test_like_and_unlike(self):
+        url = '/posts/{0}/like'.format(self.post_id)
+        for attempt in range(2):
+            self.assertEqual(self.as_bob.post(url).status_code, 302)
+        self.assertEqual(self.like_count(), 1)
+
+        url = '/posts/{0}/unlike'.format(self.post_id)
+        for attempt in range(2):
+            self.assertEqual(self.as_bob.post(url).status_code, 302)
+        self.assertEqual(self.like_count(), 0)
+
+    def test_like_recorded_by_another_request(self):
+        engine = db.get_engine(db.get_app())
+        raced = []
+
+        def race(conn, cursor, statement, parameters, context, many):
+            if 'INTO post_likes' in statement and not raced:
+                raced.append(None)
+                other = engine.connect()
+                other.execute(PostLike.__table__.insert().values(
+                    post_id=self.post_id,
+                    contact_id=self.bob.contact.id
+                ))
+                posts = Post.__table__
+                other.execute(posts.update().
+                              where(posts.c.id == self.post_id).
+                              values(like_count=posts.c.like_count + 1))
+                other.close()
+
+        post = Post.get(self.post_id)
+        event.listen(engine, 'before_cursor_execute', race)
+        try:
+            self.assertFalse(post.like(self.bob.contact))
+            db.session.commit()
+        finally:
+            event.remove(engine, 'before_cursor_execute', race)
+        self.assertTrue(raced)
+        self.assertEqual(self.like_count(), 1)
+        self.assertEqual(db.session.query(PostLike).count(), 1)
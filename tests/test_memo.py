@@ -0,0 +1,44 @@
+from __future__ import absolute_import
+
+from sqlalchemy import event
+
+from pyaspora.contact.models import Contact
+from pyaspora.database import db
+from tests.base import AppTestCase
+
+
+class MemoTest(AppTestCase):
+    def count_queries(self, fn):
+        statements = []
+
+        def collect(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        engine = db.get_engine(db.get_app())
+        event.listen(engine, 'before_cursor_execute', collect)
+        try:
+            fn()
+        finally:
+            event.remove(engine, 'before_cursor_execute', collect)
+        return len(statements)
+
+    def test_record_matches_object(self):
+        alice = self.alice.contact
+        bob_record = list(Contact.get_many_records([self.bob.contact.id]))[0]
+        results = []
+
+        def lookups():
+            results.append(alice.subscribed_to(bob_record))
+            results.append(alice.subscribed_to(self.bob.contact))
+
+        self.assertEqual(self.count_queries(lookups), 1)
+        self.assertTrue(results[0])
+        self.assertIs(results[0], results[1])
+
+    def test_no_autoflush_respected(self):
+        with db.session.no_autoflush:
+            pending = Contact(realname='pending', public_key='key')
+            db.session.add(pending)
+            Contact.get(self.bob.contact.id)
+            self.assertIn(pending, db.session.new)
+        db.session.rollback()
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+
+from pyaspora.contact.models import Contact
+from pyaspora.database import db
+from pyaspora.diaspora import models
+from pyaspora.diaspora.models import DiasporaContact, MessageQueue
+from tests.base import AppTestCase
+
+PAYLOAD = b'<XML><post><status_message><raw_message>hello</raw_message>' \
+    b'</status_message></post></XML>'
+
+
+class OutgoingQueueTest(AppTestCase):
+    def setUp(self):
+        super(OutgoingQueueTest, self).setUp()
+        self.posted = []
+        self.real_post_envelope = models.post_envelope
+        models.post_envelope = self.post_envelope
+
+        remote_ids = []
+        for server in ('https://up.example/', 'https://down.example/'):
+            contact = Contact(realname=server, public_key='key')
+            db.session.add(DiasporaContact(
+                contact=contact,
+                server=server,
+                guid=server,
+                username='someone@{0}'.format(server)
+            ))
+            db.session.flush()
+            remote_ids.append(contact.id)
+        MessageQueue.queue_relay(
+            self.alice, PAYLOAD, remote_ids, public=True, relay=False)
+        MessageQueue.queue_relay(
+            self.alice, b'not XML', remote_ids[:1], public=True, relay=False)
+        db.session.commit()
+
+    def tearDown(self):
+        models.post_envelope = self.real_post_envelope
+        super(OutgoingQueueTest, self).tearDown()
+
+    def post_envelope(self, url, envelope):
+        if url.startswith('https://down.example/'):
+            raise IOError('Connection refused')
+        self.posted.append(url)
+
+    def queued(self):
+        return dict(
+            (qi.body, qi) for qi in
+            db.session.query(MessageQueue).filter(
+                MessageQueue.local_id == self.alice_id)
+        )
+
+    def test_feed_does_not_wait_for_delivery(self):
+        feed = self.get_json(self.as_alice, '/feed/')
+        self.assertIn('run_outgoing_queue', feed['actions']['send_queued'])
+        self.assertEqual(self.posted, [])
+
+        resp = self.as_alice.get('/feed/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'run_outgoing_queue', resp.data)
+
+    def test_run_outgoing_queue(self):
+        resp = self.as_alice.get('/diaspora/run_outgoing_queue')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Refresh', resp.headers)
+        self.assertEqual(self.posted, ['https://up.example/receive/public'])
+
+        db.session.expire_all()
+        queued = self.queued()
+        self.assertEqual(sorted(queued), sorted([b'not XML', PAYLOAD]))
+        # The node that was down is retried later
+        self.assertTrue(queued[PAYLOAD].last_attempted_at)
+        self.assertFalse(queued[PAYLOAD].error)
+        # ...and the bad payload didn't stop the good one
+        self.assertTrue(queued[b'not XML'].error)
+
+        feed = self.get_json(self.as_alice, '/feed/')
+        self.assertNotIn('send_queued', feed['actions'])
@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+
+from lxml import etree
+from sqlalchemy import event
+
+from pyaspora.contact.models import Contact
+from pyaspora.content.models import MimePart
+from pyaspora.database import db
+from pyaspora.diaspora.actions import PollParticipation
+from pyaspora.diaspora.models import DiasporaContact, DiasporaPart, \
+    DiasporaPollVote
+from pyaspora.post.models import Post
+from tests.base import AppTestCase
+
+QUESTION = 'application/x-diaspora-poll-question'
+ANSWER = 'application/x-diaspora-poll-answer'
+
+
+class PollTest(AppTestCase):
+    def setUp(self):
+        super(PollTest, self).setUp()
+        self.voters = []
+        for n in range(3):
+            contact = Contact(realname='voter{0}'.format(n), public_key='key')
+            db.session.add(DiasporaContact(
+                contact=contact,
+                server='https://remote.example/',
+                guid='voter{0}'.format(n),
+                username='voter{0}@remote.example'.format(n)
+            ))
+            self.voters.append(contact)
+        self.polls = [
+            self.make_poll('Tea or coffee?', ['Tea', 'Coffee']),
+            self.make_poll('Cats or dogs?', ['Cats', 'Dogs'])
+        ]
+        db.session.flush()
+        for question, answers in self.polls:
+            for voter, answer in zip(self.voters, [0, 1, 1]):
+                db.session.add(DiasporaPollVote(
+                    guid='{0}-{1}'.format(question.id, voter.id),
+                    poll_part_id=question.id,
+                    answer_part_id=answers[answer].id,
+                    voter_id=voter.id
+                ))
+        db.session.commit()
+
+    def make_poll(self, question, answers):
+        post = Post(author=self.bob.contact)
+        question = MimePart(type=QUESTION, body=question.encode('utf-8'))
+        question.diasp = DiasporaPart(guid=question.body.decode('utf-8'))
+        post.add_part(question, inline=True, order=1)
+        answer_parts = []
+        for pos, answer in enumerate(answers):
+            part = MimePart(type=ANSWER, body=answer.encode('utf-8'))
+            part.diasp = DiasporaPart(guid=answer)
+            post.add_part(part, inline=True, order=2 + pos)
+            answer_parts.append(part)
+        post.share_with([self.bob.contact], show_on_wall=True)
+        post.thread_modified()
+        return question, answer_parts
+
+    def test_tallies_counted_in_one_query(self):
+        statements = []
+
+        def collect(conn, cursor, statement, parameters, context, many):
+            if 'diaspora_poll_votes' in statement:
+                statements.append(statement)
+
+        engine = db.get_engine(db.get_app())
+        event.listen(engine, 'before_cursor_execute', collect)
+        try:
+            profile = self.get_json(
+                self.as_alice,
+                '/contacts/{0}/profile'.format(self.bob.contact.id)
+            )
+        finally:
+            event.remove(engine, 'before_cursor_execute', collect)
+
+        self.assertEqual(len(statements), 1)
+        texts = [
+            [part['body']['text'] for part in post['parts']]
+            for post in profile['feed'][:2]
+        ]
+        self.assertEqual(texts, [
+            ['Question: Cats or dogs? (3 votes)', '- Cats (1)', '- Dogs (2)'],
+            ['Question: Tea or coffee? (3 votes)', '- Tea (1)', '- Coffee (2)']
+        ])
+
+    def test_vote_for_answer_from_another_poll(self):
+        xml = etree.fromstring(
+            '<XML><post><poll_participation>'
+            '<guid>stray-vote</guid>'
+            '<parent_guid>Tea or coffee?</parent_guid>'
+            '<diaspora_handle>voter0@remote.example</diaspora_handle>'
+            '<poll_answer_guid>Dogs</poll_answer_guid>'
+            '<author_signature>sig</author_signature>'
+            '</poll_participation></post></XML>'
+        )
+        self.assertRaises(
+            AssertionError,
+            PollParticipation.receive, xml, self.voters[0], None
+        )
+        self.assertIsNone(DiasporaPollVote.get_by_guid('stray-vote'))
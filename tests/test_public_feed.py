@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+
+import json
+import os
+import time
+
+from pyaspora import app
+from pyaspora.database import db
+from pyaspora.diaspora.models import DiasporaContact
+from tests.base import AppTestCase
+
+
+class PublicFeedTest(AppTestCase):
+    def setUp(self):
+        super(PublicFeedTest, self).setUp()
+        self.create_post(self.as_alice, 'hello world', target_type='wall')
+        self.guid = DiasporaContact.get_for_contact(self.alice.contact).guid
+        db.session.commit()
+        # Local time must not be mistaken for UTC
+        self.real_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+
+    def tearDown(self):
+        if self.real_tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.real_tz
+        time.tzset()
+        super(PublicFeedTest, self).tearDown()
+
+    def fetch(self, max_time):
+        return app.test_client().get(
+            '/people/{0}?max_time={1}'.format(self.guid, max_time))
+
+    def test_max_time_is_utc(self):
+        resp = self.fetch(int(time.time()) + 60)
+        self.assertEqual(resp.status_code, 200)
+        feed = json.loads(resp.data.decode('utf-8'))
+        self.assertEqual(len(feed), 1)
+
+        resp = self.fetch(int(time.time()) - 3600)
+        self.assertEqual(json.loads(resp.data.decode('utf-8')), [])
+
+    def test_invalid_max_time(self):
+        for max_time in ('soon', '9' * 30):
+            self.assertEqual(self.fetch(max_time).status_code, 400)
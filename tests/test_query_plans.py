@@ -0,0 +1,185 @@
+"""
+EXPLAIN QUERY PLAN checks for the hot queries: every SELECT run while the
+feed, profile, tag feed, sync and replies pages are built, and by the
+MessageQueue helpers, is planned against a seeded database, and the test
+fails if SQLite would read a whole table to answer it.
+"""
+from __future__ import absolute_import
+
+import random
+import re
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+
+from pyaspora import init_db
+from pyaspora.database import db
+from tests.base import AppTestCase
+from tests.seed import seed_node
+
+QUEUED = 1000
+
+# SQLite 3.36 and later print "SCAN posts"; earlier versions "SCAN TABLE
+# posts". Either way a bare scan, with no index named, reads every row.
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+
+
+class QueryPlanTest(AppTestCase):
+    def setUp(self):
+        super(QueryPlanTest, self).setUp()
+        self.seed()
+        self.tables = set(db.metadata.tables)
+
+    def seed(self):
+        rand = random.Random(47)
+        contact_ids, tags = seed_node(
+            self.alice.contact.id, self.bob.contact.id + 1, rand=rand)
+        conn = db.session.connection()
+        start = datetime(2020, 1, 1)
+        conn.execute(
+            'INSERT INTO message_queue (local_id, remote_id, format, body, '
+            'created_at) VALUES (?, ?, ?, ?, ?)',
+            [
+                (self.bob.id,
+                 rand.choice(contact_ids),
+                 rand.choice(['application/x-diaspora-slap',
+                              'application/x-diaspora-public-slap',
+                              'application/x-pyaspora-relay']),
+                 b'<xml/>',
+                 start)
+                for n in range(QUEUED)
+            ]
+        )
+        db.session.commit()
+        self.tagged_post = tags[0][0]
+        self.tag_name = 'topic{0}'.format(tags[0][1] - 1000)
+        self.friend_id = contact_ids[0]
+
+    @contextmanager
+    def capture(self):
+        """
+        Collect (statement, parameters) for every SELECT run in the block.
+        """
+        statements = []
+
+        def collect(conn, cursor, statement, parameters, context, many):
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                statements.append((statement, parameters))
+
+        engine = db.get_engine(db.get_app())
+        event.listen(engine, 'before_cursor_execute', collect)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, 'before_cursor_execute', collect)
+
+    def full_scans(self, statements):
+        """
+        The plan lines for full scans of tables among <statements>.
+        """
+        found = []
+        for statement, parameters in statements:
+            aliases = dict(
+                (alias, table) for table, alias in
+                re.findall(r'\b(\w+) AS (\w+)\b', statement)
+                if table in self.tables
+            )
+            cursor = db.session.connection().connection.cursor()
+            plan = cursor.execute(
+                'EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+            for row in plan:
+                match = FULL_SCAN.match(row[-1])
+                if not match:
+                    continue
+                name = match.group(1)
+                if name in self.tables or name in aliases:
+                    found.append('{0}\n    in: {1}'.format(
+                        row[-1], ' '.join(statement.split())))
+        return found
+
+    def assertNoFullScans(self, statements):
+        self.assertTrue(statements)
+        scans = self.full_scans(statements)
+        self.assertEqual(scans, [], '\n'.join(scans))
+
+    def assertPageIndexed(self, client, url):
+        self.get_json(client, url)  # settle the once-per-worker caches
+        with self.capture() as statements:
+            data = self.get_json(client, url)
+        self.assertNoFullScans(statements)
+        return data
+
+    def test_feed(self):
+        as_alice = self.as_alice
+        data = self.assertPageIndexed(as_alice, '/feed/?limit=20')
+        more = data['actions']['more'].replace('http://localhost', '')
+        self.assertPageIndexed(as_alice, more)
+
+    def test_timeline_feed(self):
+        from pyaspora import app
+        from pyaspora.feed.models import TimelineEntry
+        app.config['FEATURES'] = {'timelines': True}
+        TimelineEntry.rebuild_all()
+        db.session.commit()
+        data = self.assertPageIndexed(self.as_alice, '/feed/?limit=20')
+        more = data['actions']['more'].replace('http://localhost', '')
+        self.assertPageIndexed(self.as_alice, more)
+
+    def test_profile(self):
+        self.assertPageIndexed(
+            self.as_alice, '/contacts/{0}/profile'.format(self.friend_id))
+        self.assertPageIndexed(
+            self.as_alice,
+            '/contacts/{0}/profile'.format(self.alice.contact.id)
+        )
+
+    def test_tag_feed(self):
+        self.assertPageIndexed(
+            self.as_alice, '/tags/{0}/feed'.format(self.tag_name))
+
+    def test_sync(self):
+        token = self.assertPageIndexed(self.as_alice, '/feed/sync')['token']
+        self.assertPageIndexed(
+            self.as_alice, '/feed/sync?since={0}'.format(token))
+
+    def test_replies(self):
+        parent = db.session.execute(
+            'SELECT parent_id FROM posts JOIN shares '
+            'ON shares.post_id = posts.parent_id AND shares.public '
+            'GROUP BY parent_id ORDER BY count(*) DESC LIMIT 1'
+        ).scalar()
+        self.assertPageIndexed(
+            self.as_alice, '/posts/{0}/replies'.format(parent))
+
+    def test_indexes_updated(self):
+        names = ('ix_shares_post_public_hidden',
+                 'ix_shares_contact_hidden_public')
+        for name in names:
+            db.session.execute('DROP INDEX {0}'.format(name))
+        old_names = ('ix_shares_post_id', 'ix_posts_thread_modified')
+        db.session.execute(
+            'CREATE INDEX ix_shares_post_id ON shares (post_id)')
+        db.session.execute(
+            'CREATE INDEX ix_posts_thread_modified '
+            'ON posts (thread_modified_at, id)')
+        db.session.commit()
+        init_db()
+        found = set(row[0] for row in db.session.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"))
+        self.assertTrue(found.issuperset(names))
+        self.assertFalse(found.intersection(old_names))
+
+    def test_message_queue(self):
+        from pyaspora.diaspora.models import MessageQueue
+        user = self.bob
+        with self.capture() as statements:
+            MessageQueue.has_pending_items(user)
+            MessageQueue.has_pending_outgoing(user)
+            for criteria in (
+                MessageQueue.Queries.pending_items_for_user(user),
+                MessageQueue.Queries.pending_outgoing_for_user(user),
+                MessageQueue.Queries.pending_public_items()
+            ):
+                db.session.query(MessageQueue).filter(criteria). \
+                    order_by(MessageQueue.created_at).limit(10).all()
+        self.assertNoFullScans(statements)
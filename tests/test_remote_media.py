@@ -0,0 +1,111 @@
+from __future__ import absolute_import
+
+from os import path
+
+from pyaspora import app, diaspora
+from pyaspora.content import proxy
+from pyaspora.content.models import MimePart
+from pyaspora.database import db
+from pyaspora.post.models import Post, PostPart
+from tests.base import AppTestCase
+
+
+class FakeResponse(object):
+    def __init__(self, body, mime_type):
+        self.body = body
+        self.headers = {'Content-Type': mime_type}
+
+    def read(self, size=-1):
+        return self.body if size < 0 else self.body[:size]
+
+    def info(self):
+        return self.headers
+
+
+class RemoteMediaTest(AppTestCase):
+    def setUp(self):
+        super(RemoteMediaTest, self).setUp()
+        self.real_urlopen = diaspora.urlopen
+        self.real_download = proxy._download
+        app.config['REMOTE_MEDIA_MAX_SIZE'] = 10
+        app.config['REMOTE_MEDIA_CACHE'] = path.join(self.tmp_dir, 'media')
+
+    def tearDown(self):
+        diaspora.urlopen = self.real_urlopen
+        proxy._download = self.real_download
+        for key in ('REMOTE_MEDIA_MAX_SIZE', 'REMOTE_MEDIA_CACHE'):
+            app.config.pop(key, None)
+        super(RemoteMediaTest, self).tearDown()
+
+    def test_eager_fetch(self):
+        diaspora.urlopen = lambda req, timeout: \
+            FakeResponse(b'small', 'image/png')
+        part = diaspora.import_url_as_mimepart('https://remote.example/a')
+        self.assertEqual(part.body, b'small')
+        self.assertEqual(part.type, 'image/png')
+
+    def test_eager_fetch_too_large(self):
+        diaspora.urlopen = lambda req, timeout: \
+            FakeResponse(b'x' * 1000, 'image/png')
+        part = diaspora.import_url_as_mimepart('https://remote.example/a')
+        self.assertEqual(part.body, b'')
+        self.assertEqual(part.remote.url, 'https://remote.example/a')
+        self.assertTrue(part.remote.too_large)
+
+    def test_lazy_fetch_finds_type(self):
+        app.config['FEATURES'] = {'lazy_remote_media': True}
+        part = diaspora.import_url_as_mimepart(
+            'https://remote.example/photos/12345')
+        self.assertEqual(part.type, 'application/octet-stream')
+        part_id = self.share_part(part)
+
+        proxy._download = lambda url: (b'picture', 'image/jpeg')
+        resp = self.as_alice.get('/content/{0}/raw'.format(part_id))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b'picture')
+
+        db.session.expire_all()
+        self.assertEqual(MimePart.get(part_id).type, 'image/jpeg')
+        link = db.session.query(PostPart). \
+            filter(PostPart.mime_part_id == part_id).one()
+        self.assertTrue(link.inline)
+
+    def share_part(self, part):
+        part.text_preview = '(picture)'
+        post = Post(author=self.alice.contact)
+        post.add_part(part, inline=proxy.shown_inline(part.type))
+        post.share_with([self.alice.contact], show_on_wall=True)
+        db.session.commit()
+        return part.id
+
+    def test_too_large_not_downloaded_on_view(self):
+        diaspora.urlopen = lambda req, timeout: \
+            FakeResponse(b'x' * 1000, 'image/png')
+        part = diaspora.import_url_as_mimepart('https://remote.example/a')
+        self.assertTrue(part.remote.too_large)
+        self.assertEqual(part.type, 'image/png')
+        part_id = self.share_part(part)
+
+        downloads = []
+        proxy._download = lambda url: downloads.append(url) or (None, None)
+        resp = self.as_alice.get('/content/{0}/raw'.format(part_id))
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(resp.headers['Location'], 'https://remote.example/a')
+        self.assertEqual(downloads, [])
+
+    def test_lazy_fetch_too_large(self):
+        app.config['FEATURES'] = {'lazy_remote_media': True}
+        part = diaspora.import_url_as_mimepart('https://remote.example/b.png')
+        self.assertFalse(part.remote.too_large)
+        part_id = self.share_part(part)
+
+        downloads = []
+        proxy._download = lambda url: downloads.append(url) or (None, None)
+        for attempt in range(2):
+            resp = self.as_alice.get('/content/{0}/raw'.format(part_id))
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(resp.headers['Location'],
+                             'https://remote.example/b.png')
+        self.assertEqual(downloads, ['https://remote.example/b.png'])
+        db.session.expire_all()
+        self.assertTrue(MimePart.get(part_id).remote.too_large)
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+
+from pyaspora import app
+from tests.base import AppTestCase
+
+
+class ThreadTest(AppTestCase):
+    def tearDown(self):
+        app.config.pop('REPLY_WINDOW', None)
+        super(ThreadTest, self).tearDown()
+
+    def test_post_without_replies(self):
+        self.create_post(self.as_alice, 'nobody answers this')
+
+        feed = self.get_json(self.as_bob, '/feed/')['feed']
+        self.assertEqual(len(feed), 3)  # and the two subscription notices
+        self.assertEqual(feed[0]['children'], [])
+        self.assertEqual(feed[0]['replies'], 0)
+
+        profile = self.get_json(
+            self.as_bob,
+            '/contacts/{0}/profile'.format(self.alice.contact.id)
+        )
+        self.assertEqual(profile['feed'][0]['children'], [])
+
+        sync = self.get_json(self.as_bob, '/feed/sync')
+        self.assertTrue(sync['reset'])
+        sync = self.get_json(
+            self.as_bob, '/feed/sync?since={0}'.format(sync['token']))
+        self.assertEqual(sync['children'], [])
+
+    def test_post_with_replies(self):
+        self.create_post(self.as_alice, 'a question')
+        post_id = self.get_json(self.as_bob, '/feed/')['feed'][0]['id']
+        self.create_post(
+            self.as_bob,
+            'an answer',
+            target_type='existing',
+            relationship_type='comment',
+            relationship_id=str(post_id)
+        )
+
+        feed = self.get_json(self.as_alice, '/feed/')['feed']
+        self.assertEqual(feed[0]['id'], post_id)
+        self.assertEqual(feed[0]['replies'], 1)
+        self.assertEqual(
+            [c['parts'][0]['body']['text'] for c in feed[0]['children']],
+            ['an answer']
+        )
+
+    def test_limited_replies_not_shown_to_public(self):
+        app.config['REPLY_WINDOW'] = 1
+        self.create_post(self.as_alice, 'an open question', target_type='wall')
+        post_id = self.get_json(self.as_bob, '/feed/')['feed'][0]['id']
+        for client, body, target_type in (
+            (self.as_alice, 'a public answer', 'wall'),
+            (self.as_bob, 'a private answer', 'self'),
+        ):
+            self.create_post(
+                client,
+                body,
+                target_type=target_type,
+                relationship_type='comment',
+                relationship_id=str(post_id)
+            )
+
+        url = '/contacts/{0}/profile'.format(self.alice.contact.id)
+        for client, replies, shown in (
+            (app.test_client(), 1, 'a public answer'),
+            (self.as_bob, 2, 'a private answer'),
+        ):
+            post = self.get_json(client, url)['feed'][0]
+            self.assertEqual(post['id'], post_id)
+            self.assertEqual(post['replies'], replies)
+            self.assertEqual(
+                [c['parts'][0]['body']['text'] for c in post['children']],
+                [shown]
+            )